@@ -3,22 +3,29 @@ import logging
 import os
 
 from dotenv import load_dotenv
-from flask import Flask, request
-from rb_core_backend.data_management import RBCoreDataManagement
-from rb_core_backend.external_sources.index import RBCoreExternalSources
+from flask import Flask, make_response, request
 from rb_core_backend.external_sources.kaggle import RBCoreExternalSourceKaggle
-from rb_core_backend.mongo import RBCoreBackendMongo
 from rb_core_backend.preprocess_dataset import PreprocessDataOptions, RBCoreDatasetPreprocessor
 from rb_core_backend.util import configure_logger, json_return, remove_files
 
+from services.cache import DXDatasetCache
+from services.compression import (
+    conditional_response, file_validators, negotiate_encoding, not_modified, precompressed_variant
+)
+from services.data_management import DXRBCoreDataManagement, dataset_id, write_frames_parquet
 from services.external_sources._hdx import DXExternalSourceHDX
 from services.external_sources.dw import DXExternalSourceDW
+from services.external_sources.index import INDEXING_SUCCESSFUL, DXExternalSources
 from services.external_sources.oecd import DXExternalSourceOECD
 from services.external_sources.tgf import DXExternalSourceTGF
+from services.external_sources.util import STAGING_FOLDER, TTLCache
 from services.external_sources.who import DXExternalSourceWHO
 from services.external_sources.worldbank import DXExternalSourceWB
-
-INDEXING_SUCCESSFUL = "Indexing successful"
+from services.jobs import JOB_STATES, JOBS_LIST_MAX_LIMIT, DXJobQueue, report_progress
+from services.metrics import DXMetrics
+from services.mongo import DXBackendMongo
+from services.passthrough import passthrough_enabled, stream_json_file
+from services.size_ledger import DXDatasetSizeLedger
 
 
 # Create a subclass implementing RBCoreDatasetPreprocessor
@@ -33,7 +40,53 @@ class DXRBCoreDatasetPreprocessor(RBCoreDatasetPreprocessor):
         options: PreprocessDataOptions = PreprocessDataOptions(),
     ) -> str:
         # Custom preprocessing steps can be added here
-        return super().preprocess_data(name, create_ds, table, db, api, options)
+        # A dataset created again under a deleted id is reclaimed first, so the reclaimer cannot remove the new files.
+        if isinstance(name, str) and data_manager.is_deleted(name):
+            data_manager.reclaim_datasets([dataset_id(name)])
+        res = super().preprocess_data(name, create_ds, table, db, api, options)
+        if isinstance(name, str):
+            data_manager.invalidate(name)
+            data_manager.record_size(name)
+        # Write the columnar copy of newly parsed datasets, used for paged reads.
+        if res == "Success" and create_ds and isinstance(name, str) and columnar_enabled():
+            migrate_res = data_manager.migrate_parsed_to_columnar(name)
+            if migrate_res != "Success":
+                logger.info(f"Dataset {name} is served from JSON: {migrate_res}")
+        return res
+
+    def preprocess_dataframe(
+        self,
+        frames,
+        name: str,
+        drop_empty_columns: bool = False,
+        options: PreprocessDataOptions = PreprocessDataOptions(),
+    ) -> str:
+        """
+        Create the dataset `name` from DataFrames, such as the frames built by the external sources.
+        The frames are staged as a parquet file named after the dataset, instead of a CSV file,
+        so the column types are kept and nothing is serialised to text and parsed again.
+        The file is preprocessed with preprocess_data, so the same steps apply as for any other dataset.
+
+        :param frames: A DataFrame, or an iterable of DataFrames which are written one at a time.
+        :param name: The name of the dataset to create.
+        :param drop_empty_columns: Whether columns without any value are left out.
+        :param options: The preprocessing options.
+        :return: A string indicating the result of the preprocessing.
+        """
+        os.makedirs(STAGING_FOLDER, exist_ok=True)
+        dx_name = f"{name}.parquet"
+        dx_loc = os.path.join(STAGING_FOLDER, dx_name)
+        try:
+            if write_frames_parquet(frames, dx_loc, drop_empty_columns=drop_empty_columns) == 0:
+                return "The dataset is empty, please try a different dataset."
+            return self.preprocess_data(dx_name, create_ds=True, options=options)
+        finally:
+            if os.path.exists(dx_loc):
+                os.remove(dx_loc)
+
+
+def columnar_enabled():
+    return os.getenv("PARSED_DATA_COLUMNAR", "false").lower() == "true"
 
 
 # Load all app requirements
@@ -42,13 +95,16 @@ load_dotenv()
 # - Setup and confirm the logger
 configure_logger()
 logger = logging.getLogger(__name__)
-# - Create a RBCoreDataManagement instance
-data_manager = RBCoreDataManagement(location=os.getenv("DATA_EXPLORER_SSR"))
+# - Create a RBCoreDataManagement instance, extended with the columnar parsed data store
+#   a dataset cache shared by all workers, and the dataset size ledger
+data_manager = DXRBCoreDataManagement(
+    location=os.getenv("DATA_EXPLORER_SSR"), cache=DXDatasetCache(), size_ledger=DXDatasetSizeLedger()
+)
 # - Create a RBCorePreprocessDataset instance
 # -- Instantiate the subclass
 dataset_preprocessor = DXRBCoreDatasetPreprocessor(data_manager=data_manager, logger=logger)
-# - Create a RBCoreBackendMongo instance
-mongo_client = RBCoreBackendMongo(
+# - Create a RBCoreBackendMongo instance, extended with bulk operations for the external source indexers
+mongo_client = DXBackendMongo(
     mongo_host=os.getenv("MONGO_HOST"),
     mongo_username=os.getenv("MONGO_USERNAME"),
     mongo_password=os.getenv("MONGO_PASSWORD"),
@@ -58,6 +114,8 @@ mongo_client = RBCoreBackendMongo(
 )
 # -- Ensure we always have a text index for FederatedSearchIndex
 mongo_client.mongo_create_text_index_for_external_sources()
+# -- Ensure the indexes used for bulk upserts and resource lookups exist
+mongo_client.mongo_create_lookup_indexes_for_external_sources()
 # -- External sources
 # --- Instantiate Kaggle:
 source_classes = {
@@ -87,11 +145,155 @@ sources_dict = {
     }
     for name, instance in sources_dict.items()
 }
-# --- Create the external sources manager
-external_sources_manager = RBCoreExternalSources(mongo_client=mongo_client, all_sources=sources_dict)
+# --- Create the external sources manager, with a cache of ranked search results
+external_sources_manager = DXExternalSources(mongo_client=mongo_client, all_sources=sources_dict)
+
+# - Create the job queue for long-running routes, executed by the `flask worker` command
+job_queue = DXJobQueue()
+# -- Precompressed variants requested from this process, so each is only enqueued once while its job runs,
+#    requests expire so a variant whose job failed is requested again
+precompress_requested = TTLCache(ttl=int(os.getenv("PRECOMPRESS_REQUEST_TTL", 600)), max_size=1024)
 
 # - Set up the flask app
 app = Flask(__name__)
+# -- Time every route and the main data, preprocessing and external source calls, exposed on /metrics
+metrics = DXMetrics()
+metrics.init_app(app)
+metrics.instrument(
+    data_manager,
+    "data_manager",
+    [
+        "load_parsed_data",
+        "load_sample_data",
+        "duplicate_parsed_files",
+        "duplicate_datasets",
+        "remove_parsed_files",
+        "reclaim_datasets",
+        "get_dataset_size",
+    ],
+)
+metrics.instrument(dataset_preprocessor, "dataset_preprocessor", ["preprocess_data"])
+metrics.instrument(
+    external_sources_manager,
+    "external_sources_manager",
+    ["external_search_index", "search_external_sources", "download_external_source"],
+)
+
+
+def async_requested():
+    """
+    Long-running routes are enqueued as a job when called with ?async=true, and run inline with ?async=false.
+    Without the parameter, JOBS_ASYNC_DEFAULT decides, inline by default so existing clients keep their results.
+    """
+    return request.args.get("async", os.getenv("JOBS_ASYNC_DEFAULT", "false")).lower() == "true"
+
+
+def enqueue_job(name, **kwargs):
+    """
+    Enqueue a job and return its id, to be polled through /jobs/<job_id>.
+    """
+    try:
+        job_id = job_queue.enqueue(name, **kwargs)
+    except Exception as e:
+        logging.error(f"Error enqueueing job {name} - {str(e)}")
+        return json_return(500, "Sorry, we were unable to schedule this task. Contact the admin for more information.")
+    return json_return(202, {"jobId": job_id, "state": "queued"})
+
+
+"""
+Jobs
+"""
+
+
+@app.route("/jobs", methods=["GET"])
+def list_jobs():
+    """
+    List the most recent jobs, optionally filtered with ?state=queued|running|finished|failed|interrupted
+    The number of jobs is set with ?limit, 50 by default and at most JOBS_LIST_MAX_LIMIT.
+    """
+    state = request.args.get("state", None)
+    if state is not None and state not in JOB_STATES:
+        return json_return(400, f"Unknown job state: {state}")
+    try:
+        limit = int(request.args.get("limit", 50))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        return json_return(400, f"The limit must be a number between 1 and {JOBS_LIST_MAX_LIMIT}")
+    limit = min(limit, JOBS_LIST_MAX_LIMIT)
+    try:
+        res = job_queue.list(state=state, limit=limit)
+    except Exception as e:
+        logging.error(f"Error in route: /jobs - {str(e)}")
+        res = "Sorry, something went wrong while listing jobs. Contact the admin for more information."
+    code = 200 if not isinstance(res, str) else 500
+    return json_return(code, res)
+
+
+@app.route("/jobs/<string:job_id>", methods=["GET"])
+def get_job(job_id):
+    """
+    Return the state, progress counters and result of a job
+    """
+    try:
+        res = job_queue.get(job_id)
+    except Exception as e:
+        logging.error(f"Error in route: /jobs/<string:job_id> - {str(e)}")
+        return json_return(500, "Sorry, something went wrong while retrieving the job. Contact the admin.")
+    if res is None:
+        return json_return(404, "Job not found")
+    return json_return(200, res)
+
+
+@app.cli.command("worker")
+def jobs_worker():
+    """
+    Run the job worker processes, the number of processes is set with JOBS_WORKERS.
+    """
+    # Resume reclaiming datasets which were deleted before a restart
+    ds_ids = data_manager.tombstoned_datasets()
+    if len(ds_ids) > 0:
+        job_queue.enqueue("reclaim-datasets", ds_ids=ds_ids)
+    job_queue.work(processes=int(os.getenv("JOBS_WORKERS", 2)))
+
+
+@app.cli.command("reconcile-dataset-sizes")
+def reconcile_dataset_sizes():
+    """
+    Rebuild the dataset size ledger used by /dataset-size from the files on disk.
+    """
+    n_datasets = data_manager.reconcile_sizes()
+    logger.info(f"Reconciled the size ledger with {n_datasets} datasets")
+
+
+@app.cli.command("migrate-parsed-data")
+def migrate_parsed_data():
+    """
+    Write the columnar copy of every parsed dataset, datasets that cannot be migrated keep being served from JSON.
+    """
+    ds_names = data_manager.parsed_datasets()
+    migrated = 0
+    for ds_name in ds_names:
+        res = data_manager.migrate_parsed_to_columnar(ds_name)
+        if res == "Success":
+            migrated += 1
+        else:
+            logger.info(f"Dataset {ds_name} is served from JSON: {res}")
+    logger.info(f"Migrated {migrated} of {len(ds_names)} parsed datasets to the columnar store")
+
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    """
+    Return the hit, miss and eviction counters and the size of the shared dataset cache
+    """
+    try:
+        return json_return(200, data_manager.cache.stats())
+    except Exception as e:
+        logging.error(f"Error in route: /cache/stats - {str(e)}")
+        return json_return(
+            500, "Sorry, something went wrong in our cache statistics. Contact the admin for more information."
+        )
 
 
 """
@@ -107,24 +309,30 @@ def health_check():
 @app.route("/upload-file/<string:ds_name>", methods=["POST"])
 def process_dataset(ds_name):
     logging.debug(f"route: /upload-file/<string:ds_name> - Processing dataset {ds_name}")
+    if async_requested():
+        return enqueue_job("process-dataset", ds_name=ds_name)
+    return json_return(*process_dataset_job(ds_name))
+
+
+@job_queue.task("process-dataset")
+def process_dataset_job(ds_name):
     try:
         # Preprocess
         preprocess_res = dataset_preprocessor.preprocess_data(ds_name, create_ds=True)
         if preprocess_res != "Success":
-            return json_return(500, preprocess_res)
+            return 500, preprocess_res
         # Create a solr core and post the dataset
         # res = post_data_to_solr(ds_name)  # TODO: Disabled solr until data processing required
         # Remove the processed file
         remove_res = remove_files([ds_name])
         code = 200 if remove_res == "Success" else 500
-        res = json_return(code, remove_res)
+        return code, remove_res
     except Exception as e:
         logging.error(f"Error in route: /upload-file/<string:ds_name> - {str(e)}")
-        res = json_return(
+        return (
             500,
             "Sorry, something went wrong in our dataset processing. Contact the admin for more information.",
         )  # noqa: E501
-    return res
 
 
 @app.route("/duplicate-dataset/<string:ds_name>/<string:new_ds_name>", methods=["POST"])
@@ -161,22 +369,24 @@ def duplicate_datasets():
             "new_ds_name": "new_dataset2"
         }
     ]
+    :return: A list with the result of every duplication, in the format:
+    [
+        {
+            "ds_name": "dataset1",
+            "new_ds_name": "new_dataset1",
+            "result": "Success"
+        }
+    ]
     """
     data = request.get_json()
     logging.debug(f"route: /duplicate-datasets - Duplicating dataset {len(data)} datasets")
     try:
-        errors = []
-        for ds in data:
-            res = data_manager.duplicate_parsed_files(ds["ds_name"], ds["new_ds_name"])
-            if res != "Success":
-                errors.append(ds["ds_name"])
-
-        if len(errors) > 0:
-            res = f"Sorry, something went wrong in our dataset duplication for {len(errors)} dataset(s). Contact the admin for more information."  # noqa: E501
+        res = data_manager.duplicate_datasets(data)
+        code = 200 if all(ds["result"] == "Success" for ds in res) else 500
     except Exception as e:
         logging.error(f"Error in route: /duplicate-datasets - {str(e)}")
         res = "Sorry, something went wrong in our dataset duplication. Contact the admin for more information."
-    code = 200 if res == "Success" else 500
+        code = 500
     return json_return(code, res)
 
 
@@ -206,6 +416,13 @@ def process_dataset_sqlite(ds_name, table):
     logging.debug(
         f"route: /upload-file/<string:ds_name>/<string:table> - Processing dataset {ds_name} with table {table}"
     )
+    if async_requested():
+        return enqueue_job("process-dataset-sqlite", ds_name=ds_name, table=table)
+    return json_return(*process_dataset_sqlite_job(ds_name, table))
+
+
+@job_queue.task("process-dataset-sqlite")
+def process_dataset_sqlite_job(ds_name, table):
     try:
         # Preprocess
         dataset_preprocessor.preprocess_data(ds_name, create_ds=True, table=table)
@@ -215,7 +432,7 @@ def process_dataset_sqlite(ds_name, table):
         logging.error(f"Error in route: /upload-file/<string:ds_name>/<string:table> - {str(e)}")
         res = "Sorry, something went wrong in our sqlite dataset processing. Contact the admin for more information."
     code = 200 if res == "Success" else 500
-    return json_return(code, res)
+    return code, res
 
 
 @app.route(
@@ -226,22 +443,29 @@ def process_dataset_sql(ds_name, username, password, host, port, database, table
     logging.debug(
         f"route: /upload-file/<string:ds_name>/<string:table> - Processing dataset {ds_name} with table {table} @ {host}:{port}/{database}"  # NOQA: E501
     )
+    db = {
+        "username": username,
+        "password": password,
+        "host": host,
+        "port": port,
+        "database": database,
+        "table": table,
+    }
+    if async_requested():
+        return enqueue_job("process-dataset-sql", ds_name=ds_name, db=db)
+    return json_return(*process_dataset_sql_job(ds_name, db))
+
+
+@job_queue.task("process-dataset-sql")
+def process_dataset_sql_job(ds_name, db):
     try:
         # Preprocess
-        db = {
-            "username": username,
-            "password": password,
-            "host": host,
-            "port": port,
-            "database": database,
-            "table": table,
-        }
         res = dataset_preprocessor.preprocess_data(ds_name, create_ds=True, db=db)
     except Exception as e:
         logging.error(f"Error in route: /upload-file/<string:ds_name>/<string:table> - {str(e)}")
         res = "Sorry, something went wrong in our sql dataset processing. Contact the admin for more information."
     code = 200 if res == "Success" else 500
-    return json_return(code, res)
+    return code, res
 
 
 @app.route(
@@ -252,19 +476,28 @@ def process_dataset_api(ds_name, api_url, json_root, xml_root):
     logging.debug(
         f"route: /upload-file/<string:ds_name>/<string:api_url> - Processing dataset {ds_name} with api_url: {api_url}, json_root: {json_root}, xml_root: {xml_root}"  # NOQA: E501
     )
+    api = {
+        "api_url": api_url,
+        "json_root": json_root,
+        "xml_root": xml_root,
+    }
+    if async_requested():
+        return enqueue_job("process-dataset-api", ds_name=ds_name, api=api)
+    _, res = process_dataset_api_job(ds_name, api)
+    return res
+
+
+@job_queue.task("process-dataset-api")
+def process_dataset_api_job(ds_name, api):
     try:
         # Preprocess
-        api = {
-            "api_url": api_url,
-            "json_root": json_root,
-            "xml_root": xml_root,
-        }
         dataset_preprocessor.preprocess_data(ds_name, create_ds=True, api=api)
         res = "Success"
     except Exception as e:
         logging.error(f"Error in route: /upload-file/<string:ds_name>/<string:table> - {str(e)}")
         res = "Sorry, something went wrong in our api dataset processing. Contact the admin for more information."
-    return res
+    code = 200 if res == "Success" else 500
+    return code, res
 
 
 @app.route("/delete-dataset/<string:ds_name>", methods=["POST"])
@@ -310,16 +543,11 @@ def delete_datasets():
     data = request.get_json()
     logging.debug(f"route: /delete-datasets - Deleting {len(data)} datasets")
     try:
-        errors = []
-        for ds_name in data:
-            if ds_name.startswith("dx") or ds_name.startswith("ds"):
-                ds_name = ds_name[2:]
-            res = data_manager.remove_parsed_files(ds_name)
-            if res != "Success":
-                errors.append(ds_name)
-        # Remove the dataset from SSR
-        if len(errors) > 0:
-            res = f"Sorry, something went wrong in our dataset deletion for {len(errors)} dataset(s). Contact the admin for more information."  # noqa: E501
+        # Mark the datasets as deleted, their files are reclaimed by the job workers
+        ds_ids = data_manager.tombstone(data)
+        job_id = job_queue.enqueue("reclaim-datasets", ds_ids=ds_ids)
+        logging.debug(f"route: /delete-datasets - Reclaiming {len(ds_ids)} datasets in job {job_id}")
+        res = "Success"
     except Exception as e:
         logging.error(f"Error in route: /delete-datasets - {str(e)}")
         res = "Sorry, something went wrong in our dataset deletion. Contact the admin for more information."
@@ -327,38 +555,107 @@ def delete_datasets():
     return json_return(code, res)
 
 
+@job_queue.task("reclaim-datasets")
+def reclaim_datasets_job(ds_ids):
+    res = data_manager.reclaim_datasets(ds_ids, progress=report_progress)
+    code = 200 if len(res["failed"]) == 0 else 500
+    return code, res
+
+
 @app.route("/sample-data/<string:ds_name>", methods=["GET"])
 def sample_data(ds_name):
     """
     Return sample data for a given dataset id
     """
     logging.debug(f"route: /sample-data/<string:ds_name> - Sampling dataset {ds_name}")
-    try:
-        res = data_manager.load_sample_data(ds_name)
-    except Exception as e:
-        logging.error(f"Error in route: /sample-data/<string:ds_name> - {str(e)}")
-        res = "Sorry, something went wrong in our dataset sampling. Contact the admin for more information."
-    code = 200 if not isinstance(res, str) else 500
-    return json_return(code, res)
+    if data_manager.is_deleted(ds_name):
+        return json_return(404, "Dataset not found")
+    path = data_manager.sample_file(ds_name)
+    if path is not None:
+        etag, last_modified = file_validators(path)
+        res = not_modified(etag, last_modified)
+        if res is not None:
+            return res
+    # Stream the stored sample as is, instead of loading and re-serialising it
+    res = stream_json_file(path) if path is not None and passthrough_enabled() else None
+    if res is None:
+        try:
+            res = data_manager.load_sample_data(ds_name)
+        except Exception as e:
+            logging.error(f"Error in route: /sample-data/<string:ds_name> - {str(e)}")
+            res = "Sorry, something went wrong in our dataset sampling. Contact the admin for more information."
+        code = 200 if not isinstance(res, str) else 500
+        if code != 200 or path is None:
+            return json_return(code, res)
+        res = make_response(json_return(code, res))
+    return conditional_response(res, etag, last_modified)
 
 
 @app.route("/dataset/<string:ds_name>", methods=["GET"])
 def get_dataset(ds_name):
     """
     Return the dataset for a given dataset id
+
+    With ?full=true the complete parsed file is streamed as stored, without paging.
     """
     page = int(request.args.get("page", 1))
     page_size = int(request.args.get("page_size", 10))
+    full = request.args.get("full", "false").lower() == "true"
 
     logging.debug(f"route: /dataset/<string:ds_name> - Getting dataset {ds_name}")
+    if data_manager.is_deleted(ds_name):
+        return json_return(404, "Dataset not found")
+    path = data_manager.parsed_file(ds_name)
+    if path is not None:
+        etag, last_modified = file_validators(path, "full" if full else f"{page}-{page_size}")
+        res = not_modified(etag, last_modified)
+        if res is not None:
+            return res
+    if full:
+        if path is None:
+            return json_return(404, "Dataset not found")
+        res = stream_full_dataset(path)
+        if res is None:
+            return json_return(
+                500, "Sorry, something went wrong in our dataset retrieval. Contact the admin for more information."
+            )
+        return conditional_response(res, etag, last_modified)
     try:
         res = data_manager.load_parsed_data(ds_name, page, page_size)
     except Exception as e:
         logging.error(f"Error in route: /dataset/<string:ds_name> - {str(e)}")
         res = "Sorry, something went wrong in our dataset retrieval. Contact the admin for more information."
+    if isinstance(res, str) or path is None:
+        return res
+    return conditional_response(make_response(res), etag, last_modified)
+
+
+def stream_full_dataset(path):
+    """
+    Stream a parsed file, from its precompressed variant for the negotiated encoding when it is available.
+    Missing variants are written by a job, and the file is compressed on the fly in the meantime.
+    """
+    encoding = negotiate_encoding()
+    variant = precompressed_variant(path, encoding, create=False) if encoding else None
+    if encoding and variant is None:
+        request_key = (path, encoding, os.path.getmtime(path))
+        if precompress_requested.get(request_key) is None:
+            precompress_requested.set(request_key, True)
+            job_queue.enqueue("precompress-file", path=path, encoding=encoding)
+    res = stream_json_file(variant or path, envelope=False)
+    if res is not None and variant is not None:
+        res.headers["Content-Encoding"] = encoding
     return res
 
 
+@job_queue.task("precompress-file")
+def precompress_file_job(path, encoding):
+    variant = precompressed_variant(path, encoding)
+    if variant is None:
+        return 500, f"The {encoding} variant of {path} could not be written."
+    return 200, "Success"
+
+
 """
 External data sources
 """
@@ -367,14 +664,25 @@ External data sources
 # Index
 @app.route("/external-sources/index", methods=["GET"])
 def external_sources_index():
+    """
+    Index all external sources concurrently, each in its own process.
+    Always enqueued as a job, as indexing runs far longer than the request timeout of the server.
+    The job result reports every source: {"status": "...", "sources": {"HDX": {"status": "success", "duration": 12.3,
+    "fetched": 100, "inserted": 5, "updated": 2, "skipped": 93, "deleted": 0, "failed": 0, "result": "..."}}}
+    """
     logging.debug("route: /external-sources/index - Indexing external sources")
+    return enqueue_job("external-sources-index")
+
+
+@job_queue.task("external-sources-index")
+def external_sources_index_job():
     try:
         res = external_sources_manager.external_search_index()
     except Exception as e:
         logging.error(f"Error in route: /external-sources/index - {str(e)}")
         res = "Sorry, something went wrong in our external source indexing. Contact the admin for more information."
-    code = 200 if res == INDEXING_SUCCESSFUL else 500
-    return json_return(code, res)
+    code = 200 if isinstance(res, dict) and res["status"] == INDEXING_SUCCESSFUL else 500
+    return code, res
 
 
 # Search
@@ -395,12 +703,19 @@ def external_source_search():
 # Search for a limited number of results.
 @app.route("/external-sources/search-limited", methods=["POST"])
 def external_source_search_limited():
+    """
+    Search the external sources, paged with limit and offset.
+
+    body: {"query": "", "source": "HDX,WHO", "limit": 10, "offset": 0, "sort_by": "textScore", "facets": false}
+    With facets set to true, the result is {"results": [...], "facets": {"source": {...}, "mainCategory": {...}}}
+    """
     data = request.get_json()
     query = data.get("query", "")
     source = data.get("source", "")
     limit = data.get("limit", 10)
     offset = data.get("offset", 0)
     sort_by = data.get("sort_by", "textScore")
+    facets = data.get("facets", False)
     logging.debug(f"route: /external-sources/search-limited/<string:query> - Searching external sources for {query}")
     try:
         res = external_sources_manager.search_external_sources(
@@ -411,6 +726,9 @@ def external_source_search_limited():
             offset=offset,
             sort_by=sort_by,
         )
+        # With facets, the counts by source and main category are returned alongside the results
+        if facets and not isinstance(res, str):
+            res = {"results": res, "facets": external_sources_manager.search_facets(query, source.split(","))}
     except Exception as e:
         logging.error(f"Error in route: /external-sources/search-limited/<string:query> - {str(e)}")
         res = "Sorry, something went wrong in our external source search. Contact the admin for more information."
@@ -424,65 +742,69 @@ def external_source_download():
     data = request.get_json()
     external_source = data.get("externalSource")
     logging.debug(f"route: /external-sources/search/<string:query> - Searching external sources for {external_source}")
+    if async_requested():
+        return enqueue_job("external-source-download", external_source=external_source)
+    return json_return(*external_source_download_job(external_source))
+
+
+@job_queue.task("external-source-download")
+def external_source_download_job(external_source):
     try:
         res = external_sources_manager.download_external_source(external_source)
     except Exception as e:
         logging.error(f"Error in route: /external-sources/search/<string:query> - {str(e)}")
         res = "Sorry, we were unable to download your selected file. Contact the admin for more information."
     code = 200 if res == "Success" else 500
-    return json_return(code, res)
+    return code, res
 
 
 # Force updates
-@app.route("/external-sources/force-update-who", methods=["GET"])
-def force_update_who():
-    logging.debug("route: /external-sources/force-update-who - Forcing WHO update")
+@job_queue.task("force-update")
+def force_update_job(source):
     try:
-        res = external_sources_manager.external_search_force_reindex("WHO")
+        with metrics.timer("external_sources_manager.external_search_force_reindex", source=source):
+            res = external_sources_manager.external_search_force_reindex(source)
     except Exception as e:
-        logging.error(f"Error in route: /external-sources/force-update-who - {str(e)}")
-        res = "Sorry, something went wrong in our WHO update. Contact the admin for more information."
+        logging.error(f"Error in route: /external-sources/force-update-{source.lower()} - {str(e)}")
+        res = f"Sorry, something went wrong in our {source} update. Contact the admin for more information."
     code = 200 if res == INDEXING_SUCCESSFUL else 500
-    return json_return(code, res)
+    return code, res
+
+
+# Force updates
+@app.route("/external-sources/force-update-who", methods=["GET"])
+def force_update_who():
+    logging.debug("route: /external-sources/force-update-who - Forcing WHO update")
+    if async_requested():
+        return enqueue_job("force-update", source="WHO")
+    return json_return(*force_update_job("WHO"))
 
 
 # Force updates
 @app.route("/external-sources/force-update-kaggle", methods=["GET"])
 def force_update_kaggle():
     logging.debug("route: /external-sources/force-update-kaggle - Forcing kaggle update")
-    try:
-        res = external_sources_manager.external_search_force_reindex("Kaggle")
-    except Exception as e:
-        logging.error(f"Error in route: /external-sources/force-update-kaggle - {str(e)}")
-        res = "Sorry, something went wrong in our kaggle update. Contact the admin for more information."
-    code = 200 if res == INDEXING_SUCCESSFUL else 500
-    return json_return(code, res)
+    if async_requested():
+        return enqueue_job("force-update", source="Kaggle")
+    return json_return(*force_update_job("Kaggle"))
 
 
 # Force updates
 @app.route("/external-sources/force-update-wb", methods=["GET"])
 def force_update_wb():
     logging.debug("route: /external-sources/force-update-wb - Forcing wb update")
-    try:
-        res = external_sources_manager.external_search_force_reindex("WB")
-    except Exception as e:
-        logging.error(f"Error in route: /external-sources/force-update-wb - {str(e)}")
-        res = "Sorry, something went wrong in our wb update. Contact the admin for more information."
-    code = 200 if res == INDEXING_SUCCESSFUL else 500
-    return json_return(code, res)
+    if async_requested():
+        return enqueue_job("force-update", source="WB")
+    return json_return(*force_update_job("WB"))
 
 
 # Force updates
 @app.route("/external-sources/force-update-hdx", methods=["GET"])
 def force_update_hdx():
     logging.debug("route: /external-sources/force-update-hdx - Forcing hdx update")
-    try:
-        res = external_sources_manager.external_search_force_reindex("HDX")
-    except Exception as e:
-        logging.error(f"Error in route: /external-sources/force-update-hdx - {str(e)}")
-        res = "Sorry, something went wrong in our hdx update. Contact the admin for more information."
-    code = 200 if res == INDEXING_SUCCESSFUL else 500
-    return json_return(code, res)
+    if async_requested():
+        return enqueue_job("force-update", source="HDX")
+    return json_return(*force_update_job("HDX"))
 
 
 # Force updates tgf
@@ -490,39 +812,27 @@ def force_update_hdx():
 def force_update_tgf():
     logging.debug("route: /external-sources/force-update-tgf - Forcing tgf update")
     logging.debug("route: /external-sources/force-update-tgf - DEBUG TEST")
-    try:
-        res = external_sources_manager.external_search_force_reindex("TGF")
-    except Exception as e:
-        logging.error(f"Error in route: /external-sources/force-update-tgf - {str(e)}")
-        res = "Sorry, something went wrong in our tgf update. Contact the admin for more information."
-    code = 200 if res == INDEXING_SUCCESSFUL else 500
-    return json_return(code, res)
+    if async_requested():
+        return enqueue_job("force-update", source="TGF")
+    return json_return(*force_update_job("TGF"))
 
 
 # Force updates oecd
 @app.route("/external-sources/force-update-oecd", methods=["GET"])
 def force_update_oecd():
     logging.debug("route: /external-sources/force-update-oecd - Forcing oecd update")
-    try:
-        res = external_sources_manager.external_search_force_reindex("OECD")
-    except Exception as e:
-        logging.error(f"Error in route: /external-sources/force-update-oecd - {str(e)}")
-        res = "Sorry, something went wrong in our oecd update. Contact the admin for more information."
-    code = 200 if res == INDEXING_SUCCESSFUL else 500
-    return json_return(code, res)
+    if async_requested():
+        return enqueue_job("force-update", source="OECD")
+    return json_return(*force_update_job("OECD"))
 
 
 # Force updates dw
 @app.route("/external-sources/force-update-dw", methods=["GET"])
 def force_update_dw():
     logging.debug("route: /external-sources/force-update-dw - Forcing dw update")
-    try:
-        res = external_sources_manager.external_search_force_reindex("DW")
-    except Exception as e:
-        logging.error(f"Error in route: /external-sources/force-update-dw - {str(e)}")
-        res = "Sorry, something went wrong in our dw update. Contact the admin for more information."
-    code = 200 if res == INDEXING_SUCCESSFUL else 500
-    return json_return(code, res)
+    if async_requested():
+        return enqueue_job("force-update", source="DW")
+    return json_return(*force_update_job("DW"))
 
 
 if __name__ == "__main__":
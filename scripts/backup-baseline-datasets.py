@@ -69,8 +69,16 @@ def backup():
                 f"./staging/prepopulate-data/sample-data-files/{dataset['_id']}.json"
             )
             # duplicate the parsed files if they exist
+            # copy2 keeps the modification time, which the columnar copy is checked against
             if os.path.exists(parsed_df):
-                shutil.copy(parsed_df, new_parsed_df)
+                shutil.copy2(parsed_df, new_parsed_df)
+            for ext in ["parquet", "meta.json"]:
+                columnar_df = f"{DF_LOC}parsed-data-files/{dataset['_id']}.{ext}"
+                if os.path.exists(columnar_df):
+                    shutil.copy2(
+                        columnar_df,
+                        f"./staging/prepopulate-data/parsed-data-files/{dataset['_id']}.{ext}",
+                    )
             if os.path.exists(sample_df):
                 shutil.copy(sample_df, new_sample_df)
     except Exception as e:
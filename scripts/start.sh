@@ -10,13 +10,18 @@ fi
 MODE="$1"
 
 # Check the value of the provided argument and run the appropriate command
+# Each mode also starts the job workers, which run the long-running routes called with ?async=true
 if [ "$MODE" = "dev" ]; then
+  flask --app app worker &
   flask run --port 4004
 elif [ "$MODE" = "prod" ]; then
+  nohup flask --app app worker >> ./logging/worker.txt 2>&1 &
   gunicorn -w 8 app:app -b 0.0.0.0:4004 --daemon --access-logfile ./logging/access.txt --error-logfile ./logging/error.txt --timeout 600
 elif [ "$MODE" = "staging" ]; then
+  nohup flask --app app worker >> ./logging/worker.txt 2>&1 &
   gunicorn -w 8 app:app -b 0.0.0.0:4004 --daemon --access-logfile ./logging/access.txt --error-logfile ./logging/error.txt --timeout 600
 elif [ "$MODE" = "test" ]; then
+  nohup flask --app app worker >> ./logging/worker.txt 2>&1 &
   gunicorn -w 8 app:app -b 0.0.0.0:4004 --daemon --access-logfile ./logging/access.txt --error-logfile ./logging/error.txt --timeout 600
 else
   echo "Invalid mode. Use 'dev', 'test', 'staging' or 'prod'."
@@ -0,0 +1,279 @@
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+CACHE_DB = "./staging/cache.sqlite3"
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+# The number of seconds hit and miss counters and access times are kept in memory before they are written.
+CACHE_FLUSH_INTERVAL = 10
+# The size of the values kept decoded in each process, so repeated hits skip reading and decoding them.
+CACHE_LOCAL_MAX_BYTES = 32 * 1024 * 1024
+
+
+class DXDatasetCache:
+    """
+    A size bounded cache shared by all server workers, backed by a local SQLite file.
+    Every entry has a tag, the dataset id, so all entries of a dataset can be invalidated at once,
+    and a version, the modification time of the file it was read from, so rewritten files are never served stale.
+    When the total size exceeds max_bytes, the least recently used entries are evicted.
+    Hits and misses are counted in the same file, so the counters cover every worker.
+    Reads never take the write lock: the counters and access times of hits are kept in memory and written
+    every flush_interval seconds, or before an eviction, and an access time is only written when it is older than that.
+    Recently read values are also kept decoded in each process, up to local_max_bytes, cached values are read only.
+    """
+
+    def __init__(
+        self,
+        location: str = None,
+        max_bytes: int = None,
+        flush_interval: float = None,
+        local_max_bytes: int = None,
+    ) -> None:
+        self.location = location or os.getenv("CACHE_DB", CACHE_DB)
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv("CACHE_MAX_BYTES", CACHE_MAX_BYTES))
+        if flush_interval is None:
+            flush_interval = float(os.getenv("CACHE_FLUSH_INTERVAL", CACHE_FLUSH_INTERVAL))
+        self.flush_interval = flush_interval
+        if local_max_bytes is None:
+            local_max_bytes = int(os.getenv("CACHE_LOCAL_MAX_BYTES", CACHE_LOCAL_MAX_BYTES))
+        self.local_max_bytes = local_max_bytes
+        self._lock = threading.Lock()
+        self._pending = {"hits": 0, "misses": 0}
+        self._accessed = {}
+        self._last_flush = time.monotonic()
+        # Decoded values by key, as (version, value, size) tuples, least recently used first.
+        self._local = OrderedDict()
+        self._local_bytes = 0
+        self._pid = os.getpid()
+        if not self.enabled:
+            return
+        atexit.register(self.flush)
+        os.makedirs(os.path.dirname(os.path.abspath(self.location)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    tag TEXT NOT NULL,
+                    version REAL NOT NULL,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_tag ON entries (tag)")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute(
+                "INSERT OR IGNORE INTO stats (name, value) VALUES ('hits', 0), ('misses', 0), ('evictions', 0)"
+            )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.location, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str, version: float):
+        """
+        Get a cached value, counting the hit or miss.
+
+        :param key: The cache key.
+        :param version: The version the entry must have, the modification time of the source file.
+        :return: The cached value, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        try:
+            value = None
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT last_access FROM entries WHERE key = ? AND version = ?", (key, version)
+                ).fetchone()
+                if row is not None:
+                    value = self._local_get(key, version)
+                    if value is None:
+                        serialized = conn.execute(
+                            "SELECT value FROM entries WHERE key = ? AND version = ?", (key, version)
+                        ).fetchone()
+                        if serialized is not None:
+                            value = json.loads(serialized[0])
+                            self._local_set(key, version, value, len(serialized[0]))
+            self._count(key, row[0] if value is not None else None)
+            return value
+        except Exception as e:
+            logger.error(f"Cache:: Error reading {key}: {str(e)}")
+            return None
+
+    def _count(self, key, last_access):
+        with self._lock:
+            self._check_fork()
+            now = time.time()
+            if last_access is None:
+                self._pending["misses"] += 1
+            else:
+                self._pending["hits"] += 1
+                # Access times only order the evictions, so they are not rewritten more often than they are flushed.
+                if now - last_access > self.flush_interval:
+                    self._accessed[key] = now
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def _check_fork(self):
+        # A forked process starts from zero, its parent writes what it counted itself.
+        if self._pid != os.getpid():
+            self._pending, self._accessed = {"hits": 0, "misses": 0}, {}
+            self._local, self._local_bytes = OrderedDict(), 0
+            self._pid = os.getpid()
+
+    def _take_pending(self):
+        with self._lock:
+            self._check_fork()
+            pending, accessed = self._pending, self._accessed
+            self._pending, self._accessed = {"hits": 0, "misses": 0}, {}
+            self._last_flush = time.monotonic()
+        return pending, accessed
+
+    def _write_pending(self, conn, pending, accessed):
+        conn.executemany(
+            "UPDATE stats SET value = value + ? WHERE name = ?",
+            [(count, name) for name, count in pending.items() if count > 0],
+        )
+        conn.executemany(
+            "UPDATE entries SET last_access = MAX(last_access, ?) WHERE key = ?",
+            [(last_access, key) for key, last_access in accessed.items()],
+        )
+
+    def flush(self):
+        """
+        Write the hit and miss counters and access times kept in memory.
+        """
+        if not self.enabled:
+            return
+        pending, accessed = self._take_pending()
+        if not any(pending.values()) and not accessed:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self._write_pending(conn, pending, accessed)
+                conn.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"Cache:: Error writing the cache statistics: {str(e)}")
+
+    def _local_get(self, key, version):
+        with self._lock:
+            self._check_fork()
+            entry = self._local.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self._local.move_to_end(key)
+            return entry[1]
+
+    def _local_set(self, key, version, value, size):
+        if size > self.local_max_bytes:
+            return
+        with self._lock:
+            self._check_fork()
+            previous = self._local.pop(key, None)
+            if previous is not None:
+                self._local_bytes -= previous[2]
+            self._local[key] = (version, value, size)
+            self._local_bytes += size
+            while self._local_bytes > self.local_max_bytes:
+                _, (_, _, evicted_size) = self._local.popitem(last=False)
+                self._local_bytes -= evicted_size
+
+    def set(self, key: str, tag: str, version: float, value):
+        """
+        Cache a JSON serialisable value, evicting the least recently used entries beyond max_bytes.
+        Entries of an older version are replaced when their key is written, or evicted as they are no longer read.
+
+        :param key: The cache key.
+        :param tag: The tag used for invalidation, the dataset id.
+        :param version: The modification time of the source file.
+        :param value: The value to cache.
+        """
+        if not self.enabled:
+            return
+        try:
+            serialized = json.dumps(value)
+            size = len(serialized)
+            if size > self.max_bytes:
+                return
+            pending, accessed = self._take_pending()
+            with self._connect() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                # Evictions go by the access times, so the ones kept in memory are written first.
+                self._write_pending(conn, pending, accessed)
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, tag, version, value, size, last_access) VALUES (?, ?, ?, ?, ?, ?)",  # NOQA: E501
+                    (key, tag, version, serialized, size, time.time()),
+                )
+                self._evict(conn)
+                conn.execute("COMMIT")
+            self._local_set(key, version, value, size)
+        except Exception as e:
+            logger.error(f"Cache:: Error writing {key}: {str(e)}")
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = 0
+        for key, size in conn.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        conn.execute("UPDATE stats SET value = value + ? WHERE name = 'evictions'", (evicted,))
+
+    def invalidate(self, tag: str):
+        """
+        Remove all cached entries of a dataset.
+
+        :param tag: The dataset id.
+        """
+        if not self.enabled:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM entries WHERE tag = ?", (tag,))
+        except Exception as e:
+            logger.error(f"Cache:: Error invalidating {tag}: {str(e)}")
+
+    def stats(self) -> dict:
+        """
+        Get the hit, miss and eviction counters, and the current number and size of the entries.
+        The counters of the other workers lag by up to flush_interval seconds.
+
+        :return: A dictionary with the cache statistics.
+        """
+        if not self.enabled:
+            return {"enabled": False}
+        self.flush()
+        with self._connect() as conn:
+            res = {name: value for name, value in conn.execute("SELECT name, value FROM stats")}
+            res["entries"], res["bytes"] = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        res["enabled"] = True
+        res["maxBytes"] = self.max_bytes
+        return res
@@ -0,0 +1,182 @@
+import gzip
+import logging
+import os
+import zlib
+from datetime import datetime, timezone
+
+from flask import Response, request
+from werkzeug.http import http_date, is_resource_modified
+
+# Brotli and zstd are in the requirements, without them installed responses are only gzip encoded.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+# Responses smaller than this are not worth compressing.
+COMPRESSION_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# Precompressed variants are written once, so they use higher levels.
+PRECOMPRESSED_LEVELS = {"br": 9, "zstd": 12, "gzip": 9}
+ENCODING_EXTENSIONS = {"br": "br", "zstd": "zst", "gzip": "gz"}
+
+
+def available_encodings() -> list:
+    """
+    Get the supported content encodings, in order of preference.
+    """
+    encodings = []
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    encodings.append("gzip")
+    return encodings
+
+
+def negotiate_encoding():
+    """
+    Pick the preferred encoding the client accepts.
+
+    :return: The encoding, or None if the response should not be encoded.
+    """
+    if os.getenv("RESPONSE_COMPRESSION", "true").lower() != "true":
+        return None
+    for encoding in available_encodings():
+        if request.accept_encodings[encoding] > 0:
+            return encoding
+    return None
+
+
+def compress(data: bytes, encoding: str, level: int = None) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=level if level is not None else 5)
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=level if level is not None else 3).compress(data)
+    return gzip.compress(data, compresslevel=level if level is not None else GZIP_LEVEL)
+
+
+def _compressor(encoding, level=None):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=level if level is not None else 5)
+        return compressor.process, compressor.finish
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+        return compressor.compress, compressor.flush
+    compressor = zlib.compressobj(level if level is not None else GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress, compressor.flush
+
+
+def _compress_stream(chunks, encoding):
+    process, finish = _compressor(encoding)
+    try:
+        for chunk in chunks:
+            data = process(chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def file_validators(path: str, *variant):
+    """
+    Build the validators of a response served from a file, from its modification time and size.
+
+    :param path: The file the response is built from.
+    :param variant: Any request arguments the response depends on, such as the page.
+    :return: A tuple of the ETag and the modification time.
+    """
+    stat = os.stat(path)
+    etag = "-".join([f"{stat.st_mtime_ns:x}", f"{stat.st_size:x}"] + [str(v) for v in variant])
+    return etag, datetime.fromtimestamp(int(stat.st_mtime), tz=timezone.utc)
+
+
+def not_modified(etag: str, last_modified: datetime):
+    """
+    Get a 304 response when the client already has this version, checked before any data is loaded.
+
+    :return: The 304 response, or None if the response has to be built.
+    """
+    encoding = negotiate_encoding()
+    # The client may hold the encoded representation, which has its own ETag.
+    for tag in [f"{etag}-{encoding}", etag] if encoding else [etag]:
+        if not is_resource_modified(request.environ, etag=tag, last_modified=last_modified):
+            return _set_validators(Response(status=304), tag, last_modified)
+    return None
+
+
+def _set_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.headers["Last-Modified"] = http_date(last_modified)
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def conditional_response(response, etag: str, last_modified: datetime, encoding: str = None):
+    """
+    Add the validators to a response, and encode its body when the client accepts it.
+    Streamed responses are encoded chunk by chunk.
+
+    :param response: The flask response.
+    :param etag: The ETag, from file_validators.
+    :param last_modified: The modification time, from file_validators.
+    :param encoding: The encoding to use, defaults to the negotiated one.
+    :return: The response.
+    """
+    _set_validators(response, etag, last_modified)
+    if "Content-Encoding" in response.headers:
+        # Served from a precompressed variant.
+        response.set_etag(f"{etag}-{response.headers['Content-Encoding']}")
+        return response
+    encoding = encoding or negotiate_encoding()
+    if encoding is None or response.status_code != 200:
+        return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    # The encoded body is a different representation, so it gets its own ETag.
+    response.set_etag(f"{etag}-{encoding}")
+    return response
+
+
+def precompressed_variant(path: str, encoding: str, create: bool = True):
+    """
+    Get the precompressed variant of a file, which is stored next to it and rewritten when the file changes.
+
+    :param path: The file path.
+    :param encoding: The content encoding.
+    :param create: Whether to write the variant when it does not exist or is outdated.
+    :return: The path of the variant, or None if it is not available.
+    """
+    variant = f"{path}.{ENCODING_EXTENSIONS[encoding]}"
+    try:
+        if os.path.exists(variant) and os.path.getmtime(variant) >= os.path.getmtime(path):
+            return variant
+        if not create:
+            return None
+        tmp = f"{variant}.{os.getpid()}.tmp"
+        process, finish = _compressor(encoding, PRECOMPRESSED_LEVELS[encoding])
+        with open(path, "rb") as fsrc, open(tmp, "wb") as fdst:
+            for chunk in iter(lambda: fsrc.read(1024 * 1024), b""):
+                fdst.write(process(chunk))
+            fdst.write(finish())
+        os.replace(tmp, variant)
+        return variant
+    except Exception as e:
+        logger.error(f"Error writing the {encoding} variant of {path}: {str(e)}")
+        if os.path.exists(f"{variant}.{os.getpid()}.tmp"):
+            os.remove(f"{variant}.{os.getpid()}.tmp")
+        return None
@@ -0,0 +1,606 @@
+import bisect
+import fcntl
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from rb_core_backend.data_management import RBCoreDataManagement
+
+from services.cache import DXDatasetCache
+from services.compression import ENCODING_EXTENSIONS
+from services.size_ledger import DXDatasetSizeLedger
+
+logger = logging.getLogger(__name__)
+PARSED_DATA_FOLDER = "parsed-data-files"
+SAMPLE_DATA_FOLDER = "sample-data-files"
+# The key of the parsed data document holding the rows, the other keys are stored as metadata.
+PARSED_ROWS_KEY = "dataset"
+PARSED_DATA_ROW_GROUP_SIZE = 5000
+# The types of the parsed row values stored in the columnar copy, other values keep a dataset in JSON.
+ARROW_TYPES = {
+    type(None): pa.null(),
+    bool: pa.bool_(),
+    int: pa.int64(),
+    float: pa.float64(),
+    str: pa.string(),
+}
+DUPLICATE_WORKERS = 8
+# Deleted datasets have a marker file in this folder until their files are reclaimed.
+TOMBSTONE_FOLDER = "tombstones"
+RECLAIM_WORKERS = 8
+RECLAIM_BATCH_SIZE = 100
+# The Linux ioctl cloning a file with a reflink, supported by btrfs, xfs and others.
+FICLONE = 0x40049409
+
+
+def dataset_id(ds_name: str) -> str:
+    """
+    Normalise a dataset name as received by the routes to the id used for the parsed data files.
+    Strips any folder and extension, and the dx or ds prefix.
+
+    :param ds_name: The dataset name, for example dx64f9e7c41ecd970069309b0a or 64f9e7c41ecd970069309b0a.csv
+    :return: The dataset id.
+    """
+    ds_id = os.path.splitext(os.path.basename(ds_name))[0]
+    if ds_id.startswith("dx") or ds_id.startswith("ds"):
+        ds_id = ds_id[2:]
+    return ds_id
+
+
+def write_frames_parquet(frames, path: str, drop_empty_columns: bool = False) -> int:
+    """
+    Write DataFrames to a parquet file as one table, with their rows in order.
+    Every DataFrame is converted to an Arrow table as it arrives, so frames can be generated and released one at a time.
+    The tables store their strings contiguously and keep categorical columns dictionary encoded until they are written.
+    The column types are unified across the frames: an integer column with missing values in one frame is written
+    as a float column, a column mixing numbers and text as a text column, and categorical columns as plain text.
+
+    :param frames: A DataFrame, or an iterable of DataFrames.
+    :param path: The path of the parquet file.
+    :param drop_empty_columns: Whether columns without any value in any frame are left out.
+    :return: The number of rows written, no file is written when there are none.
+    """
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+    tables = [_frame_to_table(df) for df in frames]
+    n_rows = sum(table.num_rows for table in tables)
+    if n_rows == 0:
+        return 0
+    fields = []
+    for name in dict.fromkeys(name for table in tables for name in table.column_names):
+        columns = [table.column(name) for table in tables if name in table.column_names]
+        if drop_empty_columns and all(column.null_count == len(column) for column in columns):
+            continue
+        types = [column.type.value_type if pa.types.is_dictionary(column.type) else column.type for column in columns]
+        try:
+            schema = pa.unify_schemas([pa.schema([(name, t)]) for t in types], promote_options="permissive")
+            fields.append(schema.field(name))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            fields.append(pa.field(name, pa.string()))
+    schema = pa.schema(fields)
+    with pq.ParquetWriter(path, schema) as writer:
+        while tables:
+            table = tables.pop(0)
+            columns = [
+                table.column(field.name).cast(field.type)
+                if field.name in table.column_names
+                else pa.nulls(table.num_rows, field.type)
+                for field in schema
+            ]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+    return n_rows
+
+
+def _frame_to_table(df):
+    df = df.reset_index(drop=True)
+    df.columns = [str(column) for column in df.columns]
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Object columns mixing text and numbers are stored as text, as they would be in a CSV file.
+        for column in df.columns:
+            if df[column].dtype == object:
+                df[column] = df[column].astype(str).where(df[column].notna(), None)
+        return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _rows_schema(rows):
+    """
+    Build the Arrow schema of parsed rows, with a column for every key of any row, in the order they first appear.
+    Every column keeps the type of its values, columns mixing types, such as integers and floats, cannot be stored.
+
+    :param rows: The parsed rows.
+    :return: The schema, or a string with the reason the rows are kept in JSON.
+    """
+    if not all(isinstance(row, dict) for row in rows):
+        return "The parsed data rows are not all objects, they are kept in JSON."
+    value_types = {}
+    for row in rows:
+        for key, value in row.items():
+            types = value_types.setdefault(key, set())
+            if value is not None:
+                types.add(type(value))
+    fields = []
+    for key, types in value_types.items():
+        if len(types) > 1:
+            return f"The parsed data column {key} mixes value types, which are kept in JSON."
+        value_type = next(iter(types), type(None))
+        if value_type not in ARROW_TYPES:
+            return "The parsed data contains nested values, which are kept in JSON."
+        fields.append(pa.field(str(key), ARROW_TYPES[value_type]))
+    return pa.schema(fields)
+
+
+def clone_file(src: str, dst: str, hardlink: bool = False) -> str:
+    """
+    Duplicate a file without copying its data where possible.
+    A reflink shares the data blocks copy-on-write, and is tried first.
+    A hardlink shares the file itself, so it is only used when allowed, as a file rewritten in place changes both.
+    Otherwise the file is copied. The destination is replaced atomically.
+
+    :param src: The source path.
+    :param dst: The destination path.
+    :param hardlink: Whether a hardlink may be used when a reflink is not supported.
+    :return: The method used, "reflink", "hardlink" or "copy".
+    """
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    method = None
+    try:
+        with open(src, "rb") as fsrc, open(tmp, "wb") as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                method = "reflink"
+            except OSError:
+                pass
+        if method is None and hardlink:
+            try:
+                os.remove(tmp)
+                os.link(src, tmp)
+                method = "hardlink"
+            except OSError:
+                pass
+        if method is None:
+            shutil.copyfile(src, tmp)
+            method = "copy"
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return method
+
+
+class DXRBCoreDataManagement(RBCoreDataManagement):
+    """
+    RBCoreDataManagement extended with a columnar copy of the parsed data files.
+    A migrated dataset has a parquet file with the rows, written in fixed-size row groups,
+    next to a small metadata file with the remaining keys of the parsed document and the row offset of every row group.
+    Page reads then only decode the row groups they need, datasets without an up-to-date copy are read from JSON.
+
+    Loaded samples and pages are kept in the shared dataset cache, keyed by the modification time of their file.
+    Dataset sizes are kept in the size ledger when one is given, and updated whenever a dataset's files change.
+    """
+
+    def __init__(self, location: str, cache: DXDatasetCache = None, size_ledger: DXDatasetSizeLedger = None) -> None:
+        super().__init__(location=location)
+        self.dx_location = location or "./"
+        self.cache = cache or DXDatasetCache(max_bytes=0)
+        self.size_ledger = size_ledger
+
+    def _parsed_path(self, ds_id, extension="json"):
+        return f"{self.dx_location}{PARSED_DATA_FOLDER}/{ds_id}.{extension}"
+
+    def _sample_path(self, ds_id):
+        return f"{self.dx_location}{SAMPLE_DATA_FOLDER}/{ds_id}.json"
+
+    def _tombstone_path(self, ds_id):
+        return f"{self.dx_location}{TOMBSTONE_FOLDER}/{ds_id}"
+
+    def is_deleted(self, ds_name: str) -> bool:
+        """
+        Check whether a dataset was deleted, its files may not be reclaimed yet.
+
+        :param ds_name: The dataset name or id.
+        :return: True if the dataset has a tombstone.
+        """
+        return os.path.exists(self._tombstone_path(dataset_id(ds_name)))
+
+    def tombstone(self, ds_names: list) -> list:
+        """
+        Mark datasets as deleted, so reads fail straight away, and leave removing their files to reclaim_datasets.
+        The tombstones are files, so they survive a restart until the files are reclaimed.
+
+        :param ds_names: The dataset names or ids.
+        :return: The list of dataset ids that were marked.
+        """
+        os.makedirs(f"{self.dx_location}{TOMBSTONE_FOLDER}", exist_ok=True)
+        ds_ids = []
+        for ds_name in ds_names:
+            ds_id = dataset_id(ds_name)
+            with open(self._tombstone_path(ds_id), "w") as f:
+                f.write(datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            self.invalidate(ds_id)
+            self.record_size(ds_id)
+            ds_ids.append(ds_id)
+        return ds_ids
+
+    def tombstoned_datasets(self) -> list:
+        """
+        Get the ids of the datasets which were deleted, but whose files were not reclaimed yet.
+        """
+        folder = f"{self.dx_location}{TOMBSTONE_FOLDER}"
+        if not os.path.isdir(folder):
+            return []
+        return sorted(f for f in os.listdir(folder) if not f.startswith("."))
+
+    def reclaim_datasets(self, ds_ids: list, workers: int = None, progress=None) -> dict:
+        """
+        Remove the files of deleted datasets in parallel batches, and then their tombstones.
+        Datasets whose tombstone was removed in the meantime are skipped.
+
+        :param ds_ids: The dataset ids to reclaim.
+        :param workers: The number of threads, defaults to RECLAIM_WORKERS.
+        :param progress: An optional function called with the counters after every batch.
+        :return: A dictionary with the number of reclaimed datasets, the reclaimed bytes and the failed dataset ids.
+        """
+        if workers is None:
+            workers = int(os.getenv("RECLAIM_WORKERS", RECLAIM_WORKERS))
+        res = {"reclaimed": 0, "bytes": 0, "failed": []}
+
+        def _reclaim(ds_id):
+            if not os.path.exists(self._tombstone_path(ds_id)):
+                return 0
+            paths = [self._parsed_path(ds_id), self._sample_path(ds_id)] + self.derived_files(ds_id)
+            size = sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+            if self.remove_parsed_files(ds_id) != "Success" and os.path.exists(self._parsed_path(ds_id)):
+                raise OSError(f"The files of {ds_id} could not be removed")
+            os.remove(self._tombstone_path(ds_id))
+            return size
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for start in range(0, len(ds_ids), RECLAIM_BATCH_SIZE):
+                batch = ds_ids[start:start + RECLAIM_BATCH_SIZE]
+                for ds_id, future in zip(batch, [executor.submit(_reclaim, ds_id) for ds_id in batch]):
+                    try:
+                        res["bytes"] += future.result()
+                        res["reclaimed"] += 1
+                    except Exception as e:
+                        logger.error(f"Error reclaiming {ds_id}: {str(e)}")
+                        res["failed"].append(ds_id)
+                if progress is not None:
+                    progress(reclaimed=res["reclaimed"], bytes=res["bytes"], failed=len(res["failed"]))
+        logger.info(f"Reclaimed {res['reclaimed']} datasets, {res['bytes']} bytes, {len(res['failed'])} failed")
+        return res
+
+    def _disk_size(self, ds_id):
+        paths = [self._parsed_path(ds_id), self._sample_path(ds_id)]
+        return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+    def record_size(self, ds_name: str):
+        """
+        Update the size ledger entry of a dataset from its files on disk.
+
+        :param ds_name: The dataset name or id.
+        """
+        if self.size_ledger is None:
+            return
+        ds_id = dataset_id(ds_name)
+        try:
+            if os.path.isfile(self._parsed_path(ds_id)) and not self.is_deleted(ds_id):
+                self.size_ledger.record(ds_id, self._disk_size(ds_id))
+            else:
+                self.size_ledger.remove(ds_id)
+        except Exception as e:
+            logger.error(f"Error recording the size of {ds_id}: {str(e)}")
+
+    def get_dataset_size(self, dataset_ids: list):
+        """
+        Get the total size of the parsed and sample files of a list of datasets in MB, from the size ledger.
+        Datasets that are not in the ledger yet are measured on disk once and recorded, deleted datasets count as 0.
+
+        :param dataset_ids: The dataset ids.
+        :return: The total size in MB.
+        """
+        if self.size_ledger is None:
+            return super().get_dataset_size(dataset_ids=dataset_ids)
+        ds_ids = [dataset_id(ds_name) for ds_name in dataset_ids]
+        sizes = self.size_ledger.lookup(ds_ids)
+        for ds_id in set(ds_ids) - set(sizes):
+            if self.is_deleted(ds_id) or not os.path.isfile(self._parsed_path(ds_id)):
+                continue
+            sizes[ds_id] = self._disk_size(ds_id)
+            self.size_ledger.record(ds_id, sizes[ds_id])
+        return sum(sizes.get(ds_id, 0) for ds_id in ds_ids) / (1024 * 1024)
+
+    def reconcile_sizes(self) -> int:
+        """
+        Rebuild the size ledger from the parsed and sample files on disk.
+
+        :return: The number of datasets in the ledger.
+        """
+        sizes = {ds_id: self._disk_size(ds_id) for ds_id in self.parsed_datasets() if not self.is_deleted(ds_id)}
+        self.size_ledger.rebuild(sizes)
+        return len(sizes)
+
+    def invalidate(self, ds_name: str):
+        """
+        Remove the cached samples and pages of a dataset, called when its files are created, replaced or removed.
+
+        :param ds_name: The dataset name or id.
+        """
+        self.cache.invalidate(dataset_id(ds_name))
+
+    def _cached(self, key, ds_id, path, load):
+        """
+        Get a value from the cache, or load and cache it. Error strings are not cached.
+        """
+        try:
+            version = os.path.getmtime(path)
+        except OSError:
+            return load()
+        res = self.cache.get(key, version)
+        if res is None:
+            res = load()
+            if not isinstance(res, str):
+                self.cache.set(key, ds_id, version, res)
+        return res
+
+    def parsed_datasets(self) -> list:
+        """
+        Get the ids of all datasets with a parsed JSON file.
+        """
+        folder = f"{self.dx_location}{PARSED_DATA_FOLDER}"
+        return sorted(
+            f[: -len(".json")] for f in os.listdir(folder) if f.endswith(".json") and not f.endswith(".meta.json")
+        )
+
+    def parsed_file(self, ds_name: str):
+        """
+        Get the path of the parsed JSON file of a dataset.
+
+        :param ds_name: The dataset name or id.
+        :return: The path, or None if the dataset has no parsed file.
+        """
+        path = self._parsed_path(dataset_id(ds_name))
+        return path if os.path.isfile(path) else None
+
+    def sample_file(self, ds_name: str):
+        """
+        Get the path of the sample JSON file of a dataset.
+
+        :param ds_name: The dataset name or id.
+        :return: The path, or None if the dataset has no sample file.
+        """
+        path = self._sample_path(dataset_id(ds_name))
+        return path if os.path.isfile(path) else None
+
+    def _columnar_meta(self, ds_id):
+        """
+        Get the metadata of the columnar copy of a dataset, if it exists and is not older than the JSON file.
+
+        :param ds_id: The dataset id.
+        :return: The metadata dictionary, or None if the dataset should be read from JSON.
+        """
+        meta_path = self._parsed_path(ds_id, "meta.json")
+        if not os.path.exists(meta_path) or not os.path.exists(self._parsed_path(ds_id, "parquet")):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        json_path = self._parsed_path(ds_id)
+        if not os.path.exists(json_path) or os.path.getmtime(json_path) > meta.get("sourceMtime", 0):
+            # The JSON file is the source of truth, when it was removed or rewritten the columnar copy is stale.
+            return None
+        return meta
+
+    def derived_files(self, ds_name: str) -> list:
+        """
+        Get the paths of the files derived from the parsed file of a dataset:
+        the columnar copy and the precompressed variants.
+
+        :param ds_name: The dataset name or id.
+        :return: A list of file paths, which may not exist.
+        """
+        parsed_path = self._parsed_path(dataset_id(ds_name))
+        return self.columnar_files(ds_name) + [f"{parsed_path}.{ext}" for ext in ENCODING_EXTENSIONS.values()]
+
+    def columnar_files(self, ds_name: str) -> list:
+        """
+        Get the paths of the columnar copy of a dataset.
+
+        :param ds_name: The dataset name or id.
+        :return: A list with the parquet and metadata file paths.
+        """
+        ds_id = dataset_id(ds_name)
+        return [self._parsed_path(ds_id, "parquet"), self._parsed_path(ds_id, "meta.json")]
+
+    def migrate_parsed_to_columnar(self, ds_name: str, row_group_size: int = None) -> str:
+        """
+        Write the columnar copy of a parsed dataset. The JSON file is kept as is.
+        The copy has a column for every key of any row, each with the type of its values,
+        and is only used once it reads back as the JSON rows.
+
+        :param ds_name: The dataset name or id.
+        :param row_group_size: The number of rows per row group, defaults to PARSED_DATA_ROW_GROUP_SIZE.
+        :return: A string indicating the result of the migration.
+        """
+        if row_group_size is None:
+            row_group_size = int(os.getenv("PARSED_DATA_ROW_GROUP_SIZE", PARSED_DATA_ROW_GROUP_SIZE))
+        ds_id = dataset_id(ds_name)
+        json_path = self._parsed_path(ds_id)
+        try:
+            source_mtime = os.path.getmtime(json_path)
+            with open(json_path) as f:
+                parsed = json.load(f)
+            if not isinstance(parsed, dict) or not isinstance(parsed.get(PARSED_ROWS_KEY), list):
+                return "The parsed data does not contain a list of rows."
+            rows = parsed.pop(PARSED_ROWS_KEY)
+            schema = _rows_schema(rows)
+            if isinstance(schema, str):
+                return schema
+            table = pa.Table.from_pylist(rows, schema=schema)
+            parquet_path, meta_path = self.columnar_files(ds_id)
+            # Temporary files are per process, so concurrent migrations of the same dataset do not collide.
+            tmp = f".{os.getpid()}.tmp"
+            pq.write_table(table, f"{parquet_path}{tmp}", row_group_size=row_group_size)
+            del table
+            parquet_file = pq.ParquetFile(f"{parquet_path}{tmp}")
+            offsets = [0]
+            for i in range(parquet_file.num_row_groups):
+                rows_read = parquet_file.read_row_group(i).to_pylist()
+                end = offsets[-1] + len(rows_read)
+                # The copy is only used when it reads back as the JSON rows, with the same keys, values and types.
+                if json.dumps(rows_read, sort_keys=True) != json.dumps(rows[offsets[-1]:end], sort_keys=True):
+                    return "The columnar copy does not match the parsed data, which is kept in JSON."
+                offsets.append(end)
+            meta = {
+                "meta": parsed,
+                "numRows": len(rows),
+                "rowGroupOffsets": offsets[:-1],
+                "sourceMtime": source_mtime,
+            }
+            with open(f"{meta_path}{tmp}", "w") as f:
+                json.dump(meta, f)
+            # The metadata is replaced last, readers only use the parquet file once its metadata exists.
+            os.replace(f"{parquet_path}{tmp}", parquet_path)
+            os.replace(f"{meta_path}{tmp}", meta_path)
+        except Exception as e:
+            logger.error(f"Error in migrate_parsed_to_columnar for {ds_id}: {str(e)}")
+            return "Sorry, something went wrong in the columnar migration."
+        finally:
+            for path in self.columnar_files(ds_id):
+                if os.path.exists(f"{path}.{os.getpid()}.tmp"):
+                    os.remove(f"{path}.{os.getpid()}.tmp")
+        return "Success"
+
+    def load_sample_data(self, ds_name):
+        """
+        Load the sample data of a dataset, through the dataset cache.
+        """
+        ds_id = dataset_id(ds_name)
+        load = super().load_sample_data
+        return self._cached(f"sample:{ds_id}", ds_id, self._sample_path(ds_id), lambda: load(ds_name))
+
+    def load_parsed_data(self, ds_name, page, page_size):
+        """
+        Load a page of a parsed dataset through the dataset cache, from the columnar copy when available.
+        The result is the parsed document, with its rows limited to the requested page.
+        """
+        ds_id = dataset_id(ds_name)
+        return self._cached(
+            f"parsed:{ds_id}:{page}:{page_size}",
+            ds_id,
+            self._parsed_path(ds_id),
+            lambda: self._load_parsed_page(ds_name, page, page_size),
+        )
+
+    def _load_parsed_page(self, ds_name, page, page_size):
+        ds_id = dataset_id(ds_name)
+        try:
+            meta = self._columnar_meta(ds_id)
+        except Exception as e:
+            logger.error(f"Error reading the columnar metadata for {ds_id}: {str(e)}")
+            meta = None
+        if meta is None:
+            return super().load_parsed_data(ds_name, page, page_size)
+        start = max(page - 1, 0) * page_size
+        end = min(start + page_size, meta["numRows"])
+        res = dict(meta["meta"])
+        res[PARSED_ROWS_KEY] = self._read_rows(ds_id, meta["rowGroupOffsets"], start, end)
+        return res
+
+    def duplicate_parsed_files(self, ds_name, new_ds_name):
+        """
+        Duplicate the parsed and sample files, and the columnar copy when the dataset was migrated.
+        Files are cloned with a reflink where the filesystem supports it, so the data is not physically copied.
+        """
+        ds_id, new_ds_id = dataset_id(ds_name), dataset_id(new_ds_name)
+        if self.is_deleted(ds_id):
+            return "The dataset was deleted."
+        if not os.path.isfile(self._parsed_path(ds_id)):
+            # Leave missing datasets to the base implementation, so the error result stays the same.
+            return super().duplicate_parsed_files(ds_name, new_ds_name)
+        hardlink = os.getenv("DUPLICATE_HARDLINKS", "false").lower() == "true"
+        try:
+            clone_file(self._parsed_path(ds_id), self._parsed_path(new_ds_id), hardlink)
+            if os.path.isfile(self._sample_path(ds_id)):
+                clone_file(self._sample_path(ds_id), self._sample_path(new_ds_id), hardlink)
+        except Exception as e:
+            logger.error(f"Error in duplicate_parsed_files for {ds_id}: {str(e)}")
+            return "Sorry, something went wrong in our dataset duplication. Contact the admin for more information."
+        finally:
+            self.invalidate(new_ds_id)
+            self.record_size(new_ds_id)
+        if self._columnar_meta(ds_id) is not None:
+            try:
+                for src, dst in zip(self.columnar_files(ds_id), self.columnar_files(new_ds_id)):
+                    clone_file(src, dst, hardlink)
+                # Align the recorded source mtime with the duplicated JSON file, so the copy is not considered stale.
+                self._touch_columnar_meta(new_ds_id)
+            except Exception as e:
+                # The duplicate falls back to JSON, which is always available.
+                logger.error(f"Error duplicating the columnar copy of {ds_id}: {str(e)}")
+        return "Success"
+
+    def duplicate_datasets(self, datasets: list, workers: int = None) -> list:
+        """
+        Duplicate a list of datasets concurrently.
+
+        :param datasets: A list of dictionaries with the ds_name and new_ds_name of every dataset.
+        :param workers: The number of threads, defaults to DUPLICATE_WORKERS.
+        :return: A list with the ds_name, new_ds_name and result of every dataset, in the order of the request.
+        """
+        if workers is None:
+            workers = int(os.getenv("DUPLICATE_WORKERS", DUPLICATE_WORKERS))
+
+        def _duplicate(ds):
+            try:
+                res = self.duplicate_parsed_files(ds["ds_name"], ds["new_ds_name"])
+            except Exception as e:
+                logger.error(f"Error duplicating {ds.get('ds_name')}: {str(e)}")
+                res = "Sorry, something went wrong in our dataset duplication. Contact the admin for more information."
+            return {"ds_name": ds.get("ds_name"), "new_ds_name": ds.get("new_ds_name"), "result": res}
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            return list(executor.map(_duplicate, datasets))
+
+    def remove_parsed_files(self, ds_name):
+        """
+        Remove the parsed files, and the files derived from them.
+        """
+        for path in self.derived_files(ds_name):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except Exception as e:
+                logger.error(f"Error removing {path}: {str(e)}")
+        res = super().remove_parsed_files(ds_name)
+        self.invalidate(ds_name)
+        self.record_size(ds_name)
+        return res
+
+    def _touch_columnar_meta(self, ds_id):
+        meta_path = self._parsed_path(ds_id, "meta.json")
+        with open(meta_path) as f:
+            meta = json.load(f)
+        meta["sourceMtime"] = os.path.getmtime(self._parsed_path(ds_id))
+        # Replace rather than rewrite the file, it may be a hardlink to the metadata of the original dataset.
+        with open(f"{meta_path}.{os.getpid()}.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(f"{meta_path}.{os.getpid()}.tmp", meta_path)
+
+    def _read_rows(self, ds_id, offsets, start, end):
+        """
+        Read rows [start, end) from the columnar copy, decoding only the row groups that overlap the range.
+        """
+        if start >= end:
+            return []
+        first = bisect.bisect_right(offsets, start) - 1
+        last = bisect.bisect_right(offsets, end - 1) - 1
+        table = pq.ParquetFile(self._parsed_path(ds_id, "parquet")).read_row_groups(list(range(first, last + 1)))
+        return table.slice(start - offsets[first], end - start).to_pylist()
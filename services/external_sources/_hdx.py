@@ -3,21 +3,32 @@ import datetime
 import logging
 import os
 import re
+import shutil
+import time
 import zipfile
 
-import requests
 from hdx.api.configuration import Configuration
 from hdx.data.dataset import Dataset
 from rb_core_backend.external_sources.model import ExternalSourceModel
 from rb_core_backend.external_sources.util import EXTERNAL_DATASET_FORMAT, EXTERNAL_DATASET_RESOURCE_FORMAT
-from rb_core_backend.mongo import RBCoreBackendMongo
 from rb_core_backend.preprocess_dataset import RBCoreDatasetPreprocessor
 
+from services.external_sources.http_client import http_client
+from services.external_sources.util import ExternalSourceWriter, TTLCache, count_index, env_int
+from services.mongo import DXBackendMongo
+
 Configuration.create(hdx_site="prod", user_agent="Zimmerman_DX", hdx_read_only=True)
 
 logger = logging.getLogger(__name__)
 RE_SUB = r"[^a-zA-Z0-9]"
 HDX_SOURCE_NOTICE = "  - This Datasource was retrieved from https://data.humdata.org/."
+HDX_SEARCH_PAGE_SIZE = 1000
+HDX_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+HDX_DOWNLOAD_TIMEOUT = 60
+HDX_MAX_DOWNLOAD_SIZE = 500 * 1024 * 1024
+HDX_TOO_LARGE = "Sorry, the HDX file is too large to be processed, please try a different dataset."
+HDX_RESOURCE_CACHE_TTL = 3600
+HDX_RESOURCE_CACHE_SIZE = 1000
 
 
 class DXExternalSourceHDX(ExternalSourceModel):
@@ -25,17 +36,25 @@ class DXExternalSourceHDX(ExternalSourceModel):
 
     def __init__(
         self,
-        mongo_client: RBCoreBackendMongo,
+        mongo_client: DXBackendMongo,
         dataset_preprocessor: RBCoreDatasetPreprocessor,
     ) -> None:
         super().__init__(mongo_client, dataset_preprocessor)
+        # The CSV resources of datasets looked up on HDX, as (name, download url) tuples per dataset title.
+        self.resource_cache = TTLCache(
+            ttl=env_int("HDX_RESOURCE_CACHE_TTL", HDX_RESOURCE_CACHE_TTL),
+            max_size=HDX_RESOURCE_CACHE_SIZE,
+        )
 
-    def index(self, delete=False):
+    def index(self, delete=False, incremental=True):
         """
         Indexing function for HDX data.
         Using the HDX API, we search for datasets.
         Then check for updates, if the object is to be updated, pass that as a boolean.
+        When running incrementally, we only request datasets modified since the watermark of the last successful run.
 
+        :param delete: A boolean indicating if the HDX data should be removed before indexing, this forces a full crawl.
+        :param incremental: A boolean indicating if only datasets modified since the last successful run are requested.
         :return: A string indicating the result of the indexing.
         """
         if delete:
@@ -43,51 +62,108 @@ class DXExternalSourceHDX(ExternalSourceModel):
             self.mongo_client.mongo_remove_data_for_external_sources("HDX")
         logger.info("HDX:: Indexing HDX data...")
         # Get existing sources
-        existing_external_sources = self.mongo_client.mongo_get_all_external_sources()
-        existing_external_sources = {source["internalRef"]: source for source in existing_external_sources}
-        # Get all datasets and process
-        res = Dataset.search_in_hdx(fq="isopen:true")
+        existing_external_sources = self.mongo_client.mongo_get_external_source_refs("HDX")
+        # Get the datasets modified since the last successful run, or all datasets, and process
+        watermark = None
+        if incremental and not delete:
+            watermark = self.mongo_client.mongo_get_index_watermark("HDX")
+        if watermark is not None:
+            logger.info(f"HDX:: Requesting datasets modified since {watermark}")
         n_ds = 0
         n_success = 0
-        for dataset in res:
-            n_ds += 1
-            # We use the name as the internal ref, as the id might change.
-            internal_ref = dataset.get("name", "")
-            update = False
-            update_item = None
-            if internal_ref in existing_external_sources:
-                if existing_external_sources[internal_ref]["dateSourceLastUpdated"] == dataset.get("last_modified", ""):
-                    continue
-                else:
-                    update = True
-                    update_item = existing_external_sources[internal_ref]
-            try:
-                res = self._create_external_source_object(dataset, update, update_item)
-                if res == "Success":
-                    n_success += 1
-            except Exception as e:
-                logger.error(f"HDX:: Failed to index dataset {internal_ref} due to: {e}")
-        return f"HDX - Successfully indexed {n_success} out of {n_ds} datasets."
+        complete = True
+        with ExternalSourceWriter(self.mongo_client) as writer:
+            for page in self._search_datasets("isopen:true", since=watermark):
+                n_failed = writer.n_failed
+                page_complete = True
+                for dataset in page:
+                    n_ds += 1
+                    count_index(fetched=1)
+                    # We use the name as the internal ref, as the id might change.
+                    internal_ref = dataset.get("name", "")
+                    if existing_external_sources.get(internal_ref) == dataset.get("last_modified", ""):
+                        count_index(skipped=1)
+                        continue
+                    try:
+                        res = self._create_external_source_object(dataset, writer)
+                        if res == "Success":
+                            n_success += 1
+                    except Exception as e:
+                        page_complete = False
+                        logger.error(f"HDX:: Failed to index dataset {internal_ref} due to: {e}")
+                        count_index(failed=1)
+                writer.flush()
+                # Only move the watermark past a page if every dataset on it, and on the pages before it, was written,
+                # so failed ones are retried next run.
+                complete = complete and page_complete and writer.n_failed == n_failed
+                page_watermark = self._to_solr_date(page[-1].get("metadata_modified", ""))
+                if complete and page_watermark is not None and (watermark is None or page_watermark > watermark):
+                    watermark = page_watermark
+                    self.mongo_client.mongo_set_index_watermark("HDX", watermark)
+        return f"HDX - Successfully indexed {n_success - writer.n_failed} out of {n_ds} datasets."
+
+    @classmethod
+    def _search_datasets(cls, fq, since=None, page_size=None):
+        """
+        Lazily page through the HDX search results, oldest modification first.
+        Pages are requested with a metadata_modified cursor instead of an offset,
+        so datasets modified during the crawl move to a later page instead of shifting the others past the offset.
+        As the cursor range is inclusive, datasets at the cursor are returned again and skipped by their id.
+
+        :param fq: The solr filter query.
+        :param since: Only request datasets modified at or after this solr date.
+        :param page_size: The number of datasets requested per page, defaults to HDX_SEARCH_PAGE_SIZE.
+        :return: A generator of pages of HDX datasets.
+        """
+        if page_size is None:
+            page_size = env_int("HDX_SEARCH_PAGE_SIZE", HDX_SEARCH_PAGE_SIZE)
+        cursor = since
+        # The ids of the datasets returned at the cursor.
+        seen = set()
+        start = 0
+        while True:
+            page_fq = fq if cursor is None else f"{fq} AND metadata_modified:[{cursor} TO *]"
+            page = Dataset.search_in_hdx(fq=page_fq, rows=page_size, start=start, sort="metadata_modified asc")
+            new = [dataset for dataset in page if dataset.get("id") not in seen]
+            if len(new) > 0:
+                yield new
+            if len(page) < page_size:
+                return
+            last = cls._to_solr_date(page[-1].get("metadata_modified", ""))
+            if last is None or last == cursor:
+                # A full page modified within the same second does not move the cursor, so offset within it.
+                start += page_size
+            else:
+                cursor, seen, start = last, set(), 0
+            seen.update(
+                dataset.get("id")
+                for dataset in page
+                if cls._to_solr_date(dataset.get("metadata_modified", "")) == cursor
+            )
 
-    def _create_external_source_object(self, dataset: Dataset, update=False, update_item=None):
+    @staticmethod
+    def _to_solr_date(value):
+        """
+        Convert a HDX metadata date such as 2024-01-31T10:00:00.123456 to the solr format 2024-01-31T10:00:00Z.
+        Fractional seconds are dropped, which is safe as the watermark range is inclusive.
+        """
+        try:
+            return datetime.datetime.fromisoformat(value.rstrip("Z")).strftime("%Y-%m-%dT%H:%M:%SZ")
+        except (AttributeError, TypeError, ValueError):
+            return None
+
+    def _create_external_source_object(self, dataset: Dataset, writer: ExternalSourceWriter):
         """
         Core functionality of indexing.
-        This function creates the external source object and sends it to MongoDB.
-        If update is True, the existing object is updated instead of newly inserted.
+        This function creates the external source object and adds it to the writer, which upserts it to MongoDB.
+        Existing objects are matched on source and internalRef by the upsert, so they are updated in place.
 
         :param dataset: The HDX dataset object.
-        :param update: A boolean indicating if the object should be updated instead of inserted.
-        :param update_item: The existing object to update.
+        :param writer: The ExternalSourceWriter that buffers the object for the bulk upsert.
         :return: A string indicating the result of the operation.
         """
         resources = dataset.get_resources()
-        if update:
-            external_dataset = copy.deepcopy(update_item)
-            external_dataset.pop("score", None)
-            external_dataset["subCategories"] = []
-            external_dataset["resources"] = []
-        else:
-            external_dataset = copy.deepcopy(EXTERNAL_DATASET_FORMAT)
+        external_dataset = copy.deepcopy(EXTERNAL_DATASET_FORMAT)
 
         # Prep values
         dsn = dataset.get("name", None)
@@ -141,10 +217,8 @@ class DXExternalSourceHDX(ExternalSourceModel):
 
         if len(external_dataset["resources"]) == 0:
             return "No resources attached to this dataset."
-        mongo_res = self.mongo_client.mongo_create_external_source(external_dataset, update=update)
-        if mongo_res is not None:
-            return "Success"
-        return "MongoDB Error"
+        writer.add(external_dataset)
+        return "Success"
 
     def download(self, external_dataset):
         res = "Sorry, we were unable to download the HDX Dataset, please try again later. Contact the admin if the problem persists."  # NOQA: 501
@@ -156,70 +230,95 @@ class DXExternalSourceHDX(ExternalSourceModel):
 
             dataset_title, file_information = external_dataset["name"].split(" - Data file: ")
             filename = file_information.split(" - Dataset file name: ")[-1]
-            # Get the first result where the title is an exact match
-            dataset = Dataset.search_in_hdx(query=f'title:"{dataset_title}"', rows=1)[0]
-            resources = dataset.get_resources()
-            for resource in resources:
-                if resource.get("format", "") not in ["csv", "CSV"]:
-                    continue
-                res_name = resource.get("name", "")
-                if res_name == filename:
-                    dl_url = resource.get("download_url", "")
-                    # Download the file
-                    res = self._download_file(dl_url, dx_id, filename)
-                    break
+            dl_url = self._resolve_download_url(dataset_title, filename)
+            if dl_url:
+                # Download the file
+                res = self._download_file(dl_url, dx_id, filename)
             return res
         except Exception as e:
             logger.error(f"HDX:: Failed to download file: {str(e)}")
             return "Sorry, we were unable to download the HDX Dataset, please try again later. Contact the admin if the problem persists."  # NOQA: 501
 
-    def _download_file(self, url, dx_id, found_filename, destination_folder="./staging"):
-        # Ensure the destination folder exists
-        os.makedirs(destination_folder, exist_ok=True)
+    def _resolve_download_url(self, dataset_title, filename):
+        """
+        Find the download url of a CSV resource of a HDX dataset.
+        We first use the resource stored in MongoDB when the dataset was indexed,
+        then the cached resources of an earlier HDX lookup, and only then search HDX itself.
 
-        # Extract the filename from the URL
-        filename = url.split("/")[-1]
+        :param dataset_title: The title of the HDX dataset.
+        :param filename: The name of the resource as listed on HDX.
+        :return: The download url, or None if the resource could not be found.
+        """
+        suffix = f" - Dataset file name: {filename}"
+        indexed = self.mongo_client.mongo_get_external_source_by_title("HDX", dataset_title)
+        if indexed is not None:
+            for resource in indexed.get("resources", []):
+                if resource.get("title", "").endswith(suffix) and resource.get("URI"):
+                    return resource["URI"]
+        resources = self.resource_cache.get(dataset_title)
+        if resources is None:
+            logger.debug(f"HDX:: Searching HDX for the resources of {dataset_title}")
+            # Get the first result where the title is an exact match
+            dataset = Dataset.search_in_hdx(query=f'title:"{dataset_title}"', rows=1)[0]
+            resources = [
+                (resource.get("name", ""), resource.get("download_url", ""))
+                for resource in dataset.get_resources()
+                if resource.get("format", "") in ["csv", "CSV"]
+            ]
+            self.resource_cache.set(dataset_title, resources)
+        for res_name, dl_url in resources:
+            if res_name == filename:
+                return dl_url
+        return None
 
-        # Construct the full path for saving the file
-        filepath = os.path.join(destination_folder, filename)
+    def _download_file(self, url, dx_id, found_filename, destination_folder="./staging", max_size=None):
+        """
+        Stream a HDX resource to the staging folder in fixed-size chunks and preprocess it.
+        Zipped resources are not extracted entirely, only the matching CSV member is streamed out of the archive.
 
-        # Send a GET request to the URL to download the file
+        :param url: The download url of the resource.
+        :param dx_id: The id of the dataset to create.
+        :param found_filename: The name of the resource as listed on HDX.
+        :param destination_folder: The staging folder.
+        :param max_size: The maximum size in bytes of the download and extracted file (HDX_MAX_DOWNLOAD_SIZE).
+        :return: A string indicating the result of the download and processing.
+        """
+        if max_size is None:
+            max_size = env_int("HDX_MAX_DOWNLOAD_SIZE", HDX_MAX_DOWNLOAD_SIZE)
+        # Ensure the destination folder exists
+        os.makedirs(destination_folder, exist_ok=True)
+        dx_name = f"{dx_id}.csv"
+        dx_loc = os.path.join(destination_folder, dx_name)
+        part_loc = os.path.join(destination_folder, f"{dx_id}.part")
+
+        # Send a GET request to the URL and stream the file to the destination folder
         try:
-            response = requests.get(url)
-            if response.status_code != 200:
-                logger.info(f"HDX:: Failed to download file from {url}")
-                return "Sorry, we were unable to download the file. Please try again later. Contact the admin if the problem persists."  # NOQA: 501
-            # Save the file to the destination folder
-            with open(filepath, "wb") as f:
-                f.write(response.content)
-                logger.info(f"HDX:: File downloaded successfully: {filepath}")
-            # if filepath endswith .zip
-            if filepath.endswith(".zip"):
-                # Unzip the file
-                with zipfile.ZipFile(filepath, "r") as zip_ref:
-                    zip_ref.extractall(destination_folder)
-                logger.info(f"HDX:: File unzipped successfully: {filepath}")
-                # Delete the zip file
-                os.remove(filepath)
-                filepath = filepath[:-4]  # Remove the .zip extension
-            if filepath.endswith("_csv"):
-                # replace _csv with .csv
-                os.rename(filepath, filepath.replace("_csv", ".csv"))
-            # rename ./staging/filepath to ./staging/dx{dx_id}.csv
-            dx_name = f"{dx_id}.csv"
-            try:
-                os.rename(filepath, f"./staging/{dx_name}")
-            except Exception:
-                logger.info("HDX:: Failed to rename file")
-                if found_filename.endswith(".zip"):
-                    found_filename = found_filename[:-4]
-                if found_filename.endswith("_csv"):
-                    found_filename = found_filename.replace("_csv", ".csv")
-                try:
-                    os.rename(found_filename, f"./staging/{dx_name}")
-                except Exception:
-                    logger.error("HDX:: Failed to rename original file name as well")
-                    return "Sorry, the HDX source file does not match the expected format, please try a different dataset."  # NOQA: 501
+            start = time.monotonic()
+            n_bytes = 0
+            with http_client().get(url, stream=True, timeout=HDX_DOWNLOAD_TIMEOUT) as response:
+                if response.status_code != 200:
+                    logger.info(f"HDX:: Failed to download file from {url}")
+                    return "Sorry, we were unable to download the file. Please try again later. Contact the admin if the problem persists."  # NOQA: 501
+                if int(response.headers.get("Content-Length", 0)) > max_size:
+                    logger.info(f"HDX:: File at {url} exceeds the maximum size of {max_size} bytes")
+                    return HDX_TOO_LARGE
+                with open(part_loc, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=HDX_DOWNLOAD_CHUNK_SIZE):
+                        n_bytes += len(chunk)
+                        if n_bytes > max_size:
+                            logger.info(f"HDX:: File at {url} exceeds the maximum size of {max_size} bytes")
+                            return HDX_TOO_LARGE
+                        f.write(chunk)
+            elapsed = max(time.monotonic() - start, 1e-6)
+            logger.info(
+                f"HDX:: File downloaded successfully: {url} - {n_bytes} bytes in {elapsed:.2f}s ({n_bytes / elapsed:.0f} bytes/sec)"  # NOQA: 501
+            )
+            if zipfile.is_zipfile(part_loc):
+                res = self._extract_csv_member(part_loc, dx_loc, found_filename, max_size)
+                if res != "Success":
+                    return res
+            else:
+                os.replace(part_loc, dx_loc)
             try:
                 res = self.dataset_preprocessor.preprocess_data(dx_name, create_ds=True)
             except Exception as e:
@@ -229,3 +328,37 @@ class DXExternalSourceHDX(ExternalSourceModel):
         except Exception as e:
             logger.error(f"HDX:: Failed to download file from {url}: {e}")
             return "Sorry, we were unable to download or process the file. Please try again later. Contact the admin if the problem persists."  # NOQA: 501
+        finally:
+            if os.path.exists(part_loc):
+                os.remove(part_loc)
+
+    @staticmethod
+    def _extract_csv_member(zip_loc, dx_loc, found_filename, max_size):
+        """
+        Stream the CSV member matching the resource name out of a zip archive.
+        If no member matches the name, the first CSV member is used.
+
+        :param zip_loc: The location of the downloaded archive.
+        :param dx_loc: The location to write the CSV file to.
+        :param found_filename: The name of the resource as listed on HDX.
+        :param max_size: The maximum uncompressed size in bytes.
+        :return: A string indicating the result of the extraction.
+        """
+        expected = found_filename
+        if expected.endswith(".zip"):
+            expected = expected[:-4]
+        if expected.endswith("_csv"):
+            expected = expected[:-4] + ".csv"
+        with zipfile.ZipFile(zip_loc, "r") as zip_ref:
+            members = [m for m in zip_ref.infolist() if not m.is_dir() and m.filename.lower().endswith(".csv")]
+            if len(members) == 0:
+                logger.error("HDX:: No CSV file found in the archive")
+                return "Sorry, the HDX source file does not match the expected format, please try a different dataset."  # NOQA: 501
+            member = next((m for m in members if os.path.basename(m.filename) == expected), members[0])
+            if member.file_size > max_size:
+                logger.info(f"HDX:: Archive member {member.filename} exceeds the maximum size of {max_size} bytes")
+                return HDX_TOO_LARGE
+            with zip_ref.open(member) as src, open(dx_loc, "wb") as dst:
+                shutil.copyfileobj(src, dst, HDX_DOWNLOAD_CHUNK_SIZE)
+        logger.info(f"HDX:: Extracted {member.filename} from the archive")
+        return "Success"
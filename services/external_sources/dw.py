@@ -6,9 +6,11 @@ import re
 import datadotworld as dw
 from rb_core_backend.external_sources.model import ExternalSourceModel
 from rb_core_backend.external_sources.util import EXTERNAL_DATASET_FORMAT, EXTERNAL_DATASET_RESOURCE_FORMAT
-from rb_core_backend.mongo import RBCoreBackendMongo
 from rb_core_backend.preprocess_dataset import RBCoreDatasetPreprocessor
 
+from services.external_sources.util import ExternalSourceWriter, count_index, preprocess_dataframe
+from services.mongo import DXBackendMongo
+
 logger = logging.getLogger(__name__)
 RE_SUB = r"[^a-zA-Z0-9]"
 
@@ -18,7 +20,7 @@ class DXExternalSourceDW(ExternalSourceModel):
 
     def __init__(
         self,
-        mongo_client: RBCoreBackendMongo,
+        mongo_client: DXBackendMongo,
         dataset_preprocessor: RBCoreDatasetPreprocessor,
     ) -> None:
         super().__init__(mongo_client, dataset_preprocessor)
@@ -36,61 +38,51 @@ class DXExternalSourceDW(ExternalSourceModel):
             self.mongo_client.mongo_remove_data_for_external_sources("DW")
         logger.info("DW:: Indexing DW data...")
         # Get existing sources
-        existing_external_sources = self.mongo_client.mongo_get_all_external_sources()
-        existing_external_sources = {source["internalRef"]: source for source in existing_external_sources}
+        existing_external_sources = self.mongo_client.mongo_get_external_source_refs("DW")
         # Get all datasets and process
         all_dataset = dw.api_client().fetch_liked_datasets()
         n_ds = 0
         n_success = 0
-        for dataset in all_dataset.get("records"):
-            if dataset.get("license") not in [
-                "Public Domain",
-                "CC0",
-                "CC-BY",
-                "CC-BY-SA",
-                "CC-BY-NC",
-                "CC-BY-NC-SA",
-                "CC-BY-NC-ND",
-                "CC-BY-ND",
-            ]:  # NOQA: E501
-                continue
-            n_ds += 1
-            # We use the name as the internal ref, as the id might change.
-            internal_ref = dataset.get("id")
-            update = False
-            update_item = None
-            if internal_ref in existing_external_sources:
-                if existing_external_sources[internal_ref]["dateSourceLastUpdated"] == dataset.get("updated", ""):
+        with ExternalSourceWriter(self.mongo_client) as writer:
+            for dataset in all_dataset.get("records"):
+                if dataset.get("license") not in [
+                    "Public Domain",
+                    "CC0",
+                    "CC-BY",
+                    "CC-BY-SA",
+                    "CC-BY-NC",
+                    "CC-BY-NC-SA",
+                    "CC-BY-NC-ND",
+                    "CC-BY-ND",
+                ]:  # NOQA: E501
                     continue
-                else:
-                    update = True
-                    update_item = existing_external_sources[internal_ref]
-            try:
-                res = self._create_external_source_object(dataset, update, update_item)
-                if res == "Success":
-                    n_success += 1
-            except Exception as e:
-                logger.error(f"DW:: Failed to index dataset {internal_ref} due to: {e}")
-        return f"DW - Successfully indexed {n_success} out of {n_ds} datasets."
+                n_ds += 1
+                count_index(fetched=1)
+                # We use the name as the internal ref, as the id might change.
+                internal_ref = dataset.get("id")
+                if existing_external_sources.get(internal_ref) == dataset.get("updated", ""):
+                    count_index(skipped=1)
+                    continue
+                try:
+                    res = self._create_external_source_object(dataset, writer)
+                    if res == "Success":
+                        n_success += 1
+                except Exception as e:
+                    logger.error(f"DW:: Failed to index dataset {internal_ref} due to: {e}")
+                    count_index(failed=1)
+        return f"DW - Successfully indexed {n_success - writer.n_failed} out of {n_ds} datasets."
 
-    def _create_external_source_object(self, dataset, update=False, update_item=None):
+    def _create_external_source_object(self, dataset, writer: ExternalSourceWriter):
         """
         Core functionality of indexing.
-        This function creates the external source object and sends it to MongoDB.
-        If update is True, the existing object is updated instead of newly inserted.
+        This function creates the external source object and adds it to the writer, which upserts it to MongoDB.
+        Existing objects are matched on source and internalRef by the upsert, so they are updated in place.
 
         :param dataset: The DW dataset object.
-        :param update: A boolean indicating if the object should be updated instead of inserted.
-        :param update_item: The existing object to update.
+        :param writer: The ExternalSourceWriter that buffers the object for the bulk upsert.
         :return: A string indicating the result of the operation.
         """
-        if update:
-            external_dataset = copy.deepcopy(update_item)
-            external_dataset.pop("score", None)
-            external_dataset["subCategories"] = []
-            external_dataset["resources"] = []
-        else:
-            external_dataset = copy.deepcopy(EXTERNAL_DATASET_FORMAT)
+        external_dataset = copy.deepcopy(EXTERNAL_DATASET_FORMAT)
 
         # Build the external dataset
         external_dataset["title"] = dataset.get("title", "")
@@ -125,10 +117,8 @@ class DXExternalSourceDW(ExternalSourceModel):
 
         if len(external_dataset["resources"]) == 0:
             return "No resources attached to this dataset."
-        mongo_res = self.mongo_client.mongo_create_external_source(external_dataset, update=update)
-        if mongo_res is not None:
-            return "Success"
-        return "MongoDB Error"
+        writer.add(external_dataset)
+        return "Success"
 
     def download(self, external_dataset):
         logger.debug("DW:: Downloading dw dataset")
@@ -139,7 +129,7 @@ class DXExternalSourceDW(ExternalSourceModel):
             datasets = dw.load_dataset(file_path)
             df = datasets.dataframes[name]
             try:
-                res = self.dataset_preprocessor.preprocess_data(df, create_ds=True)
+                res = preprocess_dataframe(self.dataset_preprocessor, df, external_dataset["id"])
             except Exception as e:
                 logger.error(f"DW:: Failed to preprocess data for {url} due to: {e}")
                 res = "Sorry, we were unable to process the dataset, please try a different dataset. Contact the admin for more information."  # NOQA: 501
@@ -0,0 +1,312 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from services.external_sources.util import env_float, env_int
+
+logger = logging.getLogger(__name__)
+HTTP_CACHE_DIR = "./staging/http-cache"
+HTTP_POOL_SIZE = 10
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+# The number of requests sent to the same host at the same time, per process.
+HTTP_HOST_CONCURRENCY = 4
+HTTP_TIMEOUT = 120
+# Responses can be parsed while they are downloaded, small chunks let the parsing start early.
+HTTP_CHUNK_SIZE = 64 * 1024
+HTTP_RETRY_STATUSES = [429, 500, 502, 503, 504]
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+
+class DXHttpClient:
+    """
+    The HTTP layer shared by the external sources.
+    Requests go through one pooled keep-alive session per process, are retried with exponential backoff
+    on connection errors and HTTP_RETRY_STATUSES, and are limited to host_concurrency at a time per host.
+    fetch downloads a file to an on-disk cache, which is revalidated with ETag and Last-Modified,
+    so an unchanged file costs a 304 instead of a full download.
+    Cached files are stored by the sha256 of their content, which also records the dataset parsed from them.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = None,
+        pool_size: int = None,
+        retries: int = None,
+        backoff_factor: float = None,
+        host_concurrency: int = None,
+        timeout: float = None,
+    ) -> None:
+        self.cache_dir = cache_dir or os.getenv("HTTP_CACHE_DIR", HTTP_CACHE_DIR)
+        self.pool_size = pool_size if pool_size is not None else env_int("HTTP_POOL_SIZE", HTTP_POOL_SIZE)
+        self.retries = retries if retries is not None else env_int("HTTP_RETRIES", HTTP_RETRIES)
+        if backoff_factor is None:
+            backoff_factor = env_float("HTTP_BACKOFF_FACTOR", HTTP_BACKOFF_FACTOR)
+        self.backoff_factor = backoff_factor
+        if host_concurrency is None:
+            host_concurrency = env_int("HTTP_HOST_CONCURRENCY", HTTP_HOST_CONCURRENCY)
+        self.host_concurrency = max(1, host_concurrency)
+        self.timeout = timeout if timeout is not None else env_float("HTTP_TIMEOUT", HTTP_TIMEOUT)
+        self._session = None
+        self._session_pid = None
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def session(self) -> requests.Session:
+        """
+        Get the pooled session, created when this is the first call in the current process.
+        """
+        with self._lock:
+            if self._session is None or self._session_pid != os.getpid():
+                retry = Retry(
+                    total=self.retries,
+                    backoff_factor=self.backoff_factor,
+                    status_forcelist=HTTP_RETRY_STATUSES,
+                    allowed_methods=["GET", "HEAD"],
+                    respect_retry_after_header=True,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                # Sessions inherited from a parent process share its sockets, so they are replaced, not closed.
+                self._session, self._session_pid, self._hosts = session, os.getpid(), {}
+            return self._session
+
+    @contextmanager
+    def _host_slot(self, url):
+        host = urlparse(url).netloc
+        self.session()
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.host_concurrency)
+            semaphore = self._hosts[host]
+        with semaphore:
+            yield
+
+    @contextmanager
+    def get(self, url: str, timeout: float = None, **kwargs):
+        """
+        Send a GET request, holding a slot of its host until the response is closed.
+        Use as a context manager, like requests.get, so streamed responses release their connection.
+
+        :param url: The url.
+        :param timeout: The connect and read timeout in seconds, defaults to HTTP_TIMEOUT.
+        :param kwargs: Any other arguments for requests, such as params and stream.
+        :return: The response.
+        """
+        with self._host_slot(url):
+            response = self.session().get(url, timeout=timeout or self.timeout, **kwargs)
+            try:
+                yield response
+            finally:
+                response.close()
+
+    def fetch(self, url: str, timeout: float = None, max_age: float = 0) -> dict:
+        """
+        Download a file to the cache, or revalidate the cached copy with the ETag and Last-Modified it was served with.
+        Files are stored by the sha256 of their content, so identical files are stored once.
+
+        :param url: The url.
+        :param timeout: The connect and read timeout in seconds, defaults to HTTP_TIMEOUT.
+        :param max_age: The number of seconds a cached copy is used without revalidating it,
+                        for sources that do not send an ETag or Last-Modified.
+        :return: A dictionary with the path of the cached file, whether it changed since the last fetch,
+                 and its url, etag, lastModified, size, sha256 and fetchedAt.
+        """
+        with self.stream(url, timeout=timeout, max_age=max_age) as res:
+            pass
+        del res["file"]
+        return res
+
+    @contextmanager
+    def stream(self, url: str, timeout: float = None, max_age: float = 0):
+        """
+        Like fetch, but the content can be read while it is downloaded, so it can be parsed during the download.
+        Use as a context manager, which yields the dictionary fetch returns, with a file-like object in "file".
+        When the cached copy is used, "file" reads it. Otherwise it reads the response, which is stored in the cache
+        when the block exits, and only then are path, size and sha256 set in the dictionary.
+
+        :param url: The url.
+        :param timeout: The connect and read timeout in seconds, defaults to HTTP_TIMEOUT.
+        :param max_age: The number of seconds a cached copy is used without revalidating it.
+        :return: The dictionary described in fetch, with the file to read the content from.
+        """
+        os.makedirs(os.path.join(self.cache_dir, "objects"), exist_ok=True)
+        meta_path = os.path.join(self.cache_dir, f"{hashlib.sha256(url.encode()).hexdigest()}.json")
+        meta = self._read_meta(meta_path)
+        if meta is not None and time.time() - meta.get("fetchedAt", 0) < max_age:
+            with open(self._object_path(meta["sha256"]), "rb") as f:
+                yield {**meta, "path": self._object_path(meta["sha256"]), "changed": False, "file": f}
+            return
+        headers = {}
+        if meta is not None:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("lastModified"):
+                headers["If-Modified-Since"] = meta["lastModified"]
+        with self.get(url, timeout=timeout, headers=headers, stream=True) as response:
+            if response.status_code == 304 and meta is not None:
+                logger.debug(f"HTTP:: {url} not modified, using the cached copy")
+                meta["fetchedAt"] = time.time()
+                self._write_meta(meta_path, meta)
+                with open(self._object_path(meta["sha256"]), "rb") as f:
+                    yield {**meta, "path": self._object_path(meta["sha256"]), "changed": False, "file": f}
+                return
+            response.raise_for_status()
+            tmp = os.path.join(self.cache_dir, "objects", f"{os.getpid()}.{threading.get_ident()}.tmp")
+            try:
+                with open(tmp, "wb") as f:
+                    reader = _CachingReader(response.iter_content(chunk_size=HTTP_CHUNK_SIZE), f)
+                    res = {"url": url, "changed": True, "file": reader}
+                    yield res
+                    # The cached copy is only complete once the rest of the response is read.
+                    reader.drain()
+                os.replace(tmp, self._object_path(reader.digest.hexdigest()))
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            previous = meta
+            meta = {
+                "url": url,
+                "etag": response.headers.get("ETag"),
+                "lastModified": response.headers.get("Last-Modified"),
+                "size": reader.size,
+                "sha256": reader.digest.hexdigest(),
+                "fetchedAt": time.time(),
+            }
+        self._write_meta(meta_path, meta)
+        changed = previous is None or previous["sha256"] != meta["sha256"]
+        if previous is not None and changed:
+            self._remove_unreferenced(previous["sha256"])
+        logger.debug(
+            f"HTTP:: Downloaded {url} to the cache, {reader.size} bytes, {'changed' if changed else 'unchanged'}"
+        )
+        res.update(meta, path=self._object_path(meta["sha256"]), changed=changed)
+
+    def parsed_dataset(self, sha256: str):
+        """
+        Get the dataset that was parsed from a cached file.
+
+        :param sha256: The sha256 of the file content.
+        :return: The dataset id, or None if the content was not parsed before.
+        """
+        try:
+            with open(os.path.join(self.cache_dir, "objects", f"{sha256}.dataset")) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def set_parsed_dataset(self, sha256: str, ds_id: str):
+        """
+        Record the dataset that was parsed from a cached file.
+
+        :param sha256: The sha256 of the file content.
+        :param ds_id: The dataset id.
+        """
+        path = os.path.join(self.cache_dir, "objects", f"{sha256}.dataset")
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(ds_id)
+        os.replace(tmp, path)
+
+    def _object_path(self, sha256):
+        return os.path.join(self.cache_dir, "objects", sha256)
+
+    def _read_meta(self, meta_path):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except Exception:
+            return None
+        # A cached copy that was removed is downloaded again.
+        if not meta.get("sha256") or not os.path.exists(self._object_path(meta["sha256"])):
+            return None
+        return meta
+
+    @staticmethod
+    def _write_meta(meta_path, meta):
+        tmp = f"{meta_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, meta_path)
+
+    def _remove_unreferenced(self, sha256):
+        # Other urls may serve the same content.
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.cache_dir, filename)) as f:
+                    if json.load(f).get("sha256") == sha256:
+                        return
+            except Exception:
+                continue
+        for path in [self._object_path(sha256), f"{self._object_path(sha256)}.dataset"]:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class _CachingReader:
+    """
+    A file-like object over the chunks of a response, which writes every chunk to the cache file and hashes it.
+    """
+
+    def __init__(self, chunks, out) -> None:
+        self.chunks = chunks
+        self.out = out
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self._chunk = b""
+        self._pos = 0
+
+    def _next_chunk(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.digest.update(chunk)
+                self.size += len(chunk)
+                self.out.write(chunk)
+                return chunk
+        return b""
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._pos >= len(self._chunk):
+                self._chunk, self._pos = self._next_chunk(), 0
+                if not self._chunk:
+                    break
+            start = self._pos
+            end = len(self._chunk) if size < 0 else start + size
+            part = self._chunk[start:end]
+            self._pos += len(part)
+            if size > 0:
+                size -= len(part)
+            parts.append(part)
+        return b"".join(parts)
+
+    def drain(self):
+        while self._next_chunk():
+            pass
+
+
+def http_client() -> DXHttpClient:
+    """
+    Get the HTTP client shared by every external source in this process.
+    """
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            _CLIENT = DXHttpClient()
+        return _CLIENT
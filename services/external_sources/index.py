@@ -0,0 +1,281 @@
+import logging
+import multiprocessing
+import signal
+import time
+
+from rb_core_backend.external_sources.index import RBCoreExternalSources
+
+from services.external_sources.util import TTLCache, env_int, index_counters
+from services.jobs import detach_job, report_progress
+from services.mongo import DXBackendMongo
+
+logger = logging.getLogger(__name__)
+SEARCH_CACHE_TTL = 300
+SEARCH_CACHE_SIZE = 128
+# The number of ranked results cached per search, pages beyond it are searched directly.
+SEARCH_CACHE_WINDOW = 200
+# Source names as used in search requests, mapped to the names the indexers use.
+SEARCH_SOURCE_ALIASES = {"World Bank": "WB"}
+# Indexer names mapped to the source name stored on the documents.
+DOCUMENT_SOURCE_NAMES = {v: k for k, v in SEARCH_SOURCE_ALIASES.items()}
+ALL_SOURCES = "*"
+INDEXING_SUCCESSFUL = "Indexing successful"
+# The maximum duration of indexing one source in seconds, per source with EXTERNAL_SOURCES_INDEX_TIMEOUT_<SOURCE>.
+EXTERNAL_SOURCES_INDEX_TIMEOUT = 7200
+# The number of sources indexed at the same time, 0 indexes all sources at once.
+EXTERNAL_SOURCES_INDEX_PROCESSES = 0
+INDEX_POLL_INTERVAL = 0.5
+INDEX_COUNTERS = ["fetched", "inserted", "updated", "skipped", "deleted", "failed"]
+# The counters of the datasets that were indexed, or found unchanged, during a run.
+INDEX_PROCESSED_COUNTERS = ["inserted", "updated", "skipped"]
+
+
+class DXExternalSources(RBCoreExternalSources):
+    """
+    RBCoreExternalSources extended with a cache of ranked search results.
+    The first page of a search fetches the top SEARCH_CACHE_WINDOW results once, later pages are sliced from them.
+    Cache keys include the search generation of the searched sources, which is increased when a source is indexed,
+    so results are invalidated per source across all processes.
+    It also counts search results by source and main category, where the unfiltered counts are precomputed per source
+    after every index run.
+    Indexing all sources runs every source in its own process, so they are indexed concurrently,
+    and a slow or failing source is stopped at its timeout without affecting the others.
+    """
+
+    def __init__(self, mongo_client: DXBackendMongo, all_sources: dict) -> None:
+        super().__init__(mongo_client=mongo_client, all_sources=all_sources)
+        self.dx_mongo_client = mongo_client
+        self.search_cache = TTLCache(
+            ttl=env_int("SEARCH_CACHE_TTL", SEARCH_CACHE_TTL),
+            max_size=env_int("SEARCH_CACHE_SIZE", SEARCH_CACHE_SIZE),
+        )
+        self.search_window = env_int("SEARCH_CACHE_WINDOW", SEARCH_CACHE_WINDOW)
+
+    def _search_key(self, query, sources, sort_by):
+        sources = sorted({SEARCH_SOURCE_ALIASES.get(source, source) for source in sources or [] if source})
+        generations = self.dx_mongo_client.mongo_get_search_generations()
+        # A search over every source depends on all of them.
+        depends_on = sources or sorted(generations)
+        versions = tuple((source, generations.get(source, 0)) for source in depends_on)
+        return query, tuple(sources), sort_by, generations.get(ALL_SOURCES, 0), versions
+
+    def search_external_sources(self, query, sources=[], legacy=False, limit=None, offset=0, sort_by=None):
+        """
+        Search the external sources, serving paged searches from the cached ranked results.
+        """
+        offset = offset or 0
+        if limit is None or self.search_window <= 0 or offset + limit > self.search_window:
+            return super().search_external_sources(
+                query, sources=sources, legacy=legacy, limit=limit, offset=offset, sort_by=sort_by
+            )
+        try:
+            key = (legacy,) + self._search_key(query, sources, sort_by)
+        except Exception as e:
+            logger.error(f"Error reading the search generations: {str(e)}")
+            key = None
+        ranked = self.search_cache.get(key) if key is not None else None
+        if ranked is None:
+            ranked = super().search_external_sources(
+                query, sources=sources, legacy=legacy, limit=self.search_window, offset=0, sort_by=sort_by
+            )
+            if not isinstance(ranked, list):
+                # Errors and unexpected formats are not cached or sliced.
+                return super().search_external_sources(
+                    query, sources=sources, legacy=legacy, limit=limit, offset=offset, sort_by=sort_by
+                )
+            if key is not None:
+                self.search_cache.set(key, ranked)
+        end = offset + limit
+        return ranked[offset:end]
+
+    def search_facets(self, query, sources=[]) -> dict:
+        """
+        Count the search results by source and main category.
+        Without a query, the counts precomputed at index time are used.
+
+        :param query: The search query.
+        :param sources: Optionally only count these sources.
+        :return: A dictionary with the source and mainCategory counts.
+        """
+        document_sources = [_document_source(source) for source in sources or [] if source]
+        if not query:
+            return self.dx_mongo_client.mongo_get_external_source_facets(document_sources)
+        try:
+            key = ("facets",) + self._search_key(query, sources, None)
+        except Exception as e:
+            logger.error(f"Error reading the search generations: {str(e)}")
+            key = None
+        facets = self.search_cache.get(key) if key is not None else None
+        if facets is None:
+            facets = self.dx_mongo_client.mongo_facet_external_sources(query, document_sources)
+            if key is not None:
+                self.search_cache.set(key, facets)
+        return facets
+
+    def external_search_index(self) -> dict:
+        """
+        Index all sources concurrently, each in its own process with its own timeout.
+
+        :return: A dictionary with the overall status, which is INDEXING_SUCCESSFUL when every source succeeded,
+                 and a report per source with its status, duration in seconds, counters and indexing result.
+        """
+        reports = self._index_sources(list(self.all_sources))
+        self._invalidate(ALL_SOURCES)
+        self._refresh_facets(None)
+        failed = [name for name, report in reports.items() if report["status"] != "success"]
+        status = f"Indexing failed for {', '.join(failed)}" if failed else INDEXING_SUCCESSFUL
+        return {"status": status, "sources": reports}
+
+    def _index_sources(self, names):
+        # Forked, as the indexers hold clients that cannot be pickled, every child reconnects to MongoDB.
+        context = multiprocessing.get_context("fork")
+        max_processes = env_int("EXTERNAL_SOURCES_INDEX_PROCESSES", EXTERNAL_SOURCES_INDEX_PROCESSES) or len(names)
+        pending = list(names)
+        running = {}
+        reports = {}
+        try:
+            while pending or running:
+                while pending and len(running) < max_processes:
+                    name = pending.pop(0)
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(
+                        target=_index_source,
+                        args=(name, self.all_sources[name]["index"], self.dx_mongo_client, sender),
+                        daemon=True,
+                    )
+                    process.start()
+                    sender.close()
+                    running[name] = (process, receiver, time.monotonic(), _index_timeout(name))
+                    logger.info(f"Index:: Started indexing {name} in process {process.pid}")
+                for name, (process, receiver, start, timeout) in list(running.items()):
+                    report = _poll_index(name, process, receiver, start, timeout)
+                    if report is None:
+                        continue
+                    del running[name]
+                    reports[name] = report
+                    report_progress(**{name: report})
+                    logger.info(f"Index:: Indexing {name} {report['status']} after {report['duration']}s")
+                if running:
+                    time.sleep(INDEX_POLL_INTERVAL)
+        finally:
+            # Only left when the run itself is interrupted.
+            for process, receiver, _, _ in running.values():
+                _stop_process(process)
+                receiver.close()
+        return {name: reports[name] for name in names if name in reports}
+
+    def external_search_force_reindex(self, source):
+        res = super().external_search_force_reindex(source)
+        self._invalidate(source)
+        self._refresh_facets([_document_source(source)])
+        return res
+
+    def _refresh_facets(self, sources):
+        try:
+            self.dx_mongo_client.mongo_refresh_external_source_facets(sources)
+        except Exception as e:
+            logger.error(f"Error refreshing the facet counts for {sources or 'all sources'}: {str(e)}")
+
+    def _invalidate(self, source):
+        try:
+            self.dx_mongo_client.mongo_bump_search_generation(source)
+        except Exception as e:
+            logger.error(f"Error invalidating the search cache for {source}: {str(e)}")
+        # Clear this process straight away, other processes pick up the new generation on their next search.
+        self.search_cache.clear()
+
+
+def _document_source(source):
+    source = SEARCH_SOURCE_ALIASES.get(source, source)
+    return DOCUMENT_SOURCE_NAMES.get(source, source)
+
+
+def _index_timeout(name):
+    default = env_int("EXTERNAL_SOURCES_INDEX_TIMEOUT", EXTERNAL_SOURCES_INDEX_TIMEOUT)
+    return env_int(f"EXTERNAL_SOURCES_INDEX_TIMEOUT_{name.upper()}", default)
+
+
+def _index_source(name, index, mongo_client, sender):
+    """
+    Run the indexer of a source, in its own process, and send its report to the parent.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # The parent reports the progress of its job per source.
+    detach_job()
+    index_counters(reset=True)
+    start = time.monotonic()
+    try:
+        # pymongo clients are not fork-safe, the indexers share the mongo client, so it is reconnected in place.
+        mongo_client.reconnect()
+        result = index()
+        counters = index_counters()
+        status = _index_status(counters)
+        if status != "success":
+            logger.error(f"Index:: Indexing {name} failed: {result}")
+    except Exception as e:
+        logger.error(f"Index:: Error indexing {name}: {str(e)}")
+        result, status = f"Sorry, something went wrong indexing {name}.", "failed"
+        counters = index_counters()
+    report = {"status": status, "duration": round(time.monotonic() - start, 3)}
+    report.update({counter: counters.get(counter, 0) for counter in INDEX_COUNTERS})
+    report["result"] = result
+    sender.send(report)
+    sender.close()
+
+
+def _index_status(counters):
+    """
+    Decide the status of an index run that returned, from the counters it recorded with count_index.
+    A run fails when it fetched datasets but none of them were indexed or found unchanged,
+    runs that fetched nothing, or do not count their datasets, succeed.
+
+    :param counters: The counters of the run.
+    :return: "success" or "failed".
+    """
+    processed = sum(counters.get(counter, 0) for counter in INDEX_PROCESSED_COUNTERS)
+    if counters.get("fetched", 0) > 0 and processed == 0:
+        return "failed"
+    return "success"
+
+
+def _poll_index(name, process, receiver, start, timeout):
+    """
+    Get the report of an indexing process when it has finished, failed or timed out.
+
+    :return: The report, or None while the process is still running.
+    """
+    duration = round(time.monotonic() - start, 3)
+    if receiver.poll():
+        try:
+            report = receiver.recv()
+        except EOFError:
+            # The process exited without a report, for example when it was killed.
+            process.join()
+            logger.error(f"Index:: Indexing {name} exited with code {process.exitcode}")
+            report = _failed_report("failed", duration, f"Indexing {name} exited with code {process.exitcode}.")
+        process.join()
+        receiver.close()
+        return report
+    if duration > timeout:
+        _stop_process(process)
+        receiver.close()
+        logger.error(f"Index:: Indexing {name} timed out after {timeout}s")
+        return _failed_report("timeout", duration, f"Indexing {name} timed out after {timeout}s.")
+    return None
+
+
+def _failed_report(status, duration, result):
+    # The counters of a process that did not report are unknown.
+    report = {"status": status, "duration": duration}
+    report.update({counter: None for counter in INDEX_COUNTERS})
+    report["result"] = result
+    return report
+
+
+def _stop_process(process):
+    process.terminate()
+    process.join(5)
+    if process.is_alive():
+        process.kill()
+        process.join()
@@ -1,14 +1,19 @@
-import copy
 import datetime
 import logging
+import time
 from urllib.parse import parse_qs, unquote, urlparse
 
 import pandas as pd
+import requests
 from rb_core_backend.external_sources.model import ExternalSourceModel
 from rb_core_backend.external_sources.util import EXTERNAL_DATASET_FORMAT, EXTERNAL_DATASET_RESOURCE_FORMAT
-from rb_core_backend.mongo import RBCoreBackendMongo
 from rb_core_backend.preprocess_dataset import RBCoreDatasetPreprocessor
 
+from services.external_sources.http_client import http_client
+from services.external_sources.util import ExternalSourceWriter, count_index, env_int, preprocess_dataframe
+from services.jobs import report_progress
+from services.mongo import DXBackendMongo
+
 logger = logging.getLogger(__name__)
 RE_SUB = r"[^a-zA-Z0-9]"
 OECD_COLS = [
@@ -20,6 +25,21 @@ OECD_COLS = [
     "OECD Data Explorer dataset name (FR)",
     "OECD Data Explorer url",
 ]
+# The indexed fields read back to detect changed datasets, and to keep their publication date.
+OECD_COMPARED_FIELDS = ["title", "description", "URI", "resources.URI", "datePublished"]
+# The dtypes of the SDMX structure columns, which are always text.
+# The other codes and labels are made categorical per chunk, numeric columns such as OBS_VALUE, TIME_PERIOD,
+# UNIT_MULT and DECIMALS keep the dtype pandas infers for them.
+OECD_SDMX_DTYPES = {
+    "STRUCTURE": "category",
+    "STRUCTURE_ID": "category",
+    "STRUCTURE_NAME": "category",
+    "ACTION": "category",
+}
+OECD_CSV_CHUNK_SIZE = 100000
+OECD_MAX_ROWS = 10000000
+OECD_MAX_DOWNLOAD_SIZE = 500 * 1024 * 1024
+OECD_TOO_LARGE = "Sorry, the OECD dataset is too large to be processed, please try a smaller selection."
 
 
 class DXExternalSourceOECD(ExternalSourceModel):
@@ -27,108 +47,180 @@ class DXExternalSourceOECD(ExternalSourceModel):
 
     def __init__(
         self,
-        mongo_client: RBCoreBackendMongo,
+        mongo_client: DXBackendMongo,
         dataset_preprocessor: RBCoreDatasetPreprocessor,
     ) -> None:
         super().__init__(mongo_client, dataset_preprocessor)
 
-    def index(self, delete=True):
+    def index(self, delete=False):
         """
         Indexing function for OECD data.
-        Using the OECD API, we search for datasets.
-        Then check for updates, if the object is to be updated, pass that as a boolean.
+        The OECD correspondence workbook lists every dataset, it is transformed into documents in one pass
+        and compared to the indexed OECD datasets by internalRef.
+        Only new and changed datasets are written, and datasets that left the catalog are removed,
+        so the OECD search results remain available while indexing.
 
+        :param delete: A boolean indicating if every OECD dataset should be rewritten, even if it did not change.
         :return: A string indicating the result of the indexing.
         """
-        if delete:
-            logger.info("OECD:: - Removing old OECD data")
-            self.mongo_client.mongo_remove_data_for_external_sources("OECD")
         logger.info("OECD:: Indexing OECD data...")
         # Get datasets
         url = "https://gitlab.com/sis-cc/topologies/oecd-migration/-/raw/main/OECDDatasetsCorrespondence.xlsx"
-        df = pd.read_excel(url, header=5)  # Drop first 12 rows, as the datasets start at 13
+        # The workbook is revalidated against the cached copy, so it is only downloaded again when it changed
+        workbook = http_client().fetch(url)
+        df = pd.read_excel(workbook["path"], header=5)  # Drop first 12 rows, as the datasets start at 13
         df = df.iloc[:, :-1]  # Drop the last column, as they are unused references
-        n_ds = 0
-        n_success = 0
-        # for row in df.iterrows():
-        for i in range(len(df)):
-            row = df.iloc[i]
-            n_ds += 1
-            # We use the name as the internal ref, as the id might change.
-            internal_ref = row[OECD_COLS[0]]
-            try:
-                res = self._create_external_source_object(row)
-                if res == "Success":
-                    n_success += 1
-            except Exception as e:
-                logger.error(f"OECD:: Failed to index dataset {internal_ref} due to: {e}")
-        return f"OECD - Successfully indexed {n_success} out of {n_ds} datasets."
-
-    def _create_external_source_object(self, dataset):
+        n_ds = len(df)
+        count_index(fetched=n_ds)
+        documents = self._build_documents(df)
+        existing = self.mongo_client.mongo_get_external_source_documents("OECD", OECD_COMPARED_FIELDS)
+        changed = []
+        for internal_ref, document in documents.items():
+            current = existing.get(internal_ref)
+            if current is not None and not delete and _fingerprint(current) == _fingerprint(document):
+                continue
+            if current is not None:
+                # Keep the publication date of datasets that are already indexed.
+                document["datePublished"] = current.get("datePublished") or document["datePublished"]
+            changed.append(document)
+        count_index(skipped=n_ds - len(changed))
+        with ExternalSourceWriter(self.mongo_client) as writer:
+            for document in changed:
+                writer.add(document)
+        # Only datasets that left the workbook are removed, not listed datasets whose document could not be built.
+        listed = set(df[OECD_COLS[0]].dropna())
+        unbuilt = len(listed) - len(documents)
+        if unbuilt > 0:
+            logger.info(f"OECD:: {unbuilt} listed datasets have no SDMX agency and dataflow, they are not removed")
+        removed = [ref for ref in existing if ref not in documents and ref not in listed]
+        n_removed = self.mongo_client.mongo_remove_external_sources("OECD", removed) if removed else 0
+        count_index(deleted=n_removed)
+        n_success = len(documents) - writer.n_failed
+        return (
+            f"OECD - Successfully indexed {n_success} out of {n_ds} datasets, "
+            f"{len(documents) - len(changed)} unchanged and {n_removed} removed."
+        )
+
+    @staticmethod
+    def _build_documents(df):
         """
-        Core functionality of indexing.
-        This function creates the external source object and sends it to MongoDB.
+        Transform the correspondence workbook into external dataset documents.
+        The agency and dataflow of the SDMX resource are parsed from the Data Explorer urls column-wise,
+        in every url form _convert_oecd_url accepts. Rows without them have no resource and are not indexed.
 
-        :param dataset: The OECD dataset object.
-        :return: A string indicating the result of the operation.
+        :param df: The correspondence workbook.
+        :return: A dictionary mapping internalRef to the document in the EXTERNAL_DATASET_FORMAT.
         """
-        external_dataset = copy.deepcopy(EXTERNAL_DATASET_FORMAT)
-        _current_year = datetime.datetime.now().year
-        _title = dataset[OECD_COLS[1]]
-        _desc = f"{dataset[OECD_COLS[4]]} - [OECD ({_current_year}), {OECD_COLS[1]}, {OECD_COLS[6]}]."
-        # Build the external dataset
-        external_dataset["title"] = _title
-        external_dataset["description"] = _desc
-        external_dataset["source"] = "OECD"
-        external_dataset["URI"] = dataset[OECD_COLS[6]]
-        external_dataset["internalRef"] = dataset[OECD_COLS[0]]
-        external_dataset["mainCategory"] = "OECD"
-        external_dataset["subCategories"] = []
-        external_dataset["datePublished"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        external_dataset["dateLastUpdated"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        external_dataset["dateSourceLastUpdated"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # Build and attach the resources if they are CSV
-        _input = dataset[OECD_COLS[6]]
-        if "df[ag]=" not in _input or "df[id]=" not in _input:
-            return "Invalid link"
-        _end = _input.split("df[ag]=")[1]
-        _id = _input.split("df[id]=")[1].split("&")[0]
-
-        resource_url = f"https://sdmx.oecd.org/public/rest/data/{_end},{_id}/all?dimensionAtObservation=AllDimensions&format=csvfilewithlabels"  # NOQA: 501
-        external_resource = copy.deepcopy(EXTERNAL_DATASET_RESOURCE_FORMAT)
-        external_resource["title"] = _title
-        external_resource["description"] = _desc
-        external_resource["URI"] = resource_url
-        external_resource["internalRef"] = dataset[OECD_COLS[0]]
-        external_resource["format"] = "csv"
-        external_resource["datePublished"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        external_resource["dateLastUpdated"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        external_resource["dateResourceLastUpdated"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        external_dataset["resources"].append(external_resource)
-
-        if len(external_dataset["resources"]) == 0:
-            return "No resources attached to this dataset."
-        mongo_res = self.mongo_client.mongo_create_external_source(external_dataset)
-        if mongo_res is not None:
-            return "Success"
-        return "MongoDB Error"
+        now = datetime.datetime.now()
+        now_str = now.strftime("%Y-%m-%d %H:%M:%S")
+        citation = f" - [OECD ({now.year}), {OECD_COLS[1]}, {OECD_COLS[6]}]."
+        catalog = pd.DataFrame(
+            {
+                "internalRef": df[OECD_COLS[0]],
+                "title": df[OECD_COLS[1]].fillna("").astype(str),
+                "description": df[OECD_COLS[4]].astype(str) + citation,
+                "URI": df[OECD_COLS[6]],
+            }
+        )
+        catalog["agency"], catalog["dataflow"] = _extract_sdmx_ids(catalog["URI"])
+        catalog = catalog.dropna(subset=["internalRef", "agency", "dataflow"])
+        catalog = catalog.drop_duplicates(subset="internalRef", keep="last")
+        catalog["resourceURI"] = (
+            "https://sdmx.oecd.org/public/rest/data/"
+            + catalog["agency"]
+            + ","
+            + catalog["dataflow"]
+            + "/all?dimensionAtObservation=AllDimensions&format=csvfilewithlabels"
+        )
+        documents = {}
+        for row in catalog.itertuples(index=False):
+            resource = {
+                **EXTERNAL_DATASET_RESOURCE_FORMAT,
+                "title": row.title,
+                "description": row.description,
+                "URI": row.resourceURI,
+                "internalRef": row.internalRef,
+                "format": "csv",
+                "datePublished": now_str,
+                "dateLastUpdated": now_str,
+                "dateResourceLastUpdated": now_str,
+            }
+            documents[row.internalRef] = {
+                **EXTERNAL_DATASET_FORMAT,
+                "title": row.title,
+                "description": row.description,
+                "source": "OECD",
+                "URI": row.URI,
+                "internalRef": row.internalRef,
+                "mainCategory": "OECD",
+                "subCategories": [],
+                "datePublished": now_str,
+                "dateLastUpdated": now_str,
+                "dateSourceLastUpdated": now_str,
+                "resources": [resource],
+            }
+        return documents
 
     def download(self, external_dataset):
         logger.debug("OECD:: Downloading oecd dataset")
         try:
             url = self._convert_oecd_url(external_dataset["url"])
-            df = pd.read_csv(url)
-            try:
-                res = self.dataset_preprocessor.preprocess_data(df, create_ds=True)
-            except Exception as e:
-                logger.error(f"OECD:: Failed to preprocess data for {url} due to: {e}")
-                res = "Sorry, we were unable to process the dataset, please try a different dataset. Contact the admin for more information."  # NOQA: 501
-        except Exception as e:
+            # The chunks are handed over as they are read, the dataset is never expanded into one DataFrame.
+            res = preprocess_dataframe(self.dataset_preprocessor, self._read_sdmx_csv(url), external_dataset["id"])
+        except OECDTooLarge:
+            res = OECD_TOO_LARGE
+        except requests.RequestException as e:
             logger.error(f"OECD:: Failed to download file: {str(e)}")
             res = "Sorry, we were unable to download the OECD Dataset, please try again later. Contact the admin if the problem persists."  # NOQA: 501
+        except Exception as e:
+            logger.error(f"OECD:: Failed to preprocess data for {external_dataset.get('url')} due to: {e}")
+            res = "Sorry, we were unable to process the dataset, please try a different dataset. Contact the admin for more information."  # NOQA: 501
         return res
 
+    @staticmethod
+    def _read_sdmx_csv(url, dtypes=None, chunk_size=None, max_rows=None, max_size=None):
+        """
+        Stream an SDMX CSV chunk by chunk, with categorical codes and labels,
+        so only a single chunk of parsed text is in memory. Numeric columns keep their inferred dtype.
+
+        :param url: The SDMX CSV url.
+        :param dtypes: The explicit dtypes of known columns, defaults to OECD_SDMX_DTYPES.
+        :param chunk_size: The number of rows parsed at a time, defaults to OECD_CSV_CHUNK_SIZE.
+        :param max_rows: The maximum number of rows, defaults to OECD_MAX_ROWS.
+        :param max_size: The maximum size of the CSV in bytes, defaults to OECD_MAX_DOWNLOAD_SIZE.
+        :return: A generator of DataFrames, raising OECDTooLarge when the dataset exceeds one of the maximums.
+        """
+        dtypes = OECD_SDMX_DTYPES if dtypes is None else dtypes
+        chunk_size = chunk_size or env_int("OECD_CSV_CHUNK_SIZE", OECD_CSV_CHUNK_SIZE)
+        max_rows = max_rows or env_int("OECD_MAX_ROWS", OECD_MAX_ROWS)
+        max_size = max_size or env_int("OECD_MAX_DOWNLOAD_SIZE", OECD_MAX_DOWNLOAD_SIZE)
+        start = time.monotonic()
+        n_rows = 0
+        with http_client().get(url, stream=True) as response:
+            response.raise_for_status()
+            response.raw.decode_content = True
+            reader = _CountingReader(response.raw)
+            try:
+                csv_chunks = pd.read_csv(reader, dtype=dtypes, chunksize=chunk_size)
+            except pd.errors.EmptyDataError:
+                return
+            for chunk in csv_chunks:
+                n_rows += len(chunk)
+                if n_rows > max_rows or reader.n_bytes > max_size:
+                    logger.info(f"OECD:: {url} exceeds {max_rows} rows or {max_size} bytes")
+                    raise OECDTooLarge(url)
+                for column in chunk.columns:
+                    if chunk[column].dtype == object:
+                        chunk[column] = chunk[column].astype("category")
+                elapsed = max(time.monotonic() - start, 1e-6)
+                report_progress(rows=n_rows, bytes=reader.n_bytes, rows_per_sec=round(n_rows / elapsed))
+                yield chunk
+        elapsed = max(time.monotonic() - start, 1e-6)
+        logger.info(
+            f"OECD:: Read {n_rows} rows ({reader.n_bytes} bytes) from {url} in {elapsed:.2f}s "
+            f"({n_rows / elapsed:.0f} rows/sec)"
+        )
+
     @staticmethod
     def _get_end_and_id_from_url(_input):
         try:
@@ -183,3 +275,47 @@ class DXExternalSourceOECD(ExternalSourceModel):
         )
 
         return new_url
+
+
+class OECDTooLarge(Exception):
+    """
+    Raised while reading an SDMX CSV that exceeds OECD_MAX_ROWS or OECD_MAX_DOWNLOAD_SIZE.
+    """
+
+
+def _extract_sdmx_ids(urls):
+    """
+    Extract the SDMX agency and dataflow ids from Data Explorer urls, column-wise.
+    Accepts the df[ag] and df[id] query parameters, percent-encoded or not, and dataflow[agencyId] and
+    dataflow[dataflowId], like _convert_oecd_url.
+
+    :param urls: A Series of urls.
+    :return: A tuple of Series with the agency and dataflow ids, missing where the url has none.
+    """
+    links = urls.astype("string").str.replace("%5[bB]", "[", regex=True).str.replace("%5[dD]", "]", regex=True)
+    agency = links.str.extract(r"[?&#](?:df\[ag\]|dataflow\[agencyId\])=([^&#]*)", expand=False)
+    dataflow = links.str.extract(r"[?&#](?:df\[id\]|dataflow\[dataflowId\])=([^&#]*)", expand=False)
+    return tuple(ids.replace("", pd.NA).map(unquote, na_action="ignore") for ids in [agency, dataflow])
+
+
+def _fingerprint(document):
+    resources = tuple(resource.get("URI") for resource in document.get("resources", []))
+    return document.get("title"), document.get("description"), document.get("URI"), resources
+
+
+class _CountingReader:
+    """
+    A file-like wrapper counting the bytes read from a stream.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.n_bytes = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.n_bytes += len(data)
+        return data
+
+    def __iter__(self):
+        return iter(self.raw)
@@ -6,12 +6,20 @@ from datetime import datetime
 import requests
 from rb_core_backend.external_sources.model import ExternalSourceModel
 from rb_core_backend.external_sources.util import EXTERNAL_DATASET_FORMAT, EXTERNAL_DATASET_RESOURCE_FORMAT
-from rb_core_backend.mongo import RBCoreBackendMongo
 from rb_core_backend.preprocess_dataset import RBCoreDatasetPreprocessor
 
+from services.data_management import clone_file
+from services.external_sources.http_client import http_client
+from services.external_sources.util import (
+    STAGING_FOLDER, ExternalSourceWriter, check_parsed_dataset, count_index, env_float
+)
+from services.mongo import DXBackendMongo
+
 logger = logging.getLogger(__name__)
 TGF_DEFAULT_URL = "https://data-service.theglobalfund.org/downloads"
 TGF_SOURCE_NOTICE = "  - This Datasource was retrieved from https://data-service.theglobalfund.org/downloads."
+# The number of seconds a downloaded dataset file is used without revalidating it.
+DOWNLOAD_CACHE_MAX_AGE = 3600
 
 TGF_DATASETS = {
     "Reported Results": {
@@ -66,7 +74,7 @@ class DXExternalSourceTGF(ExternalSourceModel):
 
     def __init__(
         self,
-        mongo_client: RBCoreBackendMongo,
+        mongo_client: DXBackendMongo,
         dataset_preprocessor: RBCoreDatasetPreprocessor,
     ) -> None:
         super().__init__(mongo_client, dataset_preprocessor)
@@ -85,29 +93,33 @@ class DXExternalSourceTGF(ExternalSourceModel):
         if delete:
             logger.info("TGF:: - Removing old The Global Fund data")
             self.mongo_client.mongo_remove_data_for_external_sources("TGF")
-        existing_external_sources = self.mongo_client.mongo_get_all_external_sources()
-        existing_external_sources = {source["internalRef"]: source for source in existing_external_sources}
+        existing_external_sources = self.mongo_client.mongo_get_external_source_refs("TGF")
         n_ds = 0
         n_success = 0
-        for key, values in TGF_DATASETS.items():
-            logger.info(f"TGF:: Indexing dataset {key}")
-            n_ds += 1
-            if key in existing_external_sources:
-                # We do not update existing sources, as there is no date provided.
-                continue
-            try:
-                res = self._create_external_source_object(key, values)
-                if res == "Success":
-                    n_success += 1
-            except Exception as e:
-                logger.error(f"TGF:: Failed to index dataset {key} due to: {e}")
-        return f"World Bank - Successfully indexed {n_success} out of {n_ds} datasets."
-
-    def _create_external_source_object(self, key, values):
+        with ExternalSourceWriter(self.mongo_client) as writer:
+            for key, values in TGF_DATASETS.items():
+                logger.info(f"TGF:: Indexing dataset {key}")
+                n_ds += 1
+                count_index(fetched=1)
+                if key in existing_external_sources:
+                    # We do not update existing sources, as there is no date provided.
+                    count_index(skipped=1)
+                    continue
+                try:
+                    res = self._create_external_source_object(key, values, writer)
+                    if res == "Success":
+                        n_success += 1
+                except Exception as e:
+                    logger.error(f"TGF:: Failed to index dataset {key} due to: {e}")
+                    count_index(failed=1)
+        return f"World Bank - Successfully indexed {n_success - writer.n_failed} out of {n_ds} datasets."
+
+    def _create_external_source_object(self, key, values, writer: ExternalSourceWriter):
         """
         Core subroutine to create an external source object from a World Bank metadata id.
 
         :param meta_id: The metadata id from the World Bank API.
+        :param writer: The ExternalSourceWriter that buffers the object for the bulk upsert.
         :return: A string indicating the result of the creation.
         """
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -137,32 +149,57 @@ class DXExternalSourceTGF(ExternalSourceModel):
         if len(external_dataset["resources"]) == 0:
             return "No resources attached to this dataset."
         logger.info(f"Submitting external dataset to MongoDB {external_dataset}")
-        mongo_res = self.mongo_client.mongo_create_external_source(external_dataset, update=False)
-        if mongo_res is not None:
-            return "Success"
-        return "MongoDB Error"
+        writer.add(external_dataset)
+        return "Success"
 
     def download(self, external_dataset):
-        res = "Success"
         url = external_dataset["url"]
         logger.debug(f"TGF:: Downloading TGF dataset: {url}")
 
         try:
-            dx_id = external_dataset["id"]
-            dx_name = f"{dx_id}.csv"
-            dx_loc = f"./staging/{dx_name}"
-
-            # download `url` to `dx_loc`
-            with requests.get(url, stream=True) as r:
-                r.raise_for_status()  # Check if the request was successful
-                with open(dx_loc, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-            try:
-                res = self.dataset_preprocessor.preprocess_data(dx_name, create_ds=True)
-            except Exception:
-                return "We were unable to process the dataset, please try a different dataset. Contact the admin for more information."  # noqa
-            os.remove(dx_loc)
-        except Exception:
+            # The file is only downloaded when it changed, and a dataset already parsed from it is reused.
+            res = self._import_cached_download(url, external_dataset["id"])
+        except requests.RequestException:
             res = "We were unable to download the dataset, please try again later."
+        except Exception as e:
+            logger.error(f"TGF:: Failed to import {url}: {str(e)}")
+            res = "We were unable to process the dataset, please try a different dataset. Contact the admin for more information."  # noqa
+        return res
+
+    def _import_cached_download(self, url: str, dx_id: str, max_age: float = None):
+        """
+        Import the file at a fixed url as a dataset, through the download cache.
+        The file is only downloaded again when it changed upstream, and when the same content was imported before,
+        the dataset parsed from it is duplicated instead of parsing the file again.
+
+        :param url: The url of the CSV file.
+        :param dx_id: The id of the dataset to create.
+        :param max_age: The number of seconds the cached file is used without revalidating it,
+                        defaults to DOWNLOAD_CACHE_MAX_AGE.
+        :return: The result of the preprocessing, or of the duplication.
+        """
+        client = http_client()
+        if max_age is None:
+            max_age = env_float("DOWNLOAD_CACHE_MAX_AGE", DOWNLOAD_CACHE_MAX_AGE)
+        cached = client.fetch(url, max_age=max_age)
+        parsed = client.parsed_dataset(cached["sha256"])
+        data_manager = getattr(self.dataset_preprocessor, "data_manager", None)
+        if parsed is not None and hasattr(data_manager, "duplicate_parsed_files"):
+            res = data_manager.duplicate_parsed_files(parsed, dx_id)
+            if res == "Success":
+                logger.debug(f"TGF:: Reused dataset {parsed} for {url}")
+                return check_parsed_dataset(self.dataset_preprocessor, dx_id, res)
+            logger.info(f"TGF:: Could not reuse dataset {parsed} for {url}, parsing it again: {res}")
+        os.makedirs(STAGING_FOLDER, exist_ok=True)
+        dx_name = f"{dx_id}.csv"
+        dx_loc = os.path.join(STAGING_FOLDER, dx_name)
+        clone_file(cached["path"], dx_loc)
+        try:
+            res = self.dataset_preprocessor.preprocess_data(dx_name, create_ds=True)
+        finally:
+            if os.path.exists(dx_loc):
+                os.remove(dx_loc)
+        res = check_parsed_dataset(self.dataset_preprocessor, dx_id, res)
+        if res == "Success":
+            client.set_parsed_dataset(cached["sha256"], dx_id)
         return res
@@ -0,0 +1,278 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from services.jobs import report_progress
+from services.mongo import DXBackendMongo
+
+logger = logging.getLogger(__name__)
+EXTERNAL_SOURCES_BATCH_SIZE = 500
+EXTERNAL_SOURCES_FLUSH_INTERVAL = 5
+STAGING_FOLDER = "./staging"
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+# Counters of the index run in this process, each source is indexed in its own process by DXExternalSources.
+_INDEX_COUNTERS = {}
+_INDEX_COUNTERS_LOCK = threading.Lock()
+
+
+class RateLimiter:
+    """
+    Thread safe token bucket, used to cap the number of requests per second we send to an upstream host.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until a token is available. A rate of 0 or lower disables the limiter.
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+def host_rate_limiter(host: str, rate: float) -> RateLimiter:
+    """
+    Get the shared rate limiter for a host, so every caller within the process shares the same budget.
+
+    :param host: The upstream host name.
+    :param rate: The maximum number of requests per second, used when the limiter is first created.
+    :return: The RateLimiter for the host.
+    """
+    with _RATE_LIMITERS_LOCK:
+        if host not in _RATE_LIMITERS:
+            _RATE_LIMITERS[host] = RateLimiter(rate)
+        return _RATE_LIMITERS[host]
+
+
+def count_index(**counters):
+    """
+    Add to the counters of the index run in this process.
+
+    :param counters: Keyword counters, for example fetched=1, skipped=1.
+    """
+    with _INDEX_COUNTERS_LOCK:
+        for name, value in counters.items():
+            _INDEX_COUNTERS[name] = _INDEX_COUNTERS.get(name, 0) + value
+
+
+def index_counters(reset: bool = False) -> dict:
+    """
+    Get the counters of the index run in this process.
+
+    :param reset: Whether to reset the counters, at the start of a run.
+    :return: A dictionary of the counters.
+    """
+    with _INDEX_COUNTERS_LOCK:
+        counters = dict(_INDEX_COUNTERS)
+        if reset:
+            _INDEX_COUNTERS.clear()
+    return counters
+
+
+def env_int(name: str, default: int) -> int:
+    """
+    Read an integer setting from the environment, falling back to the default when unset or malformed.
+    """
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    """
+    Read a float setting from the environment, falling back to the default when unset or malformed.
+    """
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+class TTLCache:
+    """
+    A small thread safe in-memory cache, where entries expire after ttl seconds.
+    When max_size is reached, the least recently used entry is evicted.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 1000) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+def bounded_map(fn, items, workers: int):
+    """
+    Apply fn to every item on a thread pool, keeping at most a few tasks per worker in flight,
+    so large iterables are not materialised up front.
+    Results are yielded in completion order to the calling thread, which acts as the single consumer.
+
+    :param fn: The function to apply to each item.
+    :param items: An iterable of items.
+    :param workers: The number of worker threads.
+    :return: A generator of (item, result, exception) tuples.
+    """
+    workers = max(1, workers)
+    max_pending = workers * 4
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(fn, item)] = item
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                exc = future.exception()
+                yield item, (None if exc else future.result()), exc
+
+
+def preprocess_dataframe(dataset_preprocessor, frames, dx_id: str, drop_empty_columns: bool = False):
+    """
+    Preprocess downloaded DataFrames as the dataset with the requested id,
+    through the preprocess_dataframe entry point of the dataset preprocessor, which keeps the column types.
+
+    :param dataset_preprocessor: The dataset preprocessor.
+    :param frames: The DataFrame of the downloaded dataset, or an iterable of DataFrames with its rows in order.
+    :param dx_id: The id of the dataset to create.
+    :param drop_empty_columns: Whether columns without any value are left out.
+    :return: The result of the preprocessing.
+    """
+    res = dataset_preprocessor.preprocess_dataframe(frames, dx_id, drop_empty_columns=drop_empty_columns)
+    return check_parsed_dataset(dataset_preprocessor, dx_id, res)
+
+
+def check_parsed_dataset(dataset_preprocessor, dx_id: str, res: str) -> str:
+    """
+    Confirm that a successful preprocessing created the dataset under the requested id.
+
+    :param dataset_preprocessor: The dataset preprocessor.
+    :param dx_id: The id of the requested dataset.
+    :param res: The result of the preprocessing.
+    :return: The result, or an error when the parsed dataset is not at the requested id.
+    """
+    data_manager = getattr(dataset_preprocessor, "data_manager", None)
+    if res != "Success" or not hasattr(data_manager, "parsed_file"):
+        return res
+    if data_manager.parsed_file(dx_id) is None:
+        logger.error(f"Preprocessing succeeded, but no parsed dataset was created for {dx_id}")
+        return "Sorry, we were unable to create the dataset. Contact the admin for more information."
+    return res
+
+
+class ExternalSourceWriter:
+    """
+    Buffer external dataset documents and write them to MongoDB as unordered bulk upserts.
+    A batch is flushed when it reaches batch_size documents, or when flush_interval seconds passed since the last flush.
+    Use as a context manager, so the remaining documents are flushed when indexing completes.
+    """
+
+    def __init__(self, mongo_client: DXBackendMongo, batch_size: int = None, flush_interval: float = None) -> None:
+        if batch_size is None:
+            batch_size = env_int("EXTERNAL_SOURCES_BATCH_SIZE", EXTERNAL_SOURCES_BATCH_SIZE)
+        if flush_interval is None:
+            flush_interval = env_float("EXTERNAL_SOURCES_FLUSH_INTERVAL", EXTERNAL_SOURCES_FLUSH_INTERVAL)
+        self.mongo_client = mongo_client
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.n_inserted = 0
+        self.n_updated = 0
+        self.n_failed = 0
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+    def add(self, external_dataset: dict):
+        """
+        Buffer a document, flushing the batch when it is full or the flush interval has passed.
+
+        :param external_dataset: A document in the EXTERNAL_DATASET_FORMAT.
+        """
+        with self._lock:
+            self._buffer.append(external_dataset)
+            if len(self._buffer) < self.batch_size and time.monotonic() - self._last_flush < self.flush_interval:
+                return
+            batch = self._take()
+        self._write(batch)
+
+    def flush(self):
+        """
+        Write all buffered documents.
+        """
+        with self._lock:
+            batch = self._take()
+        self._write(batch)
+
+    def _take(self):
+        batch = self._buffer
+        self._buffer = []
+        self._last_flush = time.monotonic()
+        return batch
+
+    def _write(self, batch):
+        if len(batch) == 0:
+            return
+        res = self.mongo_client.mongo_bulk_upsert_external_sources(batch)
+        self.n_inserted += res["inserted"]
+        self.n_updated += res["updated"]
+        self.n_failed += res["failed"]
+        count_index(inserted=res["inserted"], updated=res["updated"], failed=res["failed"])
+        report_progress(inserted=self.n_inserted, updated=self.n_updated, failed=self.n_failed)
+        logger.debug(f"ExternalSourceWriter:: Flushed {len(batch)} external sources")
@@ -1,6 +1,5 @@
 import copy
 import logging
-import os
 import re
 import xml.etree.ElementTree as ET
 from datetime import datetime
@@ -9,11 +8,44 @@ import pandas as pd
 import requests
 from rb_core_backend.external_sources.model import ExternalSourceModel
 from rb_core_backend.external_sources.util import EXTERNAL_DATASET_FORMAT, EXTERNAL_DATASET_RESOURCE_FORMAT
-from rb_core_backend.mongo import RBCoreBackendMongo
 from rb_core_backend.preprocess_dataset import RBCoreDatasetPreprocessor
 
+from services.external_sources.http_client import http_client
+from services.external_sources.util import ExternalSourceWriter, count_index, env_int, preprocess_dataframe
+from services.mongo import DXBackendMongo
+
 logger = logging.getLogger(__name__)
 WB_SOURCE_NOTICE = "  - This Datasource was retrieved from https://apps.who.int/gho/athena/api/GHO."
+WHO_GHO_TIMEOUT = 120
+WHO_ODATA_PAGE_SIZE = 10000
+WHO_ODATA_TIMEOUT = 120
+# The GHO OData columns we keep, Id and IndicatorCode are dropped as they are the same for every row.
+WHO_COLUMNS = [
+    "SpatialDimType",
+    "SpatialDim",
+    "ParentLocationCode",
+    "ParentLocation",
+    "TimeDimType",
+    "TimeDim",
+    "Dim1Type",
+    "Dim1",
+    "Dim2Type",
+    "Dim2",
+    "Dim3Type",
+    "Dim3",
+    "DataSourceDimType",
+    "DataSourceDim",
+    "Value",
+    "NumericValue",
+    "Low",
+    "High",
+    "Comments",
+    "Date",
+    "TimeDimensionValue",
+    "TimeDimensionBegin",
+    "TimeDimensionEnd",
+]
+WHO_EXCLUDED_COLUMNS = ["Id", "IndicatorCode"]
 
 
 class DXExternalSourceWHO(ExternalSourceModel):
@@ -21,7 +53,7 @@ class DXExternalSourceWHO(ExternalSourceModel):
 
     def __init__(
         self,
-        mongo_client: RBCoreBackendMongo,
+        mongo_client: DXBackendMongo,
         dataset_preprocessor: RBCoreDatasetPreprocessor,
     ) -> None:
         super().__init__(mongo_client, dataset_preprocessor)
@@ -38,39 +70,70 @@ class DXExternalSourceWHO(ExternalSourceModel):
         if delete:
             logger.info("WHO:: - Removing old WHO data")
             self.mongo_client.mongo_remove_data_for_external_sources("WHO")
-        existing_external_sources = self.mongo_client.mongo_get_all_external_sources()
-        existing_external_sources = {source["internalRef"]: source for source in existing_external_sources}
+        # The watermark is the sha256 of the last catalog that was indexed completely.
+        indexed = None if delete else self.mongo_client.mongo_get_index_watermark("WHO")
 
-        # Get WHO data
+        # Stream the WHO data through the download cache, and handle each code element as soon as it is parsed.
+        # An unchanged catalog is served from the cache, and not indexed again if it was indexed completely.
         gho_xml_url = "https://apps.who.int/gho/athena/api/GHO"
-        response = requests.get(gho_xml_url)
-        xml_data = response.content
-
-        # Parse the XML data into an ElementTree
-        root = ET.fromstring(xml_data)
-        code_elements = root.findall(".//Metadata/Dimension/Code")
-        # Iterate over the code elements and create sources
         n_ds = 0
         n_success = 0
-        for code in code_elements:
-            n_ds += 1
-            if code.get("Label") is None:
-                continue
-            if code.get("Label") in existing_external_sources:
+        complete = True
+        with http_client().stream(gho_xml_url, timeout=WHO_GHO_TIMEOUT) as gho_xml:
+            if not gho_xml["changed"] and gho_xml["sha256"] == indexed:
+                logger.info("WHO:: The GHO catalog did not change since it was last indexed")
+                return "WHO - Successfully indexed 0 out of 0 datasets, the catalog did not change."
+            existing_external_sources = self.mongo_client.mongo_get_external_source_refs("WHO")
+            with ExternalSourceWriter(self.mongo_client) as writer:
+                for code in self._iter_codes(gho_xml["file"]):
+                    n_ds += 1
+                    count_index(fetched=1)
+                    if code.get("Label") is None or code.get("Label") in existing_external_sources:
+                        count_index(skipped=1)
+                        continue
+                    try:
+                        res = self._create_external_source_object(code, writer)
+                        if res == "Success":
+                            n_success += 1
+                        else:
+                            complete = False
+                    except Exception as e:
+                        complete = False
+                        logger.error(f"WHO:: Failed to index dataset {code.get('Label')} due to: {e}")
+                        count_index(failed=1)
+        if complete and writer.n_failed == 0:
+            self.mongo_client.mongo_set_index_watermark("WHO", gho_xml["sha256"])
+        return f"WHO - Successfully indexed {n_success - writer.n_failed} out of {n_ds} datasets."
+
+    @staticmethod
+    def _iter_codes(source):
+        """
+        Incrementally parse the GHO XML and yield every Metadata/Dimension/Code element.
+        Each element is cleared and detached once the caller is done with it, so the parsed tree does not grow.
+
+        :param source: A file-like object with the GHO XML.
+        :return: A generator of code elements.
+        """
+        tags = []
+        elements = []
+        for event, elem in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                tags.append(elem.tag)
+                elements.append(elem)
                 continue
-            try:
-                res = self._create_external_source_object(code)
-                if res == "Success":
-                    n_success += 1
-            except Exception as e:
-                logger.error(f"WHO:: Failed to index dataset {code.get('Label')} due to: {e}")
-        return f"WHO - Successfully indexed {n_success} out of {n_ds} datasets."
-
-    def _create_external_source_object(self, code):
+            tags.pop()
+            elements.pop()
+            if elem.tag == "Code" and tags[-2:] == ["Metadata", "Dimension"]:
+                yield elem
+                elem.clear()
+                elements[-1].remove(elem)
+
+    def _create_external_source_object(self, code, writer: ExternalSourceWriter):
         """
         Core subroutine to create an external source object from a WHO code element.
 
         :param code: The code element from the WHO API.
+        :param writer: The ExternalSourceWriter that buffers the object for the bulk upsert.
         """
         try:
             internal_ref = code.get("Label")
@@ -113,50 +176,72 @@ class DXExternalSourceWHO(ExternalSourceModel):
             external_dataset["resources"].append(external_resource)
             if len(external_dataset["resources"]) == 0:
                 return "No resources attached to this dataset."
-            mongo_res = self.mongo_client.mongo_create_external_source(external_dataset, update=False)
-            if mongo_res is not None:
-                return "Success"
-            return "MongoDB Error"
+            writer.add(external_dataset)
+            return "Success"
         except Exception as e:
             logger.error(f"WHO:: Error creating external source object: {str(e)}")
             return "Error"
 
     def download(self, external_dataset):
-        res = "Success"
         # Download data
         url = f"https://ghoapi.azureedge.net/api/{self._extract_who_code(external_dataset['name'])}"
+        logger.debug(f"WHO:: Downloading who dataset: {url}")
+        # Every page is handed to the preprocessor as it arrives, without excess columns in case $select was not
+        # supported, and columns without any value on any page are dropped.
+        pages = (
+            page.drop(columns=[col for col in WHO_EXCLUDED_COLUMNS if col in page.columns])
+            for page in self._read_odata(url)
+        )
         try:
-            logger.debug(f"WHO:: Downloading who dataset: {url}")
-            data = requests.get(url).json()["value"]
-        except Exception:
-            return "Sorry, we were unable to download the WHO Dataset, please try again later. Contact the admin if the problem persists."  # NOQA: 501
-        try:
-            if data == []:
-                return "The dataset is empty, please try a different dataset."
-            df = pd.DataFrame(data)
-
-            # Drop column if empty
-            df = df.dropna(axis=1, how="all")
-            # Drop excess columns
-            if "Id" in df.columns:
-                df = df.drop(columns=["Id"])
-            if "IndicatorCode" in df.columns:
-                df = df.drop(columns=["IndicatorCode"])
-
-            # save df as a csv file
-            dx_id = external_dataset["id"]
-            dx_name = f"{dx_id}.csv"
-            dx_loc = f"./staging/{dx_name}"
-            df.to_csv(dx_loc, index=False)
-            try:
-                res = self.dataset_preprocessor.preprocess_data(dx_name, create_ds=True)
-            except Exception:
-                res = "We were unable to process the dataset, please try a different dataset. Contact the admin for more information."  # NOQA: 501
-            os.remove(dx_loc)
+            res = preprocess_dataframe(
+                self.dataset_preprocessor, pages, external_dataset["id"], drop_empty_columns=True
+            )
+        except requests.RequestException:
+            res = "Sorry, we were unable to download the WHO Dataset, please try again later. Contact the admin if the problem persists."  # NOQA: 501
         except Exception:
             res = "We were unable to process the dataset, please try a different dataset. Contact the admin for more information."  # NOQA: 501
         return res
 
+    @staticmethod
+    def _read_odata(url, page_size=None):
+        """
+        Read a GHO OData indicator page by page, selecting only the columns we keep.
+        Every page is converted to a DataFrame straight away, so only one page of JSON records is in memory at a time.
+        We follow @odata.nextLink when the server pages the results, and otherwise page with $top and $skip.
+
+        :param url: The url of the GHO indicator.
+        :param page_size: The number of rows requested per page, defaults to WHO_ODATA_PAGE_SIZE.
+        :return: A generator of DataFrames, one per page.
+        """
+        if page_size is None:
+            page_size = env_int("WHO_ODATA_PAGE_SIZE", WHO_ODATA_PAGE_SIZE)
+        select = ",".join(WHO_COLUMNS)
+        params = {"$select": select, "$top": page_size}
+        skip = 0
+        next_url = url
+        while next_url is not None:
+            with http_client().get(next_url, params=params, timeout=WHO_ODATA_TIMEOUT) as response:
+                if response.status_code == 400 and "$select" in (params or {}):
+                    # Not every indicator exposes the full column set, fall back to all columns.
+                    logger.debug(f"WHO:: $select rejected for {url}, requesting all columns")
+                    params.pop("$select")
+                    continue
+                response.raise_for_status()
+                content = response.json()
+            page = content.pop("value", [])
+            if len(page) > 0:
+                yield pd.DataFrame.from_records(page)
+            n_rows = len(page)
+            del page
+            if content.get("@odata.nextLink"):
+                next_url, params = content["@odata.nextLink"], None
+            elif params is not None and n_rows == page_size:
+                skip += page_size
+                params = {**params, "$skip": skip}
+            else:
+                # The last page, or the server ignored $top and returned everything at once.
+                next_url = None
+
     @staticmethod
     def _extract_who_code(input_string):
         pattern = r"WHO Code:\s*([A-Z0-9_]+)"
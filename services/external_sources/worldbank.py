@@ -1,16 +1,23 @@
 import copy
 import logging
-import os
+import time
 from datetime import datetime
 
 import wbgapi as wb
 from rb_core_backend.external_sources.model import ExternalSourceModel
 from rb_core_backend.external_sources.util import EXTERNAL_DATASET_FORMAT, EXTERNAL_DATASET_RESOURCE_FORMAT
-from rb_core_backend.mongo import RBCoreBackendMongo
 from rb_core_backend.preprocess_dataset import RBCoreDatasetPreprocessor
 
+from services.external_sources.util import (
+    ExternalSourceWriter, bounded_map, count_index, env_float, env_int, host_rate_limiter, preprocess_dataframe
+)
+from services.mongo import DXBackendMongo
+
 logger = logging.getLogger(__name__)
 WB_SOURCE_NOTICE = "  - This Datasource was retrieved from https://data.worldbank.org/."
+WB_API_HOST = "api.worldbank.org"
+WB_INDEX_WORKERS = 8
+WB_INDEX_RATE_LIMIT = 20
 
 
 class DXExternalSourceWB(ExternalSourceModel):
@@ -18,56 +25,94 @@ class DXExternalSourceWB(ExternalSourceModel):
 
     def __init__(
         self,
-        mongo_client: RBCoreBackendMongo,
+        mongo_client: DXBackendMongo,
         dataset_preprocessor: RBCoreDatasetPreprocessor,
     ) -> None:
         super().__init__(mongo_client, dataset_preprocessor)
 
-    def index(self, delete=False):
+    def index(self, delete=False, workers=None, rate_limit=None):
         """
         Indexing function for World Bank data.
         Using the World Bank API, we search for datasets.
         There is no real way to track updated datasets, so we just index all datasets.
+        Series metadata is fetched concurrently on a bounded worker pool, rate limited per host,
+        while the calling thread acts as the single writer to MongoDB.
 
         :param delete: A boolean indicating if the World Bank data should be removed before indexing.
+        :param workers: The number of concurrent metadata requests, defaults to WB_INDEX_WORKERS.
+        :param rate_limit: The maximum number of metadata requests per second, defaults to WB_INDEX_RATE_LIMIT.
         :return: A string indicating the result of the indexing.
         """
         logger.info("WB:: Indexing World Bank data...")
+        if workers is None:
+            workers = env_int("WB_INDEX_WORKERS", WB_INDEX_WORKERS)
+        if rate_limit is None:
+            rate_limit = env_float("WB_INDEX_RATE_LIMIT", WB_INDEX_RATE_LIMIT)
         # Get existing sources
         if delete:
             logger.info("WB:: - Removing old World Bank data")
             self.mongo_client.mongo_remove_data_for_external_sources("World Bank")
-        existing_external_sources = self.mongo_client.mongo_get_all_external_sources()
-        existing_external_sources = {source["internalRef"]: source for source in existing_external_sources}
+        existing_external_sources = self.mongo_client.mongo_get_external_source_refs("World Bank")
         # Get all datasets and process
         search_meta = wb.series.list()
-        n_ds = 0
+        counts = {"n_ds": 0}
+
+        def _new_meta_ids():
+            for meta in search_meta:
+                counts["n_ds"] += 1
+                count_index(fetched=1)
+                meta_id = meta.get("id", None)
+                if meta_id is None or meta_id in existing_external_sources:
+                    # We do not update existing sources, as there is no date provided.
+                    count_index(skipped=1)
+                    continue
+                yield meta_id
+
+        limiter = host_rate_limiter(WB_API_HOST, rate_limit)
+        start = time.monotonic()
         n_success = 0
-        for meta in search_meta:
-            n_ds += 1
-            meta_id = meta.get("id", None)
-            if meta_id is None:
-                continue
-            if meta_id in existing_external_sources:
-                # We do not update existing sources, as there is no date provided.
-                continue
-            try:
-                res = self._create_external_source_object(meta_id)
-                if res == "Success":
-                    n_success += 1
-            except Exception as e:
-                logger.error(f"WB:: Failed to index dataset {meta_id} due to: {e}")
-        return f"World Bank - Successfully indexed {n_success} out of {n_ds} datasets."
-
-    def _create_external_source_object(self, meta_id):
+        with ExternalSourceWriter(self.mongo_client) as writer:
+            for meta_id, dataset, exc in bounded_map(
+                lambda meta_id: self._get_metadata(meta_id, limiter), _new_meta_ids(), workers
+            ):
+                if exc is not None:
+                    logger.error(f"WB:: Failed to index dataset {meta_id} due to: {exc}")
+                    count_index(failed=1)
+                    continue
+                try:
+                    res = self._create_external_source_object(meta_id, dataset, writer)
+                    if res == "Success":
+                        n_success += 1
+                except Exception as e:
+                    logger.error(f"WB:: Failed to index dataset {meta_id} due to: {e}")
+                    count_index(failed=1)
+        elapsed = max(time.monotonic() - start, 1e-6)
+        return (
+            f"World Bank - Successfully indexed {n_success - writer.n_failed} out of {counts['n_ds']} datasets "
+            f"({n_success / elapsed:.2f} series/sec)."
+        )
+
+    @staticmethod
+    def _get_metadata(meta_id, limiter):
+        """
+        Retrieve the metadata for a single World Bank series, waiting on the host rate limiter first.
+
+        :param meta_id: The metadata id from the World Bank API.
+        :param limiter: The RateLimiter for the World Bank API host.
+        :return: The metadata dictionary of the series.
+        """
+        limiter.wait()
+        return wb.series.metadata.get(meta_id).__dict__["metadata"]
+
+    def _create_external_source_object(self, meta_id, dataset, writer: ExternalSourceWriter):
         """
         Core subroutine to create an external source object from a World Bank metadata id.
 
         :param meta_id: The metadata id from the World Bank API.
+        :param dataset: The metadata dictionary retrieved for the metadata id.
+        :param writer: The ExternalSourceWriter that buffers the object for the bulk upsert.
         :return: A string indicating the result of the creation.
         """
-        dataset = wb.series.metadata.get(meta_id).__dict__["metadata"]
-
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         # Build the external dataset
         external_dataset = copy.deepcopy(EXTERNAL_DATASET_FORMAT)
@@ -94,10 +139,8 @@ class DXExternalSourceWB(ExternalSourceModel):
         external_dataset["resources"].append(external_resource)
         if len(external_dataset["resources"]) == 0:
             return "No resources attached to this dataset."
-        mongo_res = self.mongo_client.mongo_create_external_source(external_dataset, update=False)
-        if mongo_res is not None:
-            return "Success"
-        return "MongoDB Error"
+        writer.add(external_dataset)
+        return "Success"
 
     def download(self, external_dataset):
         res = "Success"
@@ -122,18 +165,12 @@ class DXExternalSourceWB(ExternalSourceModel):
             df = df.melt(id_vars=["Year"], var_name="Country", value_name="Value")
             # drop na in value
             df = df.dropna()
-            df["Year"] = df["Year"].str[2:]
-
-            # save df as a csv file
-            dx_id = external_dataset["id"]
-            dx_name = f"{dx_id}.csv"
-            dx_loc = f"./staging/{dx_name}"
-            df.to_csv(dx_loc, index=False)
+            # YR2020 -> 2020, typed as the integer the CSV round trip used to produce
+            df["Year"] = df["Year"].str[2:].astype(int)
             try:
-                res = self.dataset_preprocessor.preprocess_data(dx_name, create_ds=True)
+                res = preprocess_dataframe(self.dataset_preprocessor, df, external_dataset["id"])
             except Exception:
                 return "We were unable to process the dataset, please try a different dataset. Contact the admin for more information."  # noqa
-            os.remove(dx_loc)
         except Exception:
             res = "We were unable to download the dataset, please try again later."
         return res
@@ -0,0 +1,380 @@
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+JOBS_DB = "./staging/jobs.sqlite3"
+JOBS_POLL_INTERVAL = 1
+# Running jobs record a heartbeat every JOBS_HEARTBEAT_INTERVAL seconds, a job without one for JOBS_STALE_AFTER seconds
+# is requeued, as its worker is gone even when its pid was reused, until it was claimed JOBS_MAX_ATTEMPTS times.
+JOBS_HEARTBEAT_INTERVAL = 10
+JOBS_STALE_AFTER = 120
+JOBS_MAX_ATTEMPTS = 3
+# Columns added after the first release, created on existing job files.
+JOB_COLUMNS = {"attempts": "INTEGER NOT NULL DEFAULT 0", "heartbeat_at": "REAL"}
+JOB_STATES = ["queued", "running", "finished", "failed", "interrupted"]
+# The maximum number of jobs returned by one /jobs listing.
+JOBS_LIST_MAX_LIMIT = 500
+
+# The job currently executed by this process, used to attach progress counters.
+_current_job = {"queue": None, "id": None}
+
+
+def report_progress(**counters):
+    """
+    Merge progress counters into the job running in this process. Outside of a job this is a no-op.
+
+    :param counters: Keyword counters, for example inserted=10, updated=2.
+    """
+    queue, job_id = _current_job["queue"], _current_job["id"]
+    if queue is None or job_id is None:
+        return
+    try:
+        queue.progress(job_id, **counters)
+    except Exception as e:
+        logger.error(f"Jobs:: Failed to report progress for {job_id}: {str(e)}")
+
+
+def detach_job():
+    """
+    Stop attaching progress to the job of this process, used in child processes that report through their parent.
+    """
+    _current_job["queue"], _current_job["id"] = None, None
+
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class DXJobQueue:
+    """
+    A persistent job queue backed by a local SQLite file, so long-running work can be moved out of the request.
+    Web workers enqueue jobs by name, and a pool of worker processes started with `work` executes them.
+    Job functions are registered with the `task` decorator, and return a (code, result) tuple like our routes.
+    Running jobs send heartbeats, so the jobs of a worker that died, or of a pool that was restarted, are requeued.
+    """
+
+    def __init__(self, location: str = None) -> None:
+        self.location = location or os.getenv("JOBS_DB", JOBS_DB)
+        self.tasks = {}
+        self.heartbeat_interval = float(os.getenv("JOBS_HEARTBEAT_INTERVAL", JOBS_HEARTBEAT_INTERVAL))
+        self.stale_after = float(os.getenv("JOBS_STALE_AFTER", JOBS_STALE_AFTER))
+        self.max_attempts = int(os.getenv("JOBS_MAX_ATTEMPTS", JOBS_MAX_ATTEMPTS))
+        os.makedirs(os.path.dirname(os.path.abspath(self.location)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    kwargs TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    progress TEXT NOT NULL DEFAULT '{}',
+                    code INTEGER,
+                    result TEXT,
+                    worker_pid INTEGER,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    heartbeat_at REAL,
+                    created_at TEXT,
+                    started_at TEXT,
+                    finished_at TEXT
+                )
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, definition in JOB_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.location, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def task(self, name: str):
+        """
+        Decorator registering a function as a job.
+
+        :param name: The job name used when enqueueing.
+        """
+
+        def decorator(fn):
+            self.tasks[name] = fn
+            return fn
+
+        return decorator
+
+    def enqueue(self, name: str, **kwargs) -> str:
+        """
+        Add a job to the queue.
+
+        :param name: The name of a registered job.
+        :param kwargs: JSON serialisable keyword arguments for the job function.
+        :return: The id of the new job.
+        """
+        if name not in self.tasks:
+            raise ValueError(f"Unknown job: {name}")
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, name, kwargs, state, created_at) VALUES (?, ?, ?, 'queued', ?)",
+                (job_id, name, json.dumps(kwargs), _now()),
+            )
+        return job_id
+
+    def get(self, job_id: str):
+        """
+        Get the state of a job.
+
+        :param job_id: The job id.
+        :return: A dictionary describing the job, or None if it does not exist.
+        """
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._serialize(row) if row is not None else None
+
+    def list(self, state: str = None, limit: int = 50) -> list:
+        """
+        List the most recent jobs.
+
+        :param state: Optionally only return jobs in this state.
+        :param limit: The maximum number of jobs to return.
+        :return: A list of job dictionaries, newest first.
+        """
+        query = "SELECT * FROM jobs"
+        params = []
+        if state:
+            query += " WHERE state = ?"
+            params.append(state)
+        query += " ORDER BY rowid DESC LIMIT ?"
+        params.append(limit)
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(query, params).fetchall()
+        return [self._serialize(row) for row in rows]
+
+    def progress(self, job_id: str, **counters):
+        """
+        Merge counters into the progress of a job.
+
+        :param job_id: The job id.
+        :param counters: Keyword counters.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT progress FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is not None:
+                progress = json.loads(row[0])
+                progress.update(counters)
+                conn.execute("UPDATE jobs SET progress = ? WHERE id = ?", (json.dumps(progress), job_id))
+            conn.execute("COMMIT")
+
+    @staticmethod
+    def _serialize(row):
+        return {
+            "id": row["id"],
+            "name": row["name"],
+            "state": row["state"],
+            "progress": json.loads(row["progress"]),
+            "code": row["code"],
+            "result": json.loads(row["result"]) if row["result"] is not None else None,
+            "createdAt": row["created_at"],
+            "startedAt": row["started_at"],
+            "finishedAt": row["finished_at"],
+        }
+
+    def _claim(self):
+        """
+        Atomically move the oldest queued job to running for this process.
+
+        :return: A tuple of (job id, name, kwargs, attempt), or None when the queue is empty.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id, name, kwargs, attempts FROM jobs WHERE state = 'queued' ORDER BY rowid LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET state = 'running', worker_pid = ?, attempts = ?, heartbeat_at = ?, started_at = ? "
+                    "WHERE id = ?",
+                    (os.getpid(), row[3] + 1, time.time(), _now(), row[0]),
+                )
+            conn.execute("COMMIT")
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2]), row[3] + 1
+
+    def _finish(self, job_id, attempt, state, code, result):
+        # The arguments are cleared once the job is done, as they may contain database credentials.
+        # A job that was requeued in the meantime belongs to its new attempt, so it is left alone.
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = ?, code = ?, result = ?, kwargs = '{}', finished_at = ? "
+                "WHERE id = ? AND state = 'running' AND attempts = ?",
+                (state, code, json.dumps(result), _now(), job_id, attempt),
+            )
+
+    @contextmanager
+    def _heartbeat(self, job_id, attempt):
+        """
+        Record a heartbeat for a running job every heartbeat_interval seconds, until the block exits.
+        """
+        stopped = threading.Event()
+
+        def beat():
+            while not stopped.wait(self.heartbeat_interval):
+                try:
+                    with self._connect() as conn:
+                        conn.execute(
+                            "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND state = 'running' AND attempts = ?",
+                            (time.time(), job_id, attempt),
+                        )
+                except Exception as e:
+                    logger.error(f"Jobs:: Failed to record a heartbeat for {job_id}: {str(e)}")
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+
+    def _recover(self):
+        """
+        Requeue running jobs whose worker process no longer exists, or that have not sent a heartbeat for stale_after
+        seconds, which covers a worker pid reused by another process after a restart.
+        A job that was already claimed max_attempts times is marked as interrupted instead.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, worker_pid, attempts, heartbeat_at FROM jobs WHERE state = 'running'"
+            ).fetchall()
+            for job_id, pid, attempts, heartbeat_at in rows:
+                if pid is not None and pid_alive(pid) and heartbeat_at is not None:
+                    if now - heartbeat_at < self.stale_after:
+                        continue
+                if attempts >= self.max_attempts:
+                    logger.info(f"Jobs:: Marking job {job_id} as interrupted after {attempts} attempts")
+                    conn.execute(
+                        "UPDATE jobs SET state = 'interrupted', code = 500, result = ?, kwargs = '{}', finished_at = ? "
+                        "WHERE id = ?",
+                        (json.dumps("The job was interrupted, please try again."), _now(), job_id),
+                    )
+                else:
+                    logger.info(f"Jobs:: Requeueing job {job_id}, its worker stopped")
+                    conn.execute(
+                        "UPDATE jobs SET state = 'queued', worker_pid = NULL, heartbeat_at = NULL, started_at = NULL "
+                        "WHERE id = ?",
+                        (job_id,),
+                    )
+            conn.execute("COMMIT")
+
+    def run_next(self) -> bool:
+        """
+        Run the oldest queued job in the current process.
+
+        :return: True if a job was run, False if the queue was empty.
+        """
+        claimed = self._claim()
+        if claimed is None:
+            return False
+        job_id, name, kwargs, attempt = claimed
+        logger.info(f"Jobs:: Running job {name} ({job_id})")
+        _current_job["queue"], _current_job["id"] = self, job_id
+        try:
+            with self._heartbeat(job_id, attempt):
+                code, res = self.tasks[name](**kwargs)
+            self._finish(job_id, attempt, "finished", code, res)
+        except Exception as e:
+            logger.error(f"Jobs:: Job {name} ({job_id}) failed: {str(e)}")
+            self._finish(job_id, attempt, "failed", 500, "Sorry, something went wrong in this job. Contact the admin.")
+        finally:
+            _current_job["queue"], _current_job["id"] = None, None
+        return True
+
+    def _work_loop(self):
+        # Replace the handlers inherited from the parent, which only apply to the pool itself.
+        signal.signal(signal.SIGTERM, _exit)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        while True:
+            try:
+                if not self.run_next():
+                    time.sleep(JOBS_POLL_INTERVAL)
+            except Exception as e:
+                logger.error(f"Jobs:: Worker error: {str(e)}")
+                time.sleep(JOBS_POLL_INTERVAL)
+
+    def _start_worker(self):
+        # Not daemonic, so jobs can start processes of their own, the pool terminates its workers itself.
+        worker = multiprocessing.Process(target=self._work_loop)
+        worker.start()
+        return worker
+
+    def work(self, processes: int = 2):
+        """
+        Start a pool of worker processes executing queued jobs, and block while they run.
+        Workers that exit are restarted, and the jobs of stopped workers are requeued.
+
+        :param processes: The number of worker processes.
+        """
+        self._recover()
+        workers = [self._start_worker() for _ in range(max(1, processes))]
+        logger.info(f"Jobs:: Started {len(workers)} job workers")
+
+        def _stop(signum, frame):
+            # Running jobs are requeued by the next pool that starts.
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, _stop)
+        signal.signal(signal.SIGINT, _stop)
+        last_recover = time.monotonic()
+        while True:
+            for i, worker in enumerate(workers):
+                if worker.is_alive():
+                    continue
+                worker.join()
+                logger.error(f"Jobs:: Job worker {worker.pid} exited with code {worker.exitcode}, restarting it")
+                workers[i] = self._start_worker()
+            if time.monotonic() - last_recover >= self.heartbeat_interval:
+                try:
+                    self._recover()
+                except Exception as e:
+                    logger.error(f"Jobs:: Failed to recover stopped jobs: {str(e)}")
+                last_recover = time.monotonic()
+            time.sleep(JOBS_POLL_INTERVAL)
+
+
+def _exit(signum, frame):
+    # Exit through the interpreter, so a job can clean up the processes it started.
+    raise SystemExit(0)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
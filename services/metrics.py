@@ -0,0 +1,300 @@
+import atexit
+import fcntl
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, request
+
+from services.jobs import pid_alive
+
+logger = logging.getLogger(__name__)
+METRICS_DIR = "./staging/metrics"
+METRICS_FLUSH_INTERVAL = 1
+# The counters and histograms of processes that exited, folded into one file so their files can be removed.
+METRICS_AGGREGATE_FILE = "aggregate.json"
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+METRIC_HELP = {
+    "dx_http_requests_total": ("counter", "Requests handled, by route, method and status."),
+    "dx_http_request_duration_seconds": ("histogram", "Request latency, by route and method."),
+    "dx_http_requests_in_flight": ("gauge", "Requests being handled, by route."),
+    "dx_http_response_bytes_total": ("counter", "Response bytes with a known length, by route."),
+    "dx_call_duration_seconds": ("histogram", "Latency of instrumented calls, by call."),
+    "dx_calls_in_flight": ("gauge", "Instrumented calls running, by call."),
+    "dx_call_errors_total": ("counter", "Instrumented calls that raised, by call."),
+}
+
+
+class DXMetrics:
+    """
+    Request and call metrics, aggregated across the server and job worker processes.
+    Every process keeps its metrics in memory and regularly writes them to its own file in METRICS_DIR,
+    the /metrics endpoint sums the files of all processes into the Prometheus text format.
+    Gauges are only counted for processes that are still running, the counters and histograms of processes that
+    exited are folded into METRICS_AGGREGATE_FILE and their files are removed, so the directory does not grow.
+    """
+
+    def __init__(self, location: str = None) -> None:
+        self.location = location or os.getenv("METRICS_DIR", METRICS_DIR)
+        os.makedirs(self.location, exist_ok=True)
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = 0
+        self._pid = os.getpid()
+        self._adopt_pid()
+        atexit.register(self.flush)
+
+    def _key(self, name, labels):
+        self._check_fork()
+        return name, tuple(sorted(labels.items()))
+
+    def _check_fork(self):
+        # A forked process starts from zero, its parent keeps reporting what it recorded itself.
+        if self._pid != os.getpid():
+            self._counters, self._gauges, self._histograms = {}, {}, {}
+            self._pid = os.getpid()
+            self._adopt_pid()
+
+    def _adopt_pid(self):
+        # A file left by an exited process with the same pid would be overwritten, so it is folded first.
+        if os.path.exists(os.path.join(self.location, f"{os.getpid()}.json")):
+            self._fold([f"{os.getpid()}.json"])
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            key = self._key(name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def gauge(self, name: str, value: float, **labels):
+        """
+        Add value to a gauge, use a negative value to decrease it.
+        """
+        with self._lock:
+            key = self._key(name, labels)
+            self._gauges[key] = self._gauges.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Add an observation to a histogram.
+        """
+        with self._lock:
+            key = self._key(name, labels)
+            # One count per bucket, then the +Inf count and the sum
+            histogram = self._histograms.setdefault(key, [0] * (len(DURATION_BUCKETS) + 2))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += value
+        self._maybe_flush(force=value >= METRICS_FLUSH_INTERVAL)
+
+    @contextmanager
+    def timer(self, call: str, **labels):
+        """
+        Time a block of code as an instrumented call, tracking it as in flight while it runs.
+
+        :param call: The call label, for example data_manager.load_parsed_data.
+        :param labels: Any additional labels, for example the source.
+        """
+        self.gauge("dx_calls_in_flight", 1, call=call, **labels)
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.inc("dx_call_errors_total", call=call, **labels)
+            raise
+        finally:
+            self.gauge("dx_calls_in_flight", -1, call=call, **labels)
+            self.observe("dx_call_duration_seconds", time.monotonic() - start, call=call, **labels)
+
+    def instrument(self, obj, prefix: str, methods: list):
+        """
+        Replace methods of an object with timed wrappers.
+
+        :param obj: The object, for example the data manager.
+        :param prefix: The prefix of the call label, for example data_manager.
+        :param methods: The names of the methods to time.
+        """
+        for method in methods:
+            setattr(obj, method, self._timed(getattr(obj, method), f"{prefix}.{method}"))
+
+    def _timed(self, fn, call):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.timer(call):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    def init_app(self, app):
+        """
+        Time every request of a flask app, and add the /metrics endpoint.
+
+        :param app: The flask app.
+        """
+
+        @app.before_request
+        def _before():
+            g.metrics_route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            g.metrics_start = time.monotonic()
+            self.gauge("dx_http_requests_in_flight", 1, route=g.metrics_route)
+
+        @app.after_request
+        def _after(response):
+            route = g.get("metrics_route", "unmatched")
+            self.inc("dx_http_requests_total", route=route, method=request.method, status=str(response.status_code))
+            self.observe(
+                "dx_http_request_duration_seconds",
+                time.monotonic() - g.get("metrics_start", time.monotonic()),
+                route=route,
+                method=request.method,
+            )
+            if response.content_length is not None:
+                self.inc("dx_http_response_bytes_total", response.content_length, route=route)
+            return response
+
+        @app.teardown_request
+        def _teardown(exc):
+            if "metrics_route" in g:
+                self.gauge("dx_http_requests_in_flight", -1, route=g.pop("metrics_route"))
+
+        @app.route("/metrics", methods=["GET"])
+        def metrics():
+            return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+    def _maybe_flush(self, force=False):
+        if force or time.monotonic() - self._last_flush >= METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the metrics of this process to its file.
+        """
+        with self._lock:
+            self._check_fork()
+            self._last_flush = time.monotonic()
+            snapshot = {
+                "counters": [[name, dict(labels), value] for (name, labels), value in self._counters.items()],
+                "gauges": [[name, dict(labels), value] for (name, labels), value in self._gauges.items()],
+                "histograms": [[name, dict(labels), value] for (name, labels), value in self._histograms.items()],
+            }
+        path = os.path.join(self.location, f"{os.getpid()}.json")
+        try:
+            with self._flush_lock:
+                with open(f"{path}.tmp", "w") as f:
+                    json.dump(snapshot, f)
+                os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            logger.error(f"Metrics:: Error writing {path}: {str(e)}")
+
+    def collect(self) -> dict:
+        """
+        Sum the metrics of all processes, folding the files of processes that exited into the aggregate.
+
+        :return: A dictionary with the summed counters, gauges and histograms, keyed by name and labels.
+        """
+        self.flush()
+        filenames = [f for f in os.listdir(self.location) if f.endswith(".json") and f != METRICS_AGGREGATE_FILE]
+        exited = [f for f in filenames if not pid_alive(int(f[: -len(".json")]))]
+        if exited:
+            self._fold(exited)
+        res = {"counters": {}, "gauges": {}, "histograms": {}}
+        for filename in [METRICS_AGGREGATE_FILE] + [f for f in filenames if f not in exited]:
+            snapshot = self._read(filename)
+            if snapshot is None:
+                continue
+            _merge(res, snapshot, ["counters", "gauges", "histograms"])
+        return res
+
+    def _read(self, filename):
+        try:
+            with open(os.path.join(self.location, filename)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.error(f"Metrics:: Error reading {filename}: {str(e)}")
+            return None
+
+    def _fold(self, filenames):
+        """
+        Add the counters and histograms of exited processes to the aggregate file, and remove their files.
+        The aggregate is locked, as every server worker may fold the same files at the same time.
+        """
+        with open(os.path.join(self.location, f"{METRICS_AGGREGATE_FILE}.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            res = {"counters": {}, "histograms": {}}
+            _merge(res, self._read(METRICS_AGGREGATE_FILE) or {}, ["counters", "histograms"])
+            folded = []
+            for filename in filenames:
+                # Already folded by another process when it no longer exists.
+                snapshot = self._read(filename)
+                if snapshot is not None:
+                    _merge(res, snapshot, ["counters", "histograms"])
+                    folded.append(filename)
+            if not folded:
+                return
+            path = os.path.join(self.location, METRICS_AGGREGATE_FILE)
+            aggregate = {
+                kind: [[name, dict(labels), value] for (name, labels), value in res[kind].items()] for kind in res
+            }
+            try:
+                with open(f"{path}.tmp", "w") as f:
+                    json.dump(aggregate, f)
+                os.replace(f"{path}.tmp", path)
+                for filename in folded:
+                    os.remove(os.path.join(self.location, filename))
+            except Exception as e:
+                logger.error(f"Metrics:: Error writing {path}: {str(e)}")
+
+    def render(self) -> str:
+        """
+        Render the metrics of all processes in the Prometheus text format.
+        """
+        collected = self.collect()
+        series = {}
+        for kind in ["counters", "gauges", "histograms"]:
+            for (name, labels), value in collected[kind].items():
+                series.setdefault(name, []).append((dict(labels), value))
+        lines = []
+        for name in sorted(series):
+            metric_type, description = METRIC_HELP.get(name, ("untyped", name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in sorted(series[name], key=lambda s: sorted(s[0].items())):
+                if metric_type != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {value}")
+                    continue
+                for bound, count in zip(DURATION_BUCKETS, value):
+                    lines.append(f"{name}_bucket{_labels(dict(labels, le=str(bound)))} {count}")
+                lines.append(f"{name}_bucket{_labels(dict(labels, le='+Inf'))} {value[-2]}")
+                lines.append(f"{name}_count{_labels(labels)} {value[-2]}")
+                lines.append(f"{name}_sum{_labels(labels)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def _merge(res, snapshot, kinds):
+    for kind in kinds:
+        for name, labels, value in snapshot.get(kind, []):
+            key = (name, tuple(sorted(labels.items())))
+            if kind == "histograms":
+                current = res[kind].setdefault(key, [0] * len(value))
+                res[kind][key] = [a + b for a, b in zip(current, value)]
+            else:
+                res[kind][key] = res[kind].get(key, 0) + value
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels.items()]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
@@ -0,0 +1,327 @@
+import logging
+import os
+from datetime import datetime
+
+import pymongo
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from rb_core_backend.mongo import RBCoreBackendMongo
+
+logger = logging.getLogger(__name__)
+# Fields that are managed by MongoDB or the search query, and should never be written back.
+EXCLUDED_UPSERT_FIELDS = ["_id", "score"]
+EXTERNAL_SOURCE_REFS_BATCH_SIZE = 5000
+# Collection holding the per source indexing state, such as the watermark of the last successful run.
+EXTERNAL_SOURCE_STATE_COLLECTION = "FederatedSearchIndexState"
+# Collection holding the precomputed, unfiltered facet counts of every source.
+EXTERNAL_SOURCE_FACETS_COLLECTION = "FederatedSearchFacets"
+
+
+class DXBackendMongo(RBCoreBackendMongo):
+    """
+    RBCoreBackendMongo extended with the bulk operations used by the DX external source indexers.
+    We keep our own pymongo client for these, created lazily per process so it is safe to use after forking.
+    """
+
+    def __init__(
+        self,
+        mongo_host: str,
+        mongo_username: str,
+        mongo_password: str,
+        mongo_auth_source: str,
+        database_name: str,
+        fs_db_name: str,
+    ) -> None:
+        super().__init__(
+            mongo_host=mongo_host,
+            mongo_username=mongo_username,
+            mongo_password=mongo_password,
+            mongo_auth_source=mongo_auth_source,
+            database_name=database_name,
+            fs_db_name=fs_db_name,
+        )
+        self.dx_mongo_host = mongo_host
+        self.dx_mongo_username = mongo_username
+        self.dx_mongo_password = mongo_password
+        self.dx_mongo_auth_source = mongo_auth_source
+        self.dx_database_name = database_name
+        self.dx_fs_db_name = fs_db_name
+        self._dx_client = None
+        self._dx_client_pid = None
+
+    def reconnect(self):
+        """
+        Replace the mongo clients inherited from the parent process, call this first thing after forking.
+        The client of RBCoreBackendMongo is created when it is constructed, so that part is constructed again.
+        The inherited clients are not closed, as they share their connections with the parent.
+        """
+        super().__init__(
+            mongo_host=self.dx_mongo_host,
+            mongo_username=self.dx_mongo_username,
+            mongo_password=self.dx_mongo_password,
+            mongo_auth_source=self.dx_mongo_auth_source,
+            database_name=self.dx_database_name,
+            fs_db_name=self.dx_fs_db_name,
+        )
+        self._dx_client = None
+        self._dx_client_pid = None
+
+    def _dx_database(self):
+        """
+        Get the database, (re)connecting when this is the first call in the current process.
+        """
+        if self._dx_client is None or self._dx_client_pid != os.getpid():
+            self._dx_client = pymongo.MongoClient(
+                self.dx_mongo_host,
+                username=self.dx_mongo_username,
+                password=self.dx_mongo_password,
+                authSource=self.dx_mongo_auth_source,
+            )
+            self._dx_client_pid = os.getpid()
+        return self._dx_client[self.dx_database_name]
+
+    def _dx_external_sources(self):
+        return self._dx_database()[self.dx_fs_db_name]
+
+    def mongo_create_lookup_indexes_for_external_sources(self):
+        """
+        Ensure the compound indexes used by the DX lookups exist:
+        source + internalRef to key the bulk upserts, and source + title to resolve indexed resources.
+        """
+        try:
+            collection = self._dx_external_sources()
+            collection.create_index(
+                [("source", pymongo.ASCENDING), ("internalRef", pymongo.ASCENDING)],
+                name="source_internalRef",
+            )
+            collection.create_index(
+                [("source", pymongo.ASCENDING), ("title", pymongo.ASCENDING)],
+                name="source_title",
+            )
+        except Exception as e:
+            logger.error(f"Error in mongo_create_lookup_indexes_for_external_sources: {str(e)}")
+
+    def mongo_bulk_upsert_external_sources(self, external_datasets: list) -> dict:
+        """
+        Upsert a batch of external datasets in a single unordered bulk write, keyed on source and internalRef.
+
+        :param external_datasets: A list of documents in the EXTERNAL_DATASET_FORMAT.
+        :return: A dictionary with the number of inserted, updated, matched and failed documents.
+        """
+        result = {"inserted": 0, "updated": 0, "matched": 0, "failed": 0}
+        if len(external_datasets) == 0:
+            return result
+        operations = []
+        for external_dataset in external_datasets:
+            document = {k: v for k, v in external_dataset.items() if k not in EXCLUDED_UPSERT_FIELDS}
+            operations.append(
+                UpdateOne(
+                    {"source": document["source"], "internalRef": document["internalRef"]},
+                    {"$set": document},
+                    upsert=True,
+                )
+            )
+        try:
+            res = self._dx_external_sources().bulk_write(operations, ordered=False)
+            result["inserted"] = res.upserted_count
+            result["updated"] = res.modified_count
+            result["matched"] = res.matched_count
+        except BulkWriteError as e:
+            details = e.details
+            result["inserted"] = details.get("nUpserted", 0)
+            result["updated"] = details.get("nModified", 0)
+            result["matched"] = details.get("nMatched", 0)
+            result["failed"] = len(details.get("writeErrors", []))
+            logger.error(f"Error in mongo_bulk_upsert_external_sources: {result['failed']} write errors")
+        except Exception as e:
+            result["failed"] = len(operations)
+            logger.error(f"Error in mongo_bulk_upsert_external_sources: {str(e)}")
+        return result
+
+    def mongo_get_external_source_refs(self, source: str) -> dict:
+        """
+        Get the internalRef and dateSourceLastUpdated of every external dataset for a single source.
+        The documents are projected and streamed through a cursor, so descriptions and resources are never loaded.
+
+        :param source: The source name as stored on the documents, for example "HDX" or "World Bank".
+        :return: A dictionary mapping internalRef to dateSourceLastUpdated.
+        """
+        refs = {}
+        cursor = self._dx_external_sources().find(
+            {"source": source},
+            projection={"_id": 0, "internalRef": 1, "dateSourceLastUpdated": 1},
+            batch_size=EXTERNAL_SOURCE_REFS_BATCH_SIZE,
+        )
+        for document in cursor:
+            refs[document.get("internalRef")] = document.get("dateSourceLastUpdated", "")
+        return refs
+
+    def mongo_get_external_source_documents(self, source: str, fields: list) -> dict:
+        """
+        Get the given fields of every external dataset for a single source, streamed through a cursor.
+
+        :param source: The source name as stored on the documents.
+        :param fields: The fields to project, for example ["title", "resources.URI"].
+        :return: A dictionary mapping internalRef to the projected document.
+        """
+        projection = {"_id": 0, "internalRef": 1}
+        projection.update({field: 1 for field in fields})
+        cursor = self._dx_external_sources().find(
+            {"source": source}, projection=projection, batch_size=EXTERNAL_SOURCE_REFS_BATCH_SIZE
+        )
+        return {document.get("internalRef"): document for document in cursor}
+
+    def mongo_remove_external_sources(self, source: str, internal_refs: list) -> int:
+        """
+        Remove the external datasets of a source with the given internalRefs, leaving the rest of the source in place.
+
+        :param source: The source name as stored on the documents.
+        :param internal_refs: The internalRefs to remove.
+        :return: The number of removed documents.
+        """
+        removed = 0
+        internal_refs = list(internal_refs)
+        for start in range(0, len(internal_refs), EXTERNAL_SOURCE_REFS_BATCH_SIZE):
+            batch = internal_refs[start:start + EXTERNAL_SOURCE_REFS_BATCH_SIZE]
+            res = self._dx_external_sources().delete_many({"source": source, "internalRef": {"$in": batch}})
+            removed += res.deleted_count
+        return removed
+
+    def mongo_get_external_source_by_title(self, source: str, title: str):
+        """
+        Get the resources of an indexed external dataset by its title.
+
+        :param source: The source name.
+        :param title: The exact title of the external dataset.
+        :return: The document with only its resources, or None if it is not indexed.
+        """
+        return self._dx_external_sources().find_one(
+            {"source": source, "title": title},
+            projection={"_id": 0, "resources": 1},
+        )
+
+    def mongo_get_index_watermark(self, source: str):
+        """
+        Get the watermark stored by the last successful indexing run of a source.
+
+        :param source: The source name.
+        :return: The watermark, or None if the source was never indexed incrementally.
+        """
+        state = self._dx_database()[EXTERNAL_SOURCE_STATE_COLLECTION].find_one({"source": source})
+        if state is None:
+            return None
+        return state.get("watermark")
+
+    def mongo_set_index_watermark(self, source: str, watermark: str):
+        """
+        Store the watermark of a successful indexing run of a source.
+
+        :param source: The source name.
+        :param watermark: The watermark, for HDX the latest metadata_modified date that was indexed,
+                          for WHO the sha256 of the GHO catalog that was indexed.
+        """
+        self._dx_database()[EXTERNAL_SOURCE_STATE_COLLECTION].update_one(
+            {"source": source},
+            {"$set": {"watermark": watermark, "dateLastUpdated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}},
+            upsert=True,
+        )
+
+    def mongo_bump_search_generation(self, source: str):
+        """
+        Increase the search generation of a source, marking cached search results that include it as outdated.
+
+        :param source: The source name, or "*" for a run that indexed every source.
+        """
+        self._dx_database()[EXTERNAL_SOURCE_STATE_COLLECTION].update_one(
+            {"source": source},
+            {"$inc": {"searchGeneration": 1}},
+            upsert=True,
+        )
+
+    def mongo_get_search_generations(self) -> dict:
+        """
+        Get the search generation of every source.
+
+        :return: A dictionary mapping the source names to their generation.
+        """
+        cursor = self._dx_database()[EXTERNAL_SOURCE_STATE_COLLECTION].find(
+            {}, projection={"_id": 0, "source": 1, "searchGeneration": 1}
+        )
+        return {state["source"]: state.get("searchGeneration", 0) for state in cursor}
+
+    def mongo_facet_external_sources(self, query: str, sources: list = None) -> dict:
+        """
+        Count the external datasets matching a text search by source and by main category, in one aggregation.
+
+        :param query: The text search query.
+        :param sources: Optionally only count these sources, as stored on the documents.
+        :return: A dictionary with the source and mainCategory counts.
+        """
+        match = {"$text": {"$search": query}}
+        if sources:
+            match["source"] = {"$in": sources}
+        pipeline = [
+            {"$match": match},
+            {
+                "$facet": {
+                    "source": [{"$group": {"_id": "$source", "count": {"$sum": 1}}}],
+                    "mainCategory": [{"$group": {"_id": "$mainCategory", "count": {"$sum": 1}}}],
+                }
+            },
+        ]
+        res = next(self._dx_external_sources().aggregate(pipeline), {})
+        return {facet: _counts(res.get(facet, [])) for facet in ["source", "mainCategory"]}
+
+    def mongo_refresh_external_source_facets(self, sources: list = None):
+        """
+        Recompute the unfiltered facet counts of some or all sources.
+
+        :param sources: The sources to refresh, as stored on the documents, or None to refresh all of them.
+        """
+        match = {"source": {"$in": sources}} if sources else {}
+        pipeline = [
+            {"$match": match},
+            {"$group": {"_id": {"source": "$source", "mainCategory": "$mainCategory"}, "count": {"$sum": 1}}},
+        ]
+        facets = {source: {} for source in sources or []}
+        for group in self._dx_external_sources().aggregate(pipeline):
+            source_facets = facets.setdefault(group["_id"].get("source"), {})
+            category = group["_id"].get("mainCategory")
+            source_facets[category] = source_facets.get(category, 0) + group["count"]
+        collection = self._dx_database()[EXTERNAL_SOURCE_FACETS_COLLECTION]
+        if not sources:
+            collection.delete_many({"source": {"$nin": list(facets)}})
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for source, categories in facets.items():
+            collection.update_one(
+                {"source": source},
+                {
+                    "$set": {
+                        "count": sum(categories.values()),
+                        "mainCategory": [{"_id": k, "count": v} for k, v in categories.items()],
+                        "dateLastUpdated": now,
+                    }
+                },
+                upsert=True,
+            )
+
+    def mongo_get_external_source_facets(self, sources: list = None) -> dict:
+        """
+        Get the precomputed, unfiltered facet counts.
+
+        :param sources: Optionally only count these sources, as stored on the documents.
+        :return: A dictionary with the source and mainCategory counts.
+        """
+        res = {"source": {}, "mainCategory": {}}
+        for state in self._dx_database()[EXTERNAL_SOURCE_FACETS_COLLECTION].find({}, projection={"_id": 0}):
+            if sources and state["source"] not in sources:
+                continue
+            res["source"][state["source"]] = state.get("count", 0)
+            for category, count in _counts(state.get("mainCategory", [])).items():
+                res["mainCategory"][category] = res["mainCategory"].get(category, 0) + count
+        return res
+
+
+def _counts(groups):
+    # Documents without a value for the facet are not counted in it.
+    return {group["_id"]: group["count"] for group in groups if group.get("_id") not in [None, ""]}
@@ -0,0 +1,84 @@
+import json
+import logging
+import mmap
+import os
+
+from flask import Response, make_response, request
+from rb_core_backend.util import json_return
+from werkzeug.wsgi import wrap_file
+
+logger = logging.getLogger(__name__)
+PASSTHROUGH_CHUNK_SIZE = 1024 * 1024
+# Placeholder result used to find where json_return puts the result in its envelope.
+_SENTINEL = "__dx_passthrough_result__"
+_ENVELOPES = {}
+
+
+def passthrough_enabled() -> bool:
+    return os.getenv("DATASET_PASSTHROUGH", "false").lower() == "true"
+
+
+def _envelope(code: int):
+    """
+    Get the bytes json_return writes before and after the result, by rendering it once with a placeholder result.
+
+    :param code: The status code of the response.
+    :return: A tuple of the prefix and suffix bytes.
+    """
+    if code not in _ENVELOPES:
+        body = make_response(json_return(code, _SENTINEL)).get_data()
+        prefix, found, suffix = body.partition(json.dumps(_SENTINEL).encode())
+        if not found or _SENTINEL.encode() in suffix:
+            raise ValueError("The json_return envelope could not be derived")
+        _ENVELOPES[code] = (prefix, suffix)
+    return _ENVELOPES[code]
+
+
+def _stream_mmap(mm, prefix, suffix):
+    try:
+        yield prefix
+        for start in range(0, len(mm), PASSTHROUGH_CHUNK_SIZE):
+            # The server only accepts bytes, so only one chunk at a time is copied out of the mapping.
+            end = start + PASSTHROUGH_CHUNK_SIZE
+            yield mm[start:end]
+        yield suffix
+    finally:
+        mm.close()
+
+
+def stream_json_file(path: str, code: int = 200, envelope: bool = True):
+    """
+    Respond with an already serialised JSON file, without decoding and encoding it again.
+    With the envelope, the file is memory mapped and streamed as the result of the json_return envelope.
+    Without it, the file is handed to the server's file wrapper, which uses sendfile where available.
+
+    :param path: The path of the JSON file.
+    :param code: The status code of the response.
+    :param envelope: Whether to wrap the file in the json_return envelope.
+    :return: The streaming response, or None if the file cannot be passed through.
+    """
+    try:
+        # The size is taken from the opened file, so a file replaced in the meantime cannot break Content-Length.
+        f = open(path, "rb")
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            f.close()
+            return None
+        if not envelope:
+            body = wrap_file(request.environ, f, PASSTHROUGH_CHUNK_SIZE)
+            prefix, suffix = b"", b""
+        else:
+            prefix, suffix = _envelope(code)
+            with f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            body = _stream_mmap(mm, prefix, suffix)
+    except Exception as e:
+        logger.error(f"Error passing through {path}: {str(e)}")
+        return None
+    return Response(
+        body,
+        status=code,
+        mimetype="application/json",
+        headers={"Content-Length": str(len(prefix) + size + len(suffix))},
+        direct_passthrough=True,
+    )
@@ -0,0 +1,78 @@
+import logging
+import os
+import sqlite3
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+SIZE_LEDGER_DB = "./staging/sizes.sqlite3"
+
+
+class DXDatasetSizeLedger:
+    """
+    A persistent ledger of the size in bytes of every dataset's files, backed by a local SQLite file.
+    It is updated when datasets are created, duplicated or deleted,
+    so sizes are looked up instead of computed from disk.
+    """
+
+    def __init__(self, location: str = None) -> None:
+        self.location = location or os.getenv("SIZE_LEDGER_DB", SIZE_LEDGER_DB)
+        os.makedirs(os.path.dirname(os.path.abspath(self.location)), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sizes (id TEXT PRIMARY KEY, bytes INTEGER NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.location, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def record(self, ds_id: str, size: int):
+        """
+        Record the size of a dataset.
+
+        :param ds_id: The dataset id.
+        :param size: The size of its files in bytes.
+        """
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO sizes (id, bytes) VALUES (?, ?)", (ds_id, size))
+
+    def remove(self, ds_id: str):
+        """
+        Remove a dataset from the ledger.
+
+        :param ds_id: The dataset id.
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sizes WHERE id = ?", (ds_id,))
+
+    def lookup(self, ds_ids: list) -> dict:
+        """
+        Get the recorded sizes of a list of datasets.
+
+        :param ds_ids: The dataset ids.
+        :return: A dictionary mapping the dataset ids that are in the ledger to their size in bytes.
+        """
+        sizes = {}
+        with self._connect() as conn:
+            # Stay below the SQLite limit on the number of query parameters.
+            for start in range(0, len(ds_ids), 500):
+                batch = ds_ids[start:start + 500]
+                placeholders = ", ".join("?" for _ in batch)
+                rows = conn.execute(f"SELECT id, bytes FROM sizes WHERE id IN ({placeholders})", batch).fetchall()
+                sizes.update(rows)
+        return sizes
+
+    def rebuild(self, sizes: dict):
+        """
+        Replace the whole ledger.
+
+        :param sizes: A dictionary mapping every dataset id to its size in bytes.
+        """
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM sizes")
+            conn.executemany("INSERT INTO sizes (id, bytes) VALUES (?, ?)", sizes.items())
+            conn.execute("COMMIT")
@@ -0,0 +1,98 @@
+import json
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from services.data_management import PARSED_DATA_FOLDER, DXRBCoreDataManagement, write_frames_parquet
+
+
+def test_write_frames_parquet_keeps_column_types(tmp_path):
+    path = tmp_path / "dx1.parquet"
+    df = pd.DataFrame(
+        {
+            "year": [2020, 2021],
+            "value": [1.5, 2.0],
+            "date": pd.to_datetime(["2020-01-01", "2021-06-30"]),
+            "country": pd.Categorical(["NL", "FR"]),
+        }
+    )
+
+    assert write_frames_parquet(df, str(path)) == 2
+
+    res = pd.read_parquet(path)
+    assert res["year"].tolist() == [2020, 2021]
+    assert str(res["year"].dtype) == "int64"
+    assert str(res["value"].dtype) == "float64"
+    assert str(res["date"].dtype) == "datetime64[ns]"
+    assert res["country"].tolist() == ["NL", "FR"]
+    assert not isinstance(res["country"].dtype, pd.CategoricalDtype)
+
+
+def test_write_frames_parquet_unifies_frames(tmp_path):
+    path = tmp_path / "dx1.parquet"
+    frames = iter(
+        [
+            pd.DataFrame({"code": [1, 2], "value": [1, 2], "empty": [None, None]}),
+            pd.DataFrame({"code": ["A", "B"], "value": [3.5, None], "label": ["x", "y"]}),
+        ]
+    )
+
+    assert write_frames_parquet(frames, str(path), drop_empty_columns=True) == 4
+
+    res = pq.read_table(path).to_pylist()
+    assert res == [
+        {"code": "1", "value": 1.0, "label": None},
+        {"code": "2", "value": 2.0, "label": None},
+        {"code": "A", "value": 3.5, "label": "x"},
+        {"code": "B", "value": None, "label": "y"},
+    ]
+
+
+def test_write_frames_parquet_without_rows(tmp_path):
+    path = tmp_path / "dx1.parquet"
+
+    assert write_frames_parquet(iter([]), str(path)) == 0
+    assert not path.exists()
+
+
+def _data_manager(tmp_path, rows):
+    (tmp_path / PARSED_DATA_FOLDER).mkdir()
+    with open(tmp_path / PARSED_DATA_FOLDER / "1.json", "w") as f:
+        json.dump({"dataset": rows, "count": len(rows)}, f)
+    return DXRBCoreDataManagement(location=f"{tmp_path}/")
+
+
+def test_migrate_parsed_to_columnar_round_trip(tmp_path):
+    rows = [
+        {"a": 1, "b": "x", "c": None, "d": True, "e": 1.5},
+        {"a": 2, "b": None, "c": 3.0, "d": False, "e": 2.0},
+        {"a": 3, "b": "z", "c": None, "d": None, "e": None},
+    ]
+    data_manager = _data_manager(tmp_path, rows)
+
+    assert data_manager.migrate_parsed_to_columnar("dx1", row_group_size=2) == "Success"
+
+    meta = data_manager._columnar_meta("1")
+    assert meta["numRows"] == 3
+    assert meta["rowGroupOffsets"] == [0, 2]
+    assert meta["meta"] == {"count": 3}
+    assert data_manager._read_rows("1", meta["rowGroupOffsets"], 0, 3) == rows
+    assert data_manager._read_rows("1", meta["rowGroupOffsets"], 1, 3) == rows[1:]
+    assert [type(row["a"]) for row in data_manager._read_rows("1", meta["rowGroupOffsets"], 0, 3)] == [int] * 3
+
+
+def test_migrate_parsed_to_columnar_keeps_mixed_types_in_json(tmp_path):
+    data_manager = _data_manager(tmp_path, [{"a": 1, "b": "x"}, {"a": 2.5, "b": "y"}])
+
+    assert data_manager.migrate_parsed_to_columnar("dx1") != "Success"
+    assert data_manager._columnar_meta("1") is None
+    assert sorted(os.listdir(tmp_path / PARSED_DATA_FOLDER)) == ["1.json"]
+
+
+def test_migrate_parsed_to_columnar_keeps_rows_with_different_keys_in_json(tmp_path):
+    data_manager = _data_manager(tmp_path, [{"a": 1, "b": "x"}, {"a": 2, "b": "y", "c": 3}])
+
+    assert data_manager.migrate_parsed_to_columnar("dx1") != "Success"
+    assert data_manager._columnar_meta("1") is None
+    assert sorted(os.listdir(tmp_path / PARSED_DATA_FOLDER)) == ["1.json"]
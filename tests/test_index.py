@@ -0,0 +1,18 @@
+import pytest
+
+from services.external_sources.index import _index_status
+
+
+@pytest.mark.parametrize(
+    "counters, status",
+    [
+        ({"fetched": 40, "failed": 40}, "failed"),
+        ({"fetched": 40}, "failed"),
+        ({"fetched": 40, "inserted": 2, "failed": 38}, "success"),
+        ({"fetched": 40, "skipped": 40}, "success"),
+        ({"fetched": 40, "updated": 1, "skipped": 39}, "success"),
+        ({}, "success"),
+    ],
+)
+def test_index_status_from_counters(counters, status):
+    assert _index_status(counters) == status
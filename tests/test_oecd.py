@@ -0,0 +1,147 @@
+import io
+from contextlib import contextmanager
+
+import pandas as pd
+import pytest
+
+from services.external_sources import oecd
+from services.external_sources.oecd import OECD_COLS, OECD_TOO_LARGE, DXExternalSourceOECD
+
+SDMX_CSV = b"""STRUCTURE,STRUCTURE_ID,REF_AREA,Reference area,TIME_PERIOD,OBS_VALUE
+DATAFLOW,OECD.SDD:DF_X,NLD,Netherlands,2020,1.5
+DATAFLOW,OECD.SDD:DF_X,FRA,France,2021,2
+DATAFLOW,OECD.SDD:DF_X,NLD,Netherlands,2022,
+"""
+
+
+class FakeResponse:
+    def __init__(self, content):
+        self.raw = io.BytesIO(content)
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, content):
+        self.content = content
+
+    @contextmanager
+    def get(self, url, **kwargs):
+        yield FakeResponse(self.content)
+
+    def fetch(self, url):
+        return {"path": url}
+
+
+class FakePreprocessor:
+    def __init__(self):
+        self.chunks = []
+
+    def preprocess_dataframe(self, frames, name, drop_empty_columns=False):
+        for frame in frames:
+            self.chunks.append(frame)
+        return "Success"
+
+
+def _download(monkeypatch, content, **env):
+    monkeypatch.setattr(oecd, "http_client", lambda: FakeClient(content))
+    for key, value in env.items():
+        monkeypatch.setenv(key, value)
+    preprocessor = FakePreprocessor()
+    source = DXExternalSourceOECD(mongo_client=None, dataset_preprocessor=preprocessor)
+    url = "https://data-explorer.oecd.org/vis?df[ds]=dsDisseminateFinalDMZ&df[id]=DF_X&df[ag]=OECD.SDD"
+    return source.download({"id": "dx1", "url": url}), preprocessor.chunks
+
+
+def test_download_hands_categorical_chunks_to_the_preprocessor(monkeypatch):
+    res, chunks = _download(monkeypatch, SDMX_CSV, OECD_CSV_CHUNK_SIZE="2")
+
+    assert res == "Success"
+    assert [len(chunk) for chunk in chunks] == [2, 1]
+    assert all(isinstance(chunk["Reference area"].dtype, pd.CategoricalDtype) for chunk in chunks)
+    assert chunks[0]["OBS_VALUE"].tolist() == [1.5, 2.0]
+    assert chunks[0]["TIME_PERIOD"].dtype == "int64"
+
+
+def test_download_refuses_datasets_over_the_maximum_rows(monkeypatch):
+    res, _ = _download(monkeypatch, SDMX_CSV, OECD_CSV_CHUNK_SIZE="2", OECD_MAX_ROWS="2")
+
+    assert res == OECD_TOO_LARGE
+
+
+OECD_URLS = [
+    "https://data-explorer.oecd.org/vis?df[ds]=dsDisseminateFinalDMZ&df[id]=DSD_X%40DF_Y&df[ag]=OECD.SDD&dq=..A",
+    "https://data-explorer.oecd.org/vis?df%5Bds%5D=dsDisseminateFinalDMZ&df%5Bid%5D=DSD_X%40DF_Y&df%5Bag%5D=OECD.SDD",
+    "https://data-explorer.oecd.org/vis?df%5bds%5d=dsDisseminateFinalDMZ&df%5bid%5d=DSD_X%40DF_Y&df%5bag%5d=OECD.SDD",
+    "https://data-explorer.oecd.org/vis?dataflow[agencyId]=OECD.SDD&dataflow[dataflowId]=DSD_X@DF_Y&lc=en",
+    "https://data-explorer.oecd.org/vis?dataflow%5BagencyId%5D=OECD.SDD&dataflow%5BdataflowId%5D=DSD_X%40DF_Y",
+]
+
+
+def _workbook(urls, refs=None):
+    refs = refs or [f"REF{i}" for i in range(len(urls))]
+    return pd.DataFrame(
+        {
+            OECD_COLS[0]: refs,
+            OECD_COLS[1]: [f"Title {ref}" for ref in refs],
+            OECD_COLS[4]: [f"Description {ref}" for ref in refs],
+            OECD_COLS[6]: urls,
+        }
+    )
+
+
+@pytest.mark.parametrize("url", OECD_URLS)
+def test_build_documents_parses_every_url_variant(url):
+    documents = DXExternalSourceOECD._build_documents(_workbook([url]))
+
+    assert list(documents) == ["REF0"]
+    resource_uri = documents["REF0"]["resources"][0]["URI"]
+    assert resource_uri.startswith("https://sdmx.oecd.org/public/rest/data/OECD.SDD,DSD_X@DF_Y/all?")
+    assert DXExternalSourceOECD._convert_oecd_url(url).startswith(
+        "https://sdmx.oecd.org/public/rest/data/OECD.SDD,DSD_X@DF_Y?"
+    )
+
+
+class FakeMongo:
+    def __init__(self, existing):
+        self.existing = existing
+        self.removed = []
+
+    def mongo_get_external_source_documents(self, source, fields):
+        return self.existing
+
+    def mongo_remove_external_sources(self, source, internal_refs):
+        self.removed.extend(internal_refs)
+        return len(internal_refs)
+
+
+class FakeWriter:
+    n_failed = 0
+
+    def __init__(self, mongo_client):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def add(self, document):
+        pass
+
+
+def test_index_only_removes_datasets_that_left_the_workbook(monkeypatch):
+    workbook = _workbook([OECD_URLS[0], "https://data-explorer.oecd.org/vis?lc=en"], refs=["LISTED", "UNPARSED"])
+    # The last column of the workbook holds unused references, and is dropped.
+    workbook["References"] = None
+    monkeypatch.setattr(oecd, "http_client", lambda: FakeClient(b""))
+    monkeypatch.setattr(pd, "read_excel", lambda path, header: workbook)
+    monkeypatch.setattr(oecd, "ExternalSourceWriter", FakeWriter)
+    existing = {ref: {"internalRef": ref} for ref in ["LISTED", "UNPARSED", "GONE"]}
+    mongo = FakeMongo(existing)
+
+    DXExternalSourceOECD(mongo_client=mongo, dataset_preprocessor=None).index()
+
+    assert mongo.removed == ["GONE"]
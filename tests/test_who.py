@@ -0,0 +1,77 @@
+from contextlib import contextmanager
+
+import requests
+
+from services.external_sources import who
+from services.external_sources.who import DXExternalSourceWHO
+
+PAGES = [
+    [{"Id": 1, "SpatialDim": "NLD", "TimeDim": 2020, "NumericValue": 1.5, "Comments": None}],
+    [{"Id": 2, "SpatialDim": "FRA", "TimeDim": 2021, "NumericValue": 2.0, "Comments": None}],
+]
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+    def json(self):
+        return dict(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+
+class FakeClient:
+    def __init__(self, responses):
+        self.responses = responses
+        self.n_requests = 0
+
+    @contextmanager
+    def get(self, url, **kwargs):
+        self.n_requests += 1
+        yield self.responses.pop(0)
+
+
+class FakePreprocessor:
+    def __init__(self, client):
+        self.client = client
+        self.pages = []
+
+    def preprocess_dataframe(self, frames, name, drop_empty_columns=False):
+        assert drop_empty_columns
+        for frame in frames:
+            # Every page is handed over before the next one is requested.
+            self.pages.append((frame, self.client.n_requests))
+        return "Success"
+
+
+def _download(monkeypatch, responses):
+    client = FakeClient(responses)
+    monkeypatch.setattr(who, "http_client", lambda: client)
+    preprocessor = FakePreprocessor(client)
+    source = DXExternalSourceWHO(mongo_client=None, dataset_preprocessor=preprocessor)
+    res = source.download({"id": "dx1", "name": "Indicator - WHO Code: WHOSIS_000001"})
+    return res, preprocessor.pages
+
+
+def test_download_hands_pages_to_the_preprocessor_as_they_arrive(monkeypatch):
+    responses = [
+        FakeResponse({"value": PAGES[0], "@odata.nextLink": "https://ghoapi.azureedge.net/api/next"}),
+        FakeResponse({"value": PAGES[1]}),
+    ]
+
+    res, pages = _download(monkeypatch, responses)
+
+    assert res == "Success"
+    assert [n_requests for _, n_requests in pages] == [1, 2]
+    assert [page["SpatialDim"].tolist() for page, _ in pages] == [["NLD"], ["FRA"]]
+    assert all("Id" not in page.columns for page, _ in pages)
+
+
+def test_download_reports_failed_requests(monkeypatch):
+    res, _ = _download(monkeypatch, [FakeResponse({}, status_code=503)])
+
+    assert res.startswith("Sorry, we were unable to download the WHO Dataset")